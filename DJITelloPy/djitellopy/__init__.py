@@ -1,2 +1,5 @@
 from .tello import Tello, TelloException, BackgroundFrameRead
-from .swarm import TelloSwarm
\ No newline at end of file
+from .async_tello import AsyncTello
+from .state import TelloState, StateParser, StateHistory
+from .swarm import TelloSwarm
+from .emulator import TelloEmulator
\ No newline at end of file
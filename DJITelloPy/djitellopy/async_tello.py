@@ -0,0 +1,420 @@
+"""Asyncio client for DJI Ryze Tello drones.
+"""
+
+# coding=utf-8
+import asyncio
+import logging
+import time
+from typing import Optional, Union, Type, Dict, AsyncIterator
+
+from .enforce_types import enforce_types
+from .state import StateParser, TelloState, StateHistory
+
+
+class TelloException(Exception):
+    pass
+
+
+class TelloResponseProtocol(asyncio.DatagramProtocol):
+    """Receives the command responses of all the drones on the control client port.
+    Internal class, you normally wouldn't use this yourself.
+    """
+
+    def datagram_received(self, data: bytes, address: tuple):
+        AsyncTello.LOGGER.debug('Data received from {} at control endpoint'.format(address[0]))
+        AsyncTello.dispatch_response(address[0], data)
+
+    def error_received(self, exc: Exception):
+        AsyncTello.LOGGER.error(exc)
+
+
+class TelloStateProtocol(asyncio.DatagramProtocol):
+    """Receives the state packets of all the drones on the state port.
+    Internal class, you normally wouldn't use this yourself.
+    """
+
+    def datagram_received(self, data: bytes, address: tuple):
+        AsyncTello.LOGGER.debug('Data received from {} at state endpoint'.format(address[0]))
+        AsyncTello.dispatch_state(address[0], data)
+
+    def error_received(self, exc: Exception):
+        AsyncTello.LOGGER.error(exc)
+
+
+@enforce_types
+class AsyncTello:
+    """Asyncio client of the Ryze Tello drone, using the official Tello api.
+    The command responses and the state packets of every drone are received by two datagram endpoints shared by
+    all the AsyncTello objects of the event loop, so a single event loop drives several drones without any thread.
+
+    ```python
+    async with AsyncTello('192.168.10.1') as tello:
+        await tello.connect()
+        await tello.takeoff()
+        async for state in tello.states():
+            tello.send_rc_control(0, 20, 0, 0)
+    ```
+    """
+    # Send and receive commands
+    RESPONSE_TIMEOUT = 7  # in seconds
+    TAKEOFF_TIMEOUT = 20  # in seconds
+    TIME_BTW_COMMANDS = 0.1  # in seconds
+    TIME_BTW_RC_CONTROL_COMMANDS = 0.001  # in seconds
+    RETRY_COUNT = 3  # number of retries after a failed command
+    TELLO_IP = '192.168.10.1'  # Tello IP address
+
+    CONTROL_UDP_PORT = 8889
+    CONTROL_UDP_PORT_CLIENT = CONTROL_UDP_PORT
+    STATE_UDP_PORT = 8890
+
+    LOGGER = logging.getLogger('djitellopy')
+
+    # Conversion functions for state protocol fields
+    INT_STATE_FIELDS = (
+        # Tello EDU with mission pads enabled only
+        'mid', 'x', 'y', 'z',
+        # 'mpry': (custom format 'x,y,z')
+        # Common entries
+        'pitch', 'roll', 'yaw',
+        'vgx', 'vgy', 'vgz',
+        'templ', 'temph',
+        'tof', 'h', 'bat', 'time'
+    )
+    FLOAT_STATE_FIELDS = ('baro', 'agx', 'agy', 'agz')
+
+    state_field_converters: Dict[str, Union[Type[int], Type[float]]]
+    state_field_converters = {key: int for key in INT_STATE_FIELDS}
+    state_field_converters.update({key: float for key in FLOAT_STATE_FIELDS})
+
+    # Endpoints shared by all the drones, and the drones registered to receive their data, by host
+    control_transport: asyncio.DatagramTransport = None
+    state_transport: asyncio.DatagramTransport = None
+    drones: Dict[str, 'AsyncTello'] = {}
+
+    def __init__(self, host=TELLO_IP, retry_count=RETRY_COUNT, control_port_client=None,
+                 state_history_capacity=StateHistory.DEFAULT_CAPACITY):
+        self.host = host
+        self.address = (host, AsyncTello.CONTROL_UDP_PORT)
+        self.retry_count = retry_count
+        self.control_port_client = control_port_client if control_port_client is not None \
+            else AsyncTello.CONTROL_UDP_PORT_CLIENT
+        self.last_received_command_timestamp = time.time()
+        self.last_rc_control_timestamp = time.time()
+
+        # Most recent state packet, replaced (never modified) for each packet received
+        self.state_snapshot: Optional[TelloState] = None
+        self.state_parser = StateParser()
+        self.state_history = StateHistory(state_history_capacity)
+        # The asyncio primitives are created by open(), in the event loop that drives this drone
+        self.responses = None
+        self.command_lock = None
+        self.state_received = None
+        self.state_listeners = []
+        self.state_callbacks = []
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        """Open the shared endpoints if needed, and register this drone to receive its responses and state packets.
+        """
+        self.responses = asyncio.Queue()
+        self.command_lock = asyncio.Lock()
+        self.state_received = asyncio.Event()
+        await AsyncTello.open_endpoints(self.control_port_client)
+        AsyncTello.drones[self.host] = self
+        self.LOGGER.info("AsyncTello instance was initialized. Host: '{}'. Port: '{}'.".format(
+            self.host, AsyncTello.CONTROL_UDP_PORT))
+
+    async def close(self):
+        """Unregister this drone, the shared endpoints are closed with the last drone.
+        """
+        if AsyncTello.drones.get(self.host) is self:
+            del AsyncTello.drones[self.host]
+        if not AsyncTello.drones:
+            AsyncTello.close_endpoints()
+
+    @classmethod
+    async def open_endpoints(cls, control_port_client: int):
+        """Internal method, you normally wouldn't call this yourself.
+        """
+        loop = asyncio.get_running_loop()
+        if cls.control_transport is None:
+            cls.control_transport, _ = await loop.create_datagram_endpoint(
+                TelloResponseProtocol, local_addr=('0.0.0.0', control_port_client))
+        if cls.state_transport is None:
+            cls.state_transport, _ = await loop.create_datagram_endpoint(
+                TelloStateProtocol, local_addr=('0.0.0.0', cls.STATE_UDP_PORT))
+
+    @classmethod
+    def close_endpoints(cls):
+        """Internal method, you normally wouldn't call this yourself.
+        """
+        for transport in (cls.control_transport, cls.state_transport):
+            if transport is not None:
+                transport.close()
+        cls.control_transport = None
+        cls.state_transport = None
+
+    @classmethod
+    def dispatch_response(cls, host: str, data: bytes):
+        """Internal method, you normally wouldn't call this yourself.
+        """
+        drone = cls.drones.get(host)
+        if drone is not None:
+            drone.responses.put_nowait((time.time(), data))
+
+    @classmethod
+    def dispatch_state(cls, host: str, data: bytes):
+        """Internal method, you normally wouldn't call this yourself.
+        """
+        drone = cls.drones.get(host)
+        if drone is None:
+            return
+        try:
+            state = drone.state_parser.parse(data.decode('ASCII'), time.time())
+        except UnicodeDecodeError as e:
+            cls.LOGGER.error(e)
+            return
+        if state is None:
+            return
+        drone.state_snapshot = state
+        drone.state_history.append(state)
+        drone.state_received.set()
+        for callback in drone.state_callbacks:
+            callback(state)
+        for listener in drone.state_listeners:
+            if listener.full():  # Listeners only get the most recent state
+                listener.get_nowait()
+            listener.put_nowait(state)
+
+    @staticmethod
+    def parse_state(state: str) -> Dict[str, Union[int, float, str]]:
+        """Parse a state line to a dictionary
+        Internal method, you normally wouldn't call this yourself.
+        """
+        state = state.strip()
+        AsyncTello.LOGGER.debug('Raw state data: {}'.format(state))
+
+        if state == 'ok':
+            return {}
+
+        state_dict = {}
+        for field in state.split(';'):
+            split = field.split(':')
+            if len(split) < 2:
+                continue
+
+            key = split[0]
+            value: Union[int, float, str] = split[1]
+
+            if key in AsyncTello.state_field_converters:
+                num_type = AsyncTello.state_field_converters[key]
+                try:
+                    value = num_type(value)
+                except ValueError as e:
+                    AsyncTello.LOGGER.debug('Error parsing state value for {}: {} to {}'
+                                            .format(key, value, num_type))
+                    AsyncTello.LOGGER.error(e)
+                    continue
+
+            state_dict[key] = value
+
+        return state_dict
+
+    def get_current_state(self) -> dict:
+        """Get the last state received from the Tello, as a dict with all fields.
+        """
+        state = self.state_snapshot
+        return state.to_dict() if state is not None else {}
+
+    def get_state_snapshot(self) -> Optional[TelloState]:
+        """Get the last state received from the Tello, as a typed TelloState snapshot (None before the first packet).
+        """
+        return self.state_snapshot
+
+    def add_state_callback(self, callback):
+        """Call callback(state) with each TelloState received, from the event loop. The callback must not block.
+        """
+        self.state_callbacks.append(callback)
+
+    def get_state_history(self) -> StateHistory:
+        """Get the ring buffer of the last state packets, for time-indexed queries.
+        """
+        return self.state_history
+
+    async def states(self) -> AsyncIterator[TelloState]:
+        """Iterate over the state packets of the Tello, as they are received.
+        A slow consumer skips the intermediate packets and always gets the most recent one.
+        """
+        listener = asyncio.Queue(maxsize=1)
+        self.state_listeners.append(listener)
+        try:
+            while True:
+                yield await listener.get()
+        finally:
+            self.state_listeners.remove(listener)
+
+    async def send_command_with_return(self, command: str, timeout: int = RESPONSE_TIMEOUT) -> str:
+        """Send command to Tello and wait for its response.
+        Internal method, you normally wouldn't call this yourself.
+        Return:
+            str: response text, or the reason of the failure
+        """
+        async with self.command_lock:
+            # Commands very consecutive makes the drone not respond to them.
+            # So wait at least self.TIME_BTW_COMMANDS seconds, after the response to the previous command
+            remaining = self.TIME_BTW_COMMANDS - (time.time() - self.last_received_command_timestamp)
+            if remaining > 0:
+                self.LOGGER.debug(
+                    'Waiting {} seconds to execute command: {}...'.format(remaining, command))
+                await asyncio.sleep(remaining)
+
+            # Discard the stale responses, i.e. late answers to previous commands that timed out
+            while not self.responses.empty():
+                _, response = self.responses.get_nowait()
+                self.LOGGER.debug('Discarding stale response: {}'.format(response))
+
+            self.LOGGER.info("Send command: '{}'".format(command))
+            timestamp = time.time()
+            self.send_command_without_return(command, log=False)
+
+            while True:
+                remaining_time = timeout - (time.time() - timestamp)
+                try:
+                    received_timestamp, first_response = await asyncio.wait_for(self.responses.get(),
+                                                                                max(remaining_time, 0))
+                except asyncio.TimeoutError:
+                    message = "Aborting command '{}'. Did not receive a response after {} seconds".format(
+                        command, timeout)
+                    self.LOGGER.warning(message)
+                    return message
+                if received_timestamp >= timestamp:
+                    break
+                self.LOGGER.debug('Discarding response received before command: {}'.format(first_response))
+
+            self.last_received_command_timestamp = time.time()
+
+        try:
+            response = first_response.decode("utf-8")
+        except UnicodeDecodeError as e:
+            self.LOGGER.error(e)
+            return "response decode error"
+        response = response.rstrip("\r\n")
+
+        self.LOGGER.info("Response {}: '{}'".format(command, response))
+        return response
+
+    def send_command_without_return(self, command: str, log: bool = True):
+        """Send command to Tello without expecting a response. Never blocks.
+        Internal method, you normally wouldn't call this yourself.
+        """
+        if log:
+            self.LOGGER.info(
+                "Send command (no response expected): '{}'".format(command))
+        if AsyncTello.control_transport is None:
+            raise TelloException('AsyncTello endpoints are closed, call open() first')
+        AsyncTello.control_transport.sendto(command.encode('utf-8'), self.address)
+
+    async def send_control_command(self, command: str, timeout: int = RESPONSE_TIMEOUT) -> bool:
+        """Send control command to Tello and wait for its response.
+        Internal method, you normally wouldn't call this yourself.
+        """
+        response = "max retries exceeded"
+        for i in range(0, self.retry_count):
+            response = await self.send_command_with_return(command, timeout=timeout)
+
+            if 'ok' in response.lower():
+                return True
+
+            self.LOGGER.debug(
+                "Command attempt #{} failed for command: '{}'".format(i, command))
+
+        self.raise_result_error(command, response)
+        return False  # never reached
+
+    async def send_read_command(self, command: str, timeout: int = RESPONSE_TIMEOUT) -> str:
+        """Send given command to Tello and wait for its response.
+        Internal method, you normally wouldn't call this yourself.
+        """
+        response = await self.send_command_with_return(command, timeout=timeout)
+
+        if any(word in response for word in ('error', 'ERROR', 'False')):
+            self.raise_result_error(command, response)
+            return "Error: this code should never be reached"
+
+        return response
+
+    def raise_result_error(self, command: str, response: str):
+        """Used to reaise an error after an unsuccessful command
+        Internal method, you normally wouldn't call this yourself.
+        """
+        tries = 1 + self.retry_count
+        raise TelloException("Command '{}' was unsuccessful for {} tries. Latest response:\t'{}'"
+                             .format(command, tries, response))
+
+    async def connect(self, wait_for_state=True):
+        """Enter SDK mode. Call this before any of the control functions.
+        """
+        await self.send_control_command("command")
+
+        if wait_for_state:
+            timestamp = time.time()
+            try:
+                await asyncio.wait_for(self.state_received.wait(), 1)
+                self.LOGGER.debug("'.connect()' received first state packet after {} seconds"
+                                  .format(time.time() - timestamp))
+            except asyncio.TimeoutError:
+                raise TelloException('Did not receive a state packet from the Tello')
+
+    async def takeoff(self):
+        """Automatic takeoff.
+        """
+        await self.send_control_command("takeoff", timeout=AsyncTello.TAKEOFF_TIMEOUT)
+
+    async def land(self):
+        """Automatic landing.
+        """
+        await self.send_control_command("land")
+
+    async def streamon(self):
+        """Turn on video streaming.
+        """
+        await self.send_control_command("streamon")
+
+    async def streamoff(self):
+        """Turn off video streaming.
+        """
+        await self.send_control_command("streamoff")
+
+    async def emergency(self):
+        """Stop all motors immediately.
+        """
+        await self.send_control_command("emergency")
+
+    def send_rc_control(self, left_right_velocity: int, forward_backward_velocity: int, up_down_velocity: int,
+                        yaw_velocity: int):
+        """Send RC control via four channels, without waiting. Command is sent every
+        self.TIME_BTW_RC_CONTROL_COMMANDS seconds.
+        Arguments:
+            left_right_velocity: -100~100 (left/right)
+            forward_backward_velocity: -100~100 (forward/backward)
+            up_down_velocity: -100~100 (up/down)
+            yaw_velocity: -100~100 (yaw)
+        """
+        def clamp100(x: int) -> int:
+            return max(-100, min(100, x))
+
+        if time.time() - self.last_rc_control_timestamp > self.TIME_BTW_RC_CONTROL_COMMANDS:
+            self.last_rc_control_timestamp = time.time()
+            cmd = 'rc {} {} {} {}'.format(
+                clamp100(left_right_velocity),
+                clamp100(forward_backward_velocity),
+                clamp100(up_down_velocity),
+                clamp100(yaw_velocity)
+            )
+            self.send_command_without_return(cmd)
@@ -0,0 +1,389 @@
+"""Local emulator of DJI Ryze Tello drones, for testing without a drone or a simulator.
+"""
+
+# coding=utf-8
+import argparse
+import asyncio
+import logging
+import math
+import random
+import time
+from threading import Thread, Event
+from typing import Optional
+
+import av
+import numpy as np
+
+
+class TelloEmulatorProtocol(asyncio.DatagramProtocol):
+    """Receives the commands sent to an emulated drone on its control port.
+    Internal class, you normally wouldn't use this yourself.
+    """
+
+    def __init__(self, emulator: 'TelloEmulator'):
+        self.emulator = emulator
+
+    def datagram_received(self, data: bytes, address: tuple):
+        self.emulator.receive_command(data, address)
+
+    def error_received(self, exc: Exception):
+        TelloEmulator.LOGGER.error(exc)
+
+
+class TelloEmulator:
+    """Pure-Python stand-in of a Tello drone listening on a local address. It answers the SDK text protocol
+    on the control port, sends state packets at a configurable rate on the state port of the client, and streams
+    a synthetic or prerecorded H.264 video on its video port after 'streamon'.
+    Latency, jitter and packet loss can be injected on everything it sends, to test the client under controlled
+    network conditions. The video datagrams of a frame share the same delay, so that jitter never reorders frames.
+    The flight is roughly emulated from the commands : attitude and speeds follow the rc commands, the height
+    follows takeoff, land and the vertical rc command, and the battery slowly discharges.
+
+    Since the emulator uses the control port (8889) on its host, the client must use another local port,
+    like with the simulator. Several emulators can run at once on different loopback addresses (127.0.0.2, ...)
+    to test a TelloSwarm.
+
+    ```python
+    emulator = TelloEmulator('127.0.0.1', state_rate=20, latency=0.02, jitter=0.005, loss=0.01)
+    emulator.start()
+    Tello.CONTROL_UDP_PORT_CLIENT = 9000
+    tello = Tello('127.0.0.1')
+    tello.connect()
+    ...
+    emulator.stop()
+    ```
+    """
+    CONTROL_UDP_PORT = 8889
+    STATE_UDP_PORT = 8890
+    VS_UDP_PORT = 11111
+    VIDEO_DATAGRAM_SIZE = 1460  # Size of the video datagrams sent by the Tello
+
+    TAKEOFF_HEIGHT = 80  # in cm
+    MAX_SPEED = 100  # Horizontal and vertical speeds for a 100 rc command, in cm/s
+    MAX_YAW_RATE = 100  # Yaw rate for a 100 rc command, in deg/s
+    MAX_TILT = 25  # Pitch and roll for a 100 rc command, in degrees
+    BATTERY_DRAIN = 1 / 6  # Battery percents lost per second of flight
+
+    LOGGER = logging.getLogger('djitellopy')
+
+    def __init__(self, host='127.0.0.1', state_rate=10.0, video_fps=30, frame_size=(960, 720),
+                 video_file=None, frame_generator=None,
+                 latency=0.0, jitter=0.0, loss=0.0, seed=None):
+        """
+        Arguments:
+            host: local address the emulated drone listens on
+            state_rate: number of state packets sent per second
+            video_fps: frame rate of the video stream
+            frame_size: (width, height) of the synthetic video
+            video_file: raw H.264 (Annex B) file streamed in a loop instead of the synthetic video, e.g. the
+                video.h264 of a recorded flight
+            frame_generator: function(frame index) returning a (height, width, 3) RGB uint8 frame of the synthetic
+                video, a moving test pattern by default
+            latency: mean delay added to every packet sent, in seconds
+            jitter: maximum deviation from this delay, in seconds
+            loss: probability of dropping each packet sent
+            seed: seed of the random generator of the jitter and losses, for reproducible runs
+        """
+        self.host = host
+        self.state_rate = state_rate
+        self.video_fps = video_fps
+        self.frame_size = frame_size
+        self.video_file = video_file
+        self.frame_generator = frame_generator if frame_generator is not None else self.test_pattern
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.random = random.Random(seed)
+
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread: Optional[Thread] = None
+        self.control_transport: Optional[asyncio.DatagramTransport] = None
+        self.state_task: Optional[asyncio.Task] = None
+        self.video_thread: Optional[Thread] = None
+        self.video_stop = Event()
+        self.video_due_time = 0.0
+        self.client_host: Optional[str] = None
+
+        # Emulated flight
+        self.flying = False
+        self.rc = (0, 0, 0, 0)
+        self.height = 0.0
+        self.yaw = 0.0
+        self.battery = 100.0
+        self.flight_time = 0.0
+
+        # Counters
+        self.commands_received = 0
+        self.packets_sent = 0
+        self.packets_dropped = 0
+        self.frames_sent = 0
+
+    def start(self):
+        """Start the emulator in its own event loop thread.
+        """
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+        asyncio.run_coroutine_threadsafe(self.open(), self.loop).result()
+        self.LOGGER.info("Tello emulator listening on '{}:{}'".format(self.host, self.CONTROL_UDP_PORT))
+
+    async def open(self):
+        """Internal method, you normally wouldn't call this yourself.
+        """
+        self.control_transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: TelloEmulatorProtocol(self), local_addr=(self.host, self.CONTROL_UDP_PORT))
+        self.state_task = self.loop.create_task(self.send_states())
+
+    def stop(self):
+        """Stop the video stream, the state packets and the event loop thread.
+        """
+        self.stop_video()
+        if self.loop is None:
+            return
+
+        async def close():
+            self.state_task.cancel()
+            self.control_transport.close()
+
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        self.loop = None
+
+    def send(self, data: bytes, address: tuple, delay: Optional[float] = None):
+        """Send a datagram under the emulated network conditions. Must be called from the event loop.
+        Internal method, you normally wouldn't call this yourself.
+        """
+        if self.loss > 0 and self.random.random() < self.loss:
+            self.packets_dropped += 1
+            return
+        if delay is None:
+            delay = self.network_delay()
+        self.packets_sent += 1
+        if delay > 0:
+            self.loop.call_later(delay, self.control_transport.sendto, data, address)
+        else:
+            self.control_transport.sendto(data, address)
+
+    def network_delay(self) -> float:
+        """Internal method, you normally wouldn't call this yourself.
+        """
+        return max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0.0)
+
+    def receive_command(self, data: bytes, address: tuple):
+        """Internal method, you normally wouldn't call this yourself.
+        """
+        self.commands_received += 1
+        command = data.decode('utf-8', errors='replace').strip()
+        response = self.execute(command, address)
+        if response is not None:
+            self.send(response.encode('utf-8'), address)
+
+    def execute(self, command: str, address: tuple) -> Optional[str]:
+        """Apply a command to the emulated drone. Returns its response, None for the commands without response.
+        Internal method, you normally wouldn't call this yourself.
+        """
+        name, *args = command.split(' ')
+        if name == 'command':
+            self.client_host = address[0]
+            return 'ok'
+        if self.client_host is None:
+            return None  # Not in SDK mode yet
+        if name == 'rc':
+            try:
+                self.rc = tuple(max(-100, min(100, int(arg))) for arg in args[:4])
+            except ValueError:
+                pass
+            return None
+        if name.endswith('?'):
+            return self.read(name)
+        if name == 'takeoff':
+            self.flying = True
+            self.height = self.TAKEOFF_HEIGHT
+        elif name in ('land', 'emergency'):
+            self.flying = False
+            self.height = 0.0
+            self.rc = (0, 0, 0, 0)
+        elif name == 'streamon':
+            self.start_video()
+        elif name == 'streamoff':
+            self.stop_video()
+        return 'ok'
+
+    def read(self, name: str) -> str:
+        """Internal method, you normally wouldn't call this yourself.
+        """
+        pitch, roll, _ = self.attitude()
+        responses = {'battery?': str(int(self.battery)),
+                     'speed?': '10.0',
+                     'time?': '{}s'.format(int(self.flight_time)),
+                     'height?': '{}dm'.format(int(self.height / 10)),
+                     'temp?': '60~62C',
+                     'attitude?': 'pitch:{};roll:{};yaw:{};'.format(pitch, roll, self.wrapped_yaw()),
+                     'baro?': '{:.2f}'.format(self.height / 100),
+                     'tof?': '{}mm'.format(int(self.height * 10) + 100),
+                     'wifi?': '90',
+                     'sdk?': '30',
+                     'sn?': '0TQZGEMULATOR'}
+        return responses.get(name, 'error')
+
+    def attitude(self) -> tuple:
+        """Internal method, you normally wouldn't call this yourself.
+        """
+        if not self.flying:
+            return 0, 0, int(self.yaw)
+        return int(self.rc[1] * self.MAX_TILT / 100), int(self.rc[0] * self.MAX_TILT / 100), int(self.yaw)
+
+    def wrapped_yaw(self) -> int:
+        """Internal method, you normally wouldn't call this yourself.
+        """
+        return int((self.yaw + 180) % 360 - 180)
+
+    def update_flight(self, dt: float):
+        """Integrate the emulated flight over dt seconds.
+        Internal method, you normally wouldn't call this yourself.
+        """
+        if not self.flying:
+            return
+        self.yaw += self.rc[3] * self.MAX_YAW_RATE / 100 * dt
+        self.height = max(self.height + self.rc[2] * self.MAX_SPEED / 100 * dt, 10.0)
+        self.battery = max(self.battery - self.BATTERY_DRAIN * dt, 0.0)
+        self.flight_time += dt
+
+    def state_packet(self) -> bytes:
+        """Internal method, you normally wouldn't call this yourself.
+        """
+        pitch, roll, _ = self.attitude()
+        yaw = math.radians(self.yaw)
+        vx, vy = self.rc[1] * self.MAX_SPEED / 100, self.rc[0] * self.MAX_SPEED / 100
+        vgx = vx * math.cos(yaw) - vy * math.sin(yaw) if self.flying else 0.0
+        vgy = vx * math.sin(yaw) + vy * math.cos(yaw) if self.flying else 0.0
+        vgz = -self.rc[2] * self.MAX_SPEED / 100 if self.flying else 0.0
+        return ('mid:-1;x:0;y:0;z:0;mpry:0,0,0;pitch:{};roll:{};yaw:{};vgx:{};vgy:{};vgz:{};templ:60;temph:62;'
+                'tof:{};h:{};bat:{};baro:{:.2f};time:{};agx:{:.2f};agy:{:.2f};agz:{:.2f};\r\n').format(
+            pitch, roll, self.wrapped_yaw(), int(vgx / 10), int(vgy / 10), int(vgz / 10),
+            int(self.height) + 10, int(self.height), int(self.battery), self.height / 100, int(self.flight_time),
+            -pitch * 10.0, roll * 10.0, -1000.0).encode('ASCII')
+
+    async def send_states(self):
+        """Send the state packets at state_rate, once a client sent the 'command' command.
+        Internal method, you normally wouldn't call this yourself.
+        """
+        period = 1 / self.state_rate
+        next_time = self.loop.time()
+        while True:
+            next_time += period
+            await asyncio.sleep(max(next_time - self.loop.time(), 0))
+            self.update_flight(period)
+            if self.client_host is not None:
+                self.send(self.state_packet(), (self.client_host, self.STATE_UDP_PORT))
+
+    def start_video(self):
+        """Internal method, you normally wouldn't call this yourself.
+        """
+        if self.video_thread is not None and self.video_thread.is_alive():
+            return
+        self.video_stop.clear()
+        self.video_thread = Thread(target=self.stream_video, daemon=True)
+        self.video_thread.start()
+
+    def stop_video(self):
+        """Internal method, you normally wouldn't call this yourself.
+        """
+        self.video_stop.set()
+        if self.video_thread is not None and self.video_thread.is_alive():
+            self.video_thread.join()
+        self.video_thread = None
+
+    def test_pattern(self, index: int) -> np.ndarray:
+        """Frame of the default synthetic video : a gradient crossed by a moving vertical bar.
+        Internal method, you normally wouldn't call this yourself.
+        """
+        width, height = self.frame_size
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[:, :, 0] = np.linspace(0, 255, width, dtype=np.uint8)
+        frame[:, :, 1] = np.linspace(0, 255, height, dtype=np.uint8)[:, np.newaxis]
+        frame[:, :, 2] = (index * 4) % 256
+        bar = (index * 8) % width
+        frame[:, bar:bar + 16] = 255
+        return frame
+
+    def encoded_packets(self):
+        """Generate the H.264 packets of the video, one or a few per frame, until the video is stopped.
+        Internal method, you normally wouldn't call this yourself.
+        """
+        if self.video_file is not None:
+            with open(self.video_file, 'rb') as file:
+                data = file.read()
+            parser = av.CodecContext.create('h264', 'r')
+            packets = [bytes(packet) for packet in parser.parse(data)]
+            if not packets:
+                raise ValueError('No H.264 packet in {}'.format(self.video_file))
+            while True:
+                yield from packets
+
+        width, height = self.frame_size
+        encoder = av.CodecContext.create('libx264', 'w')
+        encoder.width, encoder.height = width, height
+        encoder.pix_fmt = 'yuv420p'
+        encoder.framerate = self.video_fps
+        encoder.gop_size = self.video_fps
+        encoder.options = {'preset': 'ultrafast', 'tune': 'zerolatency'}
+        index = 0
+        while True:
+            frame = av.VideoFrame.from_ndarray(self.frame_generator(index), format='rgb24')
+            yield b''.join(bytes(packet) for packet in encoder.encode(frame))
+            index += 1
+
+    def stream_video(self):
+        """Video thread : encode or read the frames at video_fps and hand them over to the event loop.
+        Internal method, you normally wouldn't call this yourself.
+        """
+        period = 1 / self.video_fps
+        next_time = time.perf_counter()
+        for packet in self.encoded_packets():
+            if self.video_stop.is_set() or self.loop is None:
+                break
+            if packet:
+                self.loop.call_soon_threadsafe(self.send_video_packet, packet)
+            next_time += period
+            if self.video_stop.wait(max(next_time - time.perf_counter(), 0)):
+                break
+
+    def send_video_packet(self, packet: bytes):
+        """Split a video packet in datagrams sharing the same delay, never sent before the previous packet.
+        Internal method, you normally wouldn't call this yourself.
+        """
+        if self.client_host is None:
+            return
+        now = self.loop.time()
+        self.video_due_time = max(now + self.network_delay(), self.video_due_time)
+        delay = self.video_due_time - now
+        address = (self.client_host, self.VS_UDP_PORT)
+        for start in range(0, len(packet), self.VIDEO_DATAGRAM_SIZE):
+            self.send(packet[start:start + self.VIDEO_DATAGRAM_SIZE], address, delay)
+        self.frames_sent += 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Emulate a Tello drone on a local address')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--state-rate', type=float, default=10.0)
+    parser.add_argument('--video-fps', type=int, default=30)
+    parser.add_argument('--video-file', default=None)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=None)
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    emulator = TelloEmulator(options.host, state_rate=options.state_rate, video_fps=options.video_fps,
+                             video_file=options.video_file, latency=options.latency, jitter=options.jitter,
+                             loss=options.loss, seed=options.seed)
+    emulator.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        emulator.stop()
@@ -0,0 +1,233 @@
+"""Typed state packets of DJI Ryze Tello drones.
+"""
+
+import logging
+import re
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+LOGGER = logging.getLogger('djitellopy')
+
+
+class TelloState:
+    """Snapshot of one state packet, with one typed attribute per state field.
+    The snapshots are never modified once published, so a reader always gets consistent fields.
+    Fields missing from the packet (e.g. mission pad fields on a non-EDU Tello) keep their default value,
+    `fields` lists the ones actually received.
+    Attributes:
+        seq: sequence number of the packet, increasing for each packet received from the drone
+        timestamp: reception time of the packet (time.time())
+    """
+    INT_FIELDS = ('mid', 'x', 'y', 'z',
+                  'pitch', 'roll', 'yaw',
+                  'vgx', 'vgy', 'vgz',
+                  'templ', 'temph',
+                  'tof', 'h', 'bat', 'time')
+    FLOAT_FIELDS = ('baro', 'agx', 'agy', 'agz')
+    STR_FIELDS = ('mpry',)
+    FIELDS = INT_FIELDS + FLOAT_FIELDS + STR_FIELDS
+    CONVERTERS = dict([(key, int) for key in INT_FIELDS] +
+                      [(key, float) for key in FLOAT_FIELDS] +
+                      [(key, str) for key in STR_FIELDS])
+    DEFAULTS = dict([(key, 0) for key in INT_FIELDS] +
+                    [(key, 0.0) for key in FLOAT_FIELDS] +
+                    [(key, '') for key in STR_FIELDS])
+
+    __slots__ = FIELDS + ('seq', 'timestamp', 'fields')
+
+    def __init__(self, seq: int = 0, timestamp: float = 0.0, fields: Tuple[str, ...] = ()):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.fields = fields
+
+    def __getattr__(self, key: str):
+        # Only called for the fields that were not received
+        try:
+            return TelloState.DEFAULTS[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def to_dict(self) -> dict:
+        """Returns the received fields as a dict, in the format of Tello.parse_state"""
+        return {key: getattr(self, key) for key in self.fields}
+
+    def __repr__(self):
+        return 'TelloState(seq={}, timestamp={:.3f}, {})'.format(self.seq, self.timestamp, self.to_dict())
+
+
+class StateParser:
+    """Parses the state packets of one drone into TelloState snapshots.
+    A drone always sends the same fields in the same order, so the parser compiles a regular expression matching this
+    layout from the first packet, then fills the snapshots straight from the match groups : no split of each field and
+    no intermediate dict. The layout is compiled again if a packet does not match it.
+    """
+
+    def __init__(self):
+        self.seq = 0
+        self.pattern = None
+        self.fields: Tuple[str, ...] = ()
+        self.converters: tuple = ()
+
+    def compile(self, state: str) -> bool:
+        """Compile the layout of a state line. Returns False if the line contains no known field.
+        Internal method, you normally wouldn't call this yourself.
+        """
+        keys = [field.split(':')[0] for field in state.strip().split(';') if ':' in field]
+        if not keys:
+            return False
+        # Only the known fields are captured, so that the match groups line up with self.fields
+        pattern = ''.join(('{}:([^;]*);' if key in TelloState.CONVERTERS else '{}:[^;]*;').format(re.escape(key))
+                          for key in keys)
+        self.pattern = re.compile(pattern + r'\s*')
+        self.fields = tuple(key for key in keys if key in TelloState.CONVERTERS)
+        self.converters = tuple(TelloState.CONVERTERS[key] for key in self.fields)
+        return True
+
+    def parse(self, state: str, timestamp: float) -> Optional[TelloState]:
+        """Parse a state line. Returns None if the line is not a state packet (e.g. 'ok') or cannot be parsed.
+        """
+        match = self.pattern.fullmatch(state) if self.pattern is not None else None
+        if match is None:
+            if not self.compile(state):
+                return None
+            match = self.pattern.fullmatch(state)
+            if match is None:
+                return None
+
+        snapshot = TelloState(self.seq + 1, timestamp, self.fields)
+        try:
+            for key, converter, value in zip(self.fields, self.converters, match.groups()):
+                setattr(snapshot, key, converter(value))
+        except ValueError as e:
+            LOGGER.debug('Error parsing state line: {}'.format(state))
+            LOGGER.error(e)
+            return None
+        self.seq += 1
+        return snapshot
+
+
+class StateHistory:
+    """Fixed-capacity ring buffer of the numeric fields of the state packets of one drone, stored in numpy arrays.
+    The buffer never grows : once full, each new packet overwrites the oldest one.
+    It is written by a single thread (the state receiver) and can be read from any thread : the readers never use
+    the oldest slot, which is the next one to be overwritten, and always get copies.
+    The time searches run in place on the two sorted parts of the ring (from the oldest packet to the end of the
+    arrays, then from the start of the arrays), and only the rows of the result are gathered.
+    The angle fields (pitch, roll, yaw in degrees) are unwrapped before being interpolated or differentiated.
+    """
+    FIELDS = TelloState.INT_FIELDS + TelloState.FLOAT_FIELDS
+    FIELD_INDEX = {key: i for i, key in enumerate(FIELDS)}
+    ANGLE_FIELDS = ('pitch', 'roll', 'yaw')
+    DEFAULT_CAPACITY = 1024  # About 100 s of history at 10 Hz
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        if capacity < 2:
+            raise ValueError('StateHistory capacity must be at least 2')
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.seqs = np.zeros(capacity, dtype=np.int64)
+        self.values = np.zeros((capacity, len(self.FIELDS)), dtype=np.float64)
+        self.count = 0  # Number of packets appended since the creation of the buffer
+
+    def __len__(self) -> int:
+        return min(self.count, self.capacity - 1)
+
+    def append(self, state: TelloState):
+        i = self.count % self.capacity
+        self.timestamps[i] = state.timestamp
+        self.seqs[i] = state.seq
+        self.values[i] = [getattr(state, key) for key in self.FIELDS]
+        self.count += 1  # Published once the row is complete
+
+    def field_indexes(self, fields: Optional[Tuple[str, ...]]) -> list:
+        """Internal method, you normally wouldn't call this yourself.
+        """
+        if fields is None:
+            return list(range(len(self.FIELDS)))
+        return [self.FIELD_INDEX[key] for key in fields]
+
+    def last(self, n: int, fields: Optional[Tuple[str, ...]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the timestamps (n,) and values (n, len(fields)) of the last n packets, from the oldest to the
+        most recent one. Fewer rows are returned if fewer packets are available.
+        """
+        count = self.count
+        n = max(min(n, count, self.capacity - 1), 0)
+        return self.rows(count, n, 0, n, fields)
+
+    def rows(self, count: int, n: int, start: int, stop: int,
+             fields: Optional[Tuple[str, ...]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns copies of the timestamps and values of the packets start to stop - 1 of the last n packets, when
+        `count` packets were appended.
+        Internal method, you normally wouldn't call this yourself.
+        """
+        rows = np.arange(count - n + start, count - n + stop) % self.capacity
+        return self.timestamps[rows], self.values[np.ix_(rows, self.field_indexes(fields))]
+
+    def search(self, count: int, n: int, timestamp: float, side: str = 'left') -> int:
+        """Returns the index where timestamp would be inserted in the timestamps of the last n packets (as
+        np.searchsorted), when `count` packets were appended. No copy of the timestamps is made.
+        Internal method, you normally wouldn't call this yourself.
+        """
+        start = (count - n) % self.capacity
+        end = start + n
+        index = int(np.searchsorted(self.timestamps[start:min(end, self.capacity)], timestamp, side=side))
+        if end > self.capacity and index == self.capacity - start:  # Goes on in the wrapped part
+            index += int(np.searchsorted(self.timestamps[:end - self.capacity], timestamp, side=side))
+        return index
+
+    def since(self, duration: float, fields: Optional[Tuple[str, ...]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the timestamps and values of the packets received during the last `duration` seconds"""
+        count = self.count
+        n = min(count, self.capacity - 1)
+        first = self.search(count, n, self.timestamps[(count - 1) % self.capacity] - duration) if n else 0
+        return self.rows(count, n, first, n, fields)
+
+    def unwrap_angles(self, values: np.ndarray, fields: Optional[Tuple[str, ...]]) -> np.ndarray:
+        """Internal method, you normally wouldn't call this yourself.
+        """
+        columns = [column for column, key in enumerate(fields if fields is not None else self.FIELDS)
+                   if key in self.ANGLE_FIELDS]
+        if columns and len(values) > 1:
+            values[:, columns] = np.degrees(np.unwrap(np.radians(values[:, columns]), axis=0))
+        return values
+
+    def at(self, timestamp: float, fields: Optional[Tuple[str, ...]] = None) -> Optional[np.ndarray]:
+        """Returns the values of the fields at the given time (time.time() reference), linearly interpolated between
+        the two surrounding packets, or those of the first/last packet when the time is out of the history.
+        Returns None when the history is empty.
+        """
+        count = self.count
+        n = min(count, self.capacity - 1)
+        if n == 0:
+            return None
+        i = self.search(count, n, timestamp)
+        if i == 0:
+            return self.rows(count, n, 0, 1, fields)[1][0]
+        if i == n:
+            return self.rows(count, n, n - 1, n, fields)[1][0]
+        timestamps, values = self.rows(count, n, i - 1, i + 1, fields)
+        values = self.unwrap_angles(values, fields)
+        weight = (timestamp - timestamps[0]) / max(timestamps[1] - timestamps[0], 1e-9)
+        result = values[0] + weight * (values[1] - values[0])
+        for column, key in enumerate(fields if fields is not None else self.FIELDS):
+            if key in self.ANGLE_FIELDS:  # Back to [-180, 180[
+                result[column] = (result[column] + 180) % 360 - 180
+        return result
+
+    def rolling_stats(self, duration: float, fields: Optional[Tuple[str, ...]] = None) -> Dict[str, np.ndarray]:
+        """Returns the mean, standard deviation, min, max and rate of change (least squares slope, per second)
+        of the fields over the last `duration` seconds, as arrays of len(fields) values.
+        """
+        timestamps, values = self.since(duration, fields)
+        n_fields = values.shape[1]
+        if len(timestamps) == 0:
+            zeros = np.zeros(n_fields)
+            return {'mean': zeros, 'std': zeros, 'min': zeros, 'max': zeros, 'rate': zeros}
+        values = self.unwrap_angles(values, fields)
+        rate = np.zeros(n_fields)
+        if len(timestamps) > 1:
+            dt = timestamps - timestamps.mean()
+            rate = dt @ (values - values.mean(axis=0)) / max(dt @ dt, 1e-9)
+        return {'mean': values.mean(axis=0), 'std': values.std(axis=0),
+                'min': values.min(axis=0), 'max': values.max(axis=0), 'rate': rate}
@@ -2,25 +2,55 @@
 """
 
 # coding=utf-8
+import asyncio
 import logging
-import socket
 import time
-from threading import Thread
+from threading import Thread, Lock
 from typing import Optional, Union, Type, Dict
 
+from .async_tello import AsyncTello, TelloException
 from .enforce_types import enforce_types
+from .state import TelloState, StateHistory
 
 import av
 import numpy as np
 
 
-threads_initialized = False
 drones: Optional[dict] = {}
-client_socket: socket.socket
 
 
-class TelloException(Exception):
-    pass
+class EventLoopThread:
+    """Runs the asyncio event loop that drives the AsyncTello objects of all the synchronous Tello objects,
+    in a single daemon thread started with the first Tello.
+    Warning : the blocking methods must not be called from the event loop thread itself.
+    Internal class, you normally wouldn't use this yourself.
+    """
+    loop: Optional[asyncio.AbstractEventLoop] = None
+    thread: Optional[Thread] = None
+    lock = Lock()
+
+    @classmethod
+    def get_loop(cls) -> asyncio.AbstractEventLoop:
+        with cls.lock:
+            if cls.loop is None:
+                cls.loop = asyncio.new_event_loop()
+                cls.thread = Thread(target=cls.loop.run_forever, daemon=True)
+                cls.thread.start()
+        return cls.loop
+
+    @classmethod
+    def run(cls, coroutine):
+        """Run a coroutine in the event loop thread and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coroutine, cls.get_loop()).result()
+
+    @classmethod
+    def is_running(cls) -> bool:
+        return cls.loop is not None and cls.loop.is_running()
+
+    @classmethod
+    def call_soon(cls, callback, *args):
+        """Schedule a non-blocking call in the event loop thread, without waiting for it"""
+        cls.get_loop().call_soon_threadsafe(callback, *args)
 
 
 @enforce_types
@@ -35,7 +65,6 @@ class Tello:
     TAKEOFF_TIMEOUT = 20  # in seconds
     FRAME_GRAB_TIMEOUT = 5
     TIME_BTW_COMMANDS = 0.1  # in seconds
-    TIME_BTW_RC_CONTROL_COMMANDS = 0.001  # in seconds
     RETRY_COUNT = 3  # number of retries after a failed command
     TELLO_IP = '192.168.10.1'  # Tello IP address
 
@@ -75,21 +104,11 @@ class Tello:
     # to only receive logs of the desired level and higher
 
     # Conversion functions for state protocol fields
-    INT_STATE_FIELDS = (
-        # Tello EDU with mission pads enabled only
-        'mid', 'x', 'y', 'z',
-        # 'mpry': (custom format 'x,y,z')
-        # Common entries
-        'pitch', 'roll', 'yaw',
-        'vgx', 'vgy', 'vgz',
-        'templ', 'temph',
-        'tof', 'h', 'bat', 'time'
-    )
-    FLOAT_STATE_FIELDS = ('baro', 'agx', 'agy', 'agz')
+    INT_STATE_FIELDS = AsyncTello.INT_STATE_FIELDS
+    FLOAT_STATE_FIELDS = AsyncTello.FLOAT_STATE_FIELDS
 
     state_field_converters: Dict[str, Union[Type[int], Type[float]]]
-    state_field_converters = {key: int for key in INT_STATE_FIELDS}
-    state_field_converters.update({key: float for key in FLOAT_STATE_FIELDS})
+    state_field_converters = AsyncTello.state_field_converters
 
     # VideoCapture object
     background_frame_read: Optional['BackgroundFrameRead'] = None
@@ -102,39 +121,27 @@ class Tello:
                  retry_count=RETRY_COUNT,
                  image_received_method=None):
 
-        global threads_initialized, client_socket, drones
+        global drones
 
         self.address = (host, Tello.CONTROL_UDP_PORT)
         self.stream_on = False
         self.retry_count = retry_count
         self.last_received_command_timestamp = time.time()
-        self.last_rc_control_timestamp = time.time()
         self.update_frame_method = image_received_method
 
-        if not threads_initialized:
-            # Run Tello command responses UDP receiver on background
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            client_socket.bind(('', Tello.CONTROL_UDP_PORT_CLIENT))
-            response_receiver_thread = Thread(
-                target=Tello.udp_response_receiver)
-            response_receiver_thread.daemon = True
-            response_receiver_thread.start()
-
-            # Run state UDP receiver on background
-            state_receiver_thread = Thread(target=Tello.udp_state_receiver)
-            state_receiver_thread.daemon = True
-            state_receiver_thread.start()
+        # The command responses and state packets are received by the AsyncTello endpoints,
+        # in the event loop thread shared by all the Tello objects
+        self.async_tello = AsyncTello(host, retry_count, control_port_client=Tello.CONTROL_UDP_PORT_CLIENT)
+        EventLoopThread.run(self.async_tello.open())
 
-            threads_initialized = True
-
-        drones[host] = {'responses': [], 'state': {}}
+        drones[host] = self.async_tello
 
         self.LOGGER.info("Tello instance was initialized. Host: '{}'. Port: '{}'.".format(
             host, Tello.CONTROL_UDP_PORT))
 
-    def get_own_udp_object(self):
+    def get_own_udp_object(self) -> AsyncTello:
         """Get own object from the global drones dict. This object is filled
-        with responses and state information by the receiver threads.
+        with responses and state information by the event loop thread.
         Internal method, you normally wouldn't call this yourself.
         """
         global drones
@@ -142,106 +149,47 @@ class Tello:
         host = self.address[0]
         return drones[host]
 
-    @staticmethod
-    def udp_response_receiver():
-        """Setup drone UDP receiver. This method listens for responses of Tello.
-        Must be run from a background thread in order to not block the main thread.
-        Internal method, you normally wouldn't call this yourself.
-        """
-        while True:
-            try:
-                data, address = client_socket.recvfrom(1024)
-
-                address = address[0]
-                Tello.LOGGER.debug(
-                    'Data received from {} at client_socket'.format(address))
-
-                if address not in drones:
-                    continue
-
-                drones[address]['responses'].append(data)
-
-            except Exception as e:
-                Tello.LOGGER.error(e)
-                break
-
-    @staticmethod
-    def udp_state_receiver():
-        """Setup state UDP receiver. This method listens for state information from
-        Tello. Must be run from a background thread in order to not block
-        the main thread.
-        Internal method, you normally wouldn't call this yourself.
-        """
-        state_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        state_socket.bind(("", Tello.STATE_UDP_PORT))
-
-        while True:
-            try:
-                data, address = state_socket.recvfrom(1024)
-
-                address = address[0]
-                Tello.LOGGER.debug(
-                    'Data received from {} at state_socket'.format(address))
-
-                if address not in drones:
-                    continue
-
-                data = data.decode('ASCII')
-                drones[address]['state'] = Tello.parse_state(data)
-
-            except Exception as e:
-                Tello.LOGGER.error(e)
-                break
-
     @staticmethod
     def parse_state(state: str) -> Dict[str, Union[int, float, str]]:
         """Parse a state line to a dictionary
         Internal method, you normally wouldn't call this yourself.
         """
-        state = state.strip()
-        Tello.LOGGER.debug('Raw state data: {}'.format(state))
-
-        if state == 'ok':
-            return {}
-
-        state_dict = {}
-        for field in state.split(';'):
-            split = field.split(':')
-            if len(split) < 2:
-                continue
-
-            key = split[0]
-            value: Union[int, float, str] = split[1]
-
-            if key in Tello.state_field_converters:
-                num_type = Tello.state_field_converters[key]
-                try:
-                    value = num_type(value)
-                except ValueError as e:
-                    Tello.LOGGER.debug('Error parsing state value for {}: {} to {}'
-                                       .format(key, value, num_type))
-                    Tello.LOGGER.error(e)
-                    continue
-
-            state_dict[key] = value
-
-        return state_dict
+        return AsyncTello.parse_state(state)
 
     def get_current_state(self) -> dict:
         """Call this function to attain the state of the Tello. Returns a dict
         with all fields.
         Internal method, you normally wouldn't call this yourself.
         """
-        return self.get_own_udp_object()['state']
+        return self.async_tello.get_current_state()
+
+    def get_state_snapshot(self) -> Optional[TelloState]:
+        """Get the last state packet as a typed TelloState snapshot, with one attribute per field plus its sequence
+        number and reception time. The snapshot is never modified, so its fields are always consistent.
+        Returns None before the first state packet.
+        """
+        return self.async_tello.get_state_snapshot()
+
+    def add_state_callback(self, callback):
+        """Call callback(state) with each TelloState received. The callback is run by the event loop thread
+        that receives the packets of all the drones, so it must return quickly.
+        """
+        self.async_tello.add_state_callback(callback)
+
+    def get_state_history(self) -> StateHistory:
+        """Get the ring buffer of the last state packets, for time-indexed queries :
+        state at a given time, last N packets, rolling statistics.
+        """
+        return self.async_tello.get_state_history()
 
     def get_state_field(self, key: str):
         """Get a specific sate field by name.
         Internal method, you normally wouldn't call this yourself.
         """
-        state = self.get_current_state()
+        state = self.get_state_snapshot()
 
-        if key in state:
-            return state[key]
+        if state is not None and key in state.fields:
+            return getattr(state, key)
         else:
             raise TelloException(
                 'Could not get state property: {}'.format(key))
@@ -409,15 +357,27 @@ class Tello:
             ip=self.VS_UDP_IP, port=self.VS_UDP_PORT)
         return address
 
-    def get_frame_read(self) -> 'BackgroundFrameRead':
+    def get_frame_read(self, frame_size=None, pixel_format=None, ring_size=None,
+                       packet_callback=None) -> 'BackgroundFrameRead':
         """Get the BackgroundFrameRead object from the camera drone. Then, you just need to call
         backgroundFrameRead.frame to get the actual frame received by the drone.
+        Passing any of the optional arguments enables the direct decode mode of BackgroundFrameRead
+        (see BackgroundFrameRead.__init__).
+        Arguments:
+            frame_size: (width, height) the decoder scales the frames to, None keeps the stream size
+            pixel_format: one of BackgroundFrameRead.PIXEL_FORMAT_*
+            ring_size: number of preallocated frame buffers
+            packet_callback: function called with the raw bytes of each H.264 packet received, before decoding
         Returns:
             BackgroundFrameRead
         """
         if self.background_frame_read is None:
             address = self.get_udp_video_address()
-            self.background_frame_read = BackgroundFrameRead(address, self.update_frame_method)
+            self.background_frame_read = BackgroundFrameRead(address, self.update_frame_method,
+                                                             frame_size=frame_size,
+                                                             pixel_format=pixel_format,
+                                                             ring_size=ring_size,
+                                                             packet_callback=packet_callback)
             self.background_frame_read.start()
         return self.background_frame_read
 
@@ -427,40 +387,8 @@ class Tello:
         Return:
             bool/str: str with response text on success, False when unsuccessfull.
         """
-        # Commands very consecutive makes the drone not respond to them.
-        # So wait at least self.TIME_BTW_COMMANDS seconds
-        diff = time.time() - self.last_received_command_timestamp
-        if diff < self.TIME_BTW_COMMANDS:
-            self.LOGGER.debug(
-                'Waiting {} seconds to execute command: {}...'.format(diff, command))
-            time.sleep(diff)
-
-        self.LOGGER.info("Send command: '{}'".format(command))
-        timestamp = time.time()
-
-        client_socket.sendto(command.encode('utf-8'), self.address)
-
-        responses = self.get_own_udp_object()['responses']
-
-        while not responses:
-            if time.time() - timestamp > timeout:
-                message = "Aborting command '{}'. Did not receive a response after {} seconds".format(
-                    command, timeout)
-                self.LOGGER.warning(message)
-                return message
-            time.sleep(0.1)  # Sleep during send command
-
-        self.last_received_command_timestamp = time.time()
-
-        first_response = responses.pop(0)  # first datum from socket
-        try:
-            response = first_response.decode("utf-8")
-        except UnicodeDecodeError as e:
-            self.LOGGER.error(e)
-            return "response decode error"
-        response = response.rstrip("\r\n")
-
-        self.LOGGER.info("Response {}: '{}'".format(command, response))
+        response = EventLoopThread.run(self.async_tello.send_command_with_return(command, timeout=timeout))
+        self.last_received_command_timestamp = self.async_tello.last_received_command_timestamp
         return response
 
     def send_command_without_return(self, command: str):
@@ -471,42 +399,19 @@ class Tello:
 
         self.LOGGER.info(
             "Send command (no response expected): '{}'".format(command))
-        client_socket.sendto(command.encode('utf-8'), self.address)
+        EventLoopThread.call_soon(self.async_tello.send_command_without_return, command, False)
 
     def send_control_command(self, command: str, timeout: int = RESPONSE_TIMEOUT) -> bool:
         """Send control command to Tello and wait for its response.
         Internal method, you normally wouldn't call this yourself.
         """
-        response = "max retries exceeded"
-        for i in range(0, self.retry_count):
-            response = self.send_command_with_return(command, timeout=timeout)
-
-            if 'ok' in response.lower():
-                return True
-
-            self.LOGGER.debug(
-                "Command attempt #{} failed for command: '{}'".format(i, command))
-
-        self.raise_result_error(command, response)
-        return False  # never reached
+        return EventLoopThread.run(self.async_tello.send_control_command(command, timeout=timeout))
 
     def send_read_command(self, command: str) -> str:
         """Send given command to Tello and wait for its response.
         Internal method, you normally wouldn't call this yourself.
         """
-
-        response = self.send_command_with_return(command)
-
-        try:
-            response = str(response)
-        except TypeError as e:
-            self.LOGGER.error(e)
-
-        if any(word in response for word in ('error', 'ERROR', 'False')):
-            self.raise_result_error(command, response)
-            return "Error: this code should never be reached"
-
-        return response
+        return EventLoopThread.run(self.async_tello.send_read_command(command))
 
     def send_read_command_int(self, command: str) -> int:
         """Send given command to Tello and wait for its response.
@@ -535,21 +440,7 @@ class Tello:
     def connect(self, wait_for_state=True):
         """Enter SDK mode. Call this before any of the control functions.
         """
-        self.send_control_command("command")
-
-        if wait_for_state:
-            reps = 20
-            for i in range(reps):
-                if self.get_current_state():
-                    t = i / reps  # in seconds
-                    Tello.LOGGER.debug(
-                        "'.connect()' received first state packet after {} seconds".format(t))
-                    break
-                time.sleep(1 / reps)
-
-            if not self.get_current_state():
-                raise TelloException(
-                    'Did not receive a state packet from the Tello')
+        EventLoopThread.run(self.async_tello.connect(wait_for_state))
 
     def send_keepalive(self):
         """Send a keepalive packet to prevent the drone from landing after 15s
@@ -818,25 +709,16 @@ class Tello:
 
     def send_rc_control(self, left_right_velocity: int, forward_backward_velocity: int, up_down_velocity: int,
                         yaw_velocity: int):
-        """Send RC control via four channels. Command is sent every self.TIME_BTW_RC_CONTROL_COMMANDS seconds.
+        """Send RC control via four channels, without waiting. Command is sent every
+        AsyncTello.TIME_BTW_RC_CONTROL_COMMANDS seconds (see AsyncTello.send_rc_control).
         Arguments:
             left_right_velocity: -100~100 (left/right)
             forward_backward_velocity: -100~100 (forward/backward)
             up_down_velocity: -100~100 (up/down)
             yaw_velocity: -100~100 (yaw)
         """
-        def clamp100(x: int) -> int:
-            return max(-100, min(100, x))
-
-        if time.time() - self.last_rc_control_timestamp > self.TIME_BTW_RC_CONTROL_COMMANDS:
-            self.last_rc_control_timestamp = time.time()
-            cmd = 'rc {} {} {} {}'.format(
-                clamp100(left_right_velocity),
-                clamp100(forward_backward_velocity),
-                clamp100(up_down_velocity),
-                clamp100(yaw_velocity)
-            )
-            self.send_command_without_return(cmd)
+        EventLoopThread.call_soon(self.async_tello.send_rc_control, left_right_velocity, forward_backward_velocity,
+                                  up_down_velocity, yaw_velocity)
 
     def set_wifi_credentials(self, ssid: str, password: str):
         """Set the Wi-Fi SSID and password. The Tello will reboot afterwords.
@@ -1027,6 +909,8 @@ class Tello:
         host = self.address[0]
         if host in drones:
             del drones[host]
+            if EventLoopThread.is_running():
+                EventLoopThread.run(self.async_tello.close())
 
     def __del__(self):
         self.end()
@@ -1037,27 +921,67 @@ class BackgroundFrameRead:
     """
     This class read frames using PyAV in background. Use
     backgroundFrameRead.frame to get the current frame.
-    """
 
-    def __init__(self, address, frame_update_callback=None):
+    By default every decoded frame goes through a PIL image and is copied into a new
+    RGB numpy array. In direct decode mode (any of frame_size, pixel_format or ring_size given),
+    PyAV scales and converts the frame itself, and the pixels are copied once into a ring of
+    preallocated numpy arrays that is reused for the whole stream.
+    Warning : in direct decode mode, backgroundFrameRead.frame is a view on a ring buffer. It is
+    overwritten after ring_size new frames, so a consumer that keeps a frame longer must copy it.
+    backgroundFrameRead.frame_timestamp is the time the current frame was received (time.time()),
+    frame_pts its presentation timestamp in the stream (-1 if unknown) and frame_decode_time the time it was
+    decoded (time.perf_counter(), to measure the latency of the frame processing).
+    A packet_callback receives the raw bytes of each H.264 packet before it is decoded, e.g. to record the stream.
+    """
+    PIXEL_FORMAT_RGB = 'rgb24'
+    PIXEL_FORMAT_BGR = 'bgr24'
+    PIXEL_FORMAT_GRAY = 'gray'
+    PIXEL_FORMAT_CHANNELS = {PIXEL_FORMAT_RGB: 3,
+                             PIXEL_FORMAT_BGR: 3,
+                             PIXEL_FORMAT_GRAY: 1}
+    DEFAULT_RING_SIZE = 4
+
+    def __init__(self, address, frame_update_callback=None,
+                 frame_size=None, pixel_format=None, ring_size=None, packet_callback=None):
         self.address = address
         self.frame = np.zeros([300, 400, 3], dtype=np.uint8)
+        self.frame_timestamp = 0.0
+        self.frame_pts = -1
+        self.frame_decode_time = 0.0
         self.frame_update_callback = frame_update_callback
+        self.packet_callback = packet_callback
+
+        # Direct decode mode
+        self.direct_decode = frame_size is not None or pixel_format is not None or ring_size is not None
+        self.frame_size = frame_size
+        self.pixel_format = pixel_format if pixel_format is not None else self.PIXEL_FORMAT_RGB
+        if self.pixel_format not in self.PIXEL_FORMAT_CHANNELS:
+            raise TelloException('Unsupported pixel format: {}'.format(self.pixel_format))
+        self.ring_size = ring_size if ring_size is not None else self.DEFAULT_RING_SIZE
+        if self.ring_size < 1:
+            raise TelloException('The frame ring needs at least one buffer')
+        self.ring: Optional[np.ndarray] = None
+        self.ring_index = 0
+
+        self.container = self.open_container()
+        self.stopped = False
+        self.worker = Thread(target=self.update_frame, args=(), daemon=True)
 
+    def open_container(self):
+        """Open the video stream with PyAV
+        Internal method, you normally wouldn't call this yourself.
+        """
         # Try grabbing frame with PyAV
         # According to issue #90 the decoder might need some time
         # https://github.com/damiafuentes/DJITelloPy/issues/90#issuecomment-855458905
         try:
             Tello.LOGGER.debug('trying to grab video frames...')
-            self.container = av.open(self.address, timeout=(
+            return av.open(self.address, timeout=(
                 Tello.FRAME_GRAB_TIMEOUT, None))
         except av.error.ExitError:
             raise TelloException(
                 'Failed to grab video frames from video stream')
 
-        self.stopped = False
-        self.worker = Thread(target=self.update_frame, args=(), daemon=True)
-
     def start(self):
         """Start the frame update worker
         Internal method, you normally wouldn't call this yourself.
@@ -1070,17 +994,64 @@ class BackgroundFrameRead:
         """
 
         try:
-            for frame in self.container.decode(video=0):
-                self.frame = np.array(frame.to_image())
-                if self.stopped:
-                    self.container.close()
-                    break
-                if self.frame_update_callback is not None:
-                    self.frame_update_callback()
+            for packet in self.container.demux(video=0):
+                if self.packet_callback is not None and packet.size > 0:
+                    self.packet_callback(bytes(packet))
+                for frame in packet.decode():
+                    self.set_frame(frame, time.time())
+                    if self.stopped:
+                        self.container.close()
+                        return
+                    if self.frame_update_callback is not None:
+                        self.frame_update_callback()
         except av.error.ExitError:
             raise TelloException('Do not have enough frames for decoding, please try again or increase video'
                                  ' fps before get_frame_read()')
 
+    def set_frame(self, frame, timestamp: float):
+        """Convert a decoded PyAV frame into the current numpy frame
+        Internal method, you normally wouldn't call this yourself.
+        """
+        if self.direct_decode:
+            self.frame = self.decode_into_ring(frame)
+        else:
+            self.frame = np.array(frame.to_image())
+        self.frame_timestamp = timestamp
+        self.frame_pts = frame.pts if frame.pts is not None else -1
+        self.frame_decode_time = time.perf_counter()
+
+    def allocate_ring(self, width: int, height: int):
+        """Allocate the reusable frame buffers once the output frame size is known
+        Internal method, you normally wouldn't call this yourself.
+        """
+        channels = self.PIXEL_FORMAT_CHANNELS[self.pixel_format]
+        shape = (self.ring_size, height, width, channels) if channels > 1 else (self.ring_size, height, width)
+        self.ring = np.zeros(shape, dtype=np.uint8)
+        self.ring_index = 0
+
+    def decode_into_ring(self, frame) -> np.ndarray:
+        """Scale and convert a decoded PyAV frame with the decoder (swscale), then copy its pixels
+        into the next buffer of the ring. Returns the filled buffer.
+        Internal method, you normally wouldn't call this yourself.
+        """
+        if self.frame_size is not None:
+            width, height = self.frame_size
+        else:
+            width, height = frame.width, frame.height
+        if self.ring is None or self.ring.shape[1] != height or self.ring.shape[2] != width:
+            self.allocate_ring(width, height)
+
+        frame = frame.reformat(width=width, height=height, format=self.pixel_format)
+        plane = frame.planes[0]
+        row_size = width * self.PIXEL_FORMAT_CHANNELS[self.pixel_format]
+        # Plane rows may be padded (line_size >= row_size): crop them while copying
+        pixels = np.frombuffer(plane, dtype=np.uint8).reshape(-1, plane.line_size)[:height, :row_size]
+
+        buffer = self.ring[self.ring_index]
+        np.copyto(buffer.reshape(height, row_size), pixels)
+        self.ring_index = (self.ring_index + 1) % self.ring_size
+        return buffer
+
     def stop(self):
         """Stop the frame update worker
         Internal method, you normally wouldn't call this yourself.
@@ -0,0 +1,102 @@
+"""
+Benchmark of the panel of Display, run with : SDL_VIDEODRIVER=dummy python bench_display_view.py
+Compares rendering every panel line and updating the whole window on every frame, with the cached panel lines
+redrawn only when their value changed and the update of the dirty rectangles only.
+Also compares the transfer of the frames by a rotation, a flip and a new surface on every frame, with the single
+copy into the persistent surfaces of Display.
+"""
+import time
+
+import numpy
+import pygame
+
+from parameters import RED, IMG_SIZE
+from subsys_display_view import Display
+
+N_FRAMES: int = 300
+N_LINES: int = 40
+CHANGING_LINES: int = 8     # Lines whose value changes on every frame (timings, RC commands...)
+
+
+def panel(index: int) -> dict:
+    variables = {f'Static {line}': line for line in range(N_LINES - CHANGING_LINES)}
+    variables.update({f'Changing {line}': (index * 7 + line) % 50 for line in range(CHANGING_LINES)})
+    return variables
+
+
+def legacy_run(frame: numpy.ndarray, overlay: numpy.ndarray, variables_dict: dict):
+    """ Display.run() and the window update, as they were before the text cache and the dirty rectangles """
+    Display.SCREEN.fill([0, 0, 0])
+    for key in variables_dict:
+        Display._log(f"{key}: ", f"{variables_dict[key]}")
+    frame = pygame.surfarray.make_surface(numpy.flipud(numpy.rot90(frame)))
+    overlay = pygame.surfarray.make_surface(numpy.flipud(numpy.rot90(overlay)))
+    overlay.set_colorkey((0, 0, 0))
+    for title, item in Display.log_dict.items():
+        Display.SCREEN.blit(Display.FONT_PANEL_INFO.render(f"{title} {item['value']}", True, RED), item['pos'])
+    Display.SCREEN.blit(frame, Display.pos_img_in_screen)
+    Display.SCREEN.blit(overlay, Display.pos_img_in_screen)
+    pygame.display.update()
+
+
+def legacy_panel(variables_dict: dict):
+    Display.SCREEN.fill([0, 0, 0], (0, 0, Display.pos_img_in_screen[0], Display.SCREEN.get_height()))
+    for key in variables_dict:
+        Display._log(f"{key}: ", f"{variables_dict[key]}")
+    for title, item in Display.log_dict.items():
+        Display.SCREEN.blit(Display.FONT_PANEL_INFO.render(f"{title} {item['value']}", True, RED), item['pos'])
+
+
+def cached_panel(variables_dict: dict):
+    for key in variables_dict:
+        Display._log(f"{key}: ", f"{variables_dict[key]}")
+    Display._update_log()
+    Display.dirty_rects = []
+
+
+def legacy_blit(frame: numpy.ndarray, overlay: numpy.ndarray, _variables_dict: dict):
+    frame = pygame.surfarray.make_surface(numpy.flipud(numpy.rot90(frame)))
+    overlay = pygame.surfarray.make_surface(numpy.flipud(numpy.rot90(overlay)))
+    overlay.set_colorkey((0, 0, 0))
+    Display.SCREEN.blit(frame, Display.pos_img_in_screen)
+    Display.SCREEN.blit(overlay, Display.pos_img_in_screen)
+
+
+def persistent_blit(frame: numpy.ndarray, overlay: numpy.ndarray, _variables_dict: dict):
+    frame_surface = Display._get_surface('frame_surface', frame)
+    pygame.surfarray.blit_array(frame_surface, frame.swapaxes(0, 1))
+    overlay_surface = Display._get_surface('overlay_surface', overlay)
+    pygame.surfarray.blit_array(overlay_surface, overlay.swapaxes(0, 1))
+    Display.SCREEN.blit(frame_surface, Display.pos_img_in_screen)
+    Display.SCREEN.blit(overlay_surface, Display.pos_img_in_screen)
+
+
+def cached_run(frame: numpy.ndarray, overlay: numpy.ndarray, variables_dict: dict):
+    Display.run(frame, overlay, variables_dict)
+    Display.update()
+
+
+def time_per_frame(function, *args) -> float:
+    Display.setup()
+    function(*args, panel(0))  # warm-up
+    start_time = time.perf_counter()
+    for index in range(N_FRAMES):
+        function(*args, panel(index))
+    return (time.perf_counter() - start_time) / N_FRAMES
+
+
+if __name__ == "__main__":
+    rng = numpy.random.default_rng(0)
+    frame = rng.integers(0, 256, (IMG_SIZE[1], IMG_SIZE[0], 3), dtype=numpy.uint8)
+    overlay = numpy.zeros_like(frame)
+    print(f'{N_LINES} panel lines, {CHANGING_LINES} changing on every frame')
+    for name, legacy_time, cached_time in (('panel', time_per_frame(legacy_panel), time_per_frame(cached_panel)),
+                                           ('frame', time_per_frame(legacy_run, frame, overlay),
+                                            time_per_frame(cached_run, frame, overlay))):
+        print(f'{name}   full redraw {legacy_time * 1e3:6.2f} ms   cached + dirty rects {cached_time * 1e3:6.2f} ms   '
+              f'x{legacy_time / cached_time:5.2f}')
+    for name, image in (('rgb', frame), ('gray', frame[..., 0].copy())):
+        legacy_time = time_per_frame(legacy_blit, image, overlay)
+        persistent_time = time_per_frame(persistent_blit, image, overlay)
+        print(f'{name:5} blit   rot90 + flipud + make_surface {legacy_time * 1e3:6.2f} ms   '
+              f'persistent surface {persistent_time * 1e3:6.2f} ms')
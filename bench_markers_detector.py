@@ -0,0 +1,83 @@
+"""
+Benchmark of the ARUCO markers detection, run with : python bench_markers_detector.py
+No simulator nor drone is needed : the test frame is built from the marker images of the images folder.
+"""
+import time
+
+import cv2
+import numpy
+
+from parameters import IMG_SIZE
+from subsys_markers_detected import MarkersDetector, DetectedMarkersStatus
+
+N_FRAMES: int = 200
+# (marker id, top-left position, side length in pixels) of the markers pasted on the test frame
+TEST_MARKERS: list = [(1, (40, 60), 160),
+                      (2, (300, 120), 90),
+                      (3, (500, 300), 40)]
+
+
+def build_test_frame() -> numpy.ndarray:
+    frame = numpy.full((IMG_SIZE[1], IMG_SIZE[0], 3), 200, dtype=numpy.uint8)
+    for marker_id, (x, y), side in TEST_MARKERS:
+        marker = cv2.imread(f'images/ARUCO_ID_{marker_id}.png', cv2.IMREAD_COLOR)
+        if marker is None:
+            raise FileNotFoundError(f'images/ARUCO_ID_{marker_id}.png')
+        frame[y:y + side, x:x + side] = cv2.resize(marker, (side, side), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+
+def legacy_run(frame: numpy.ndarray):
+    """ Detection as it was done before the detector was cached """
+    cp_frame = frame.copy()
+    gray = cv2.cvtColor(cp_frame, cv2.COLOR_BGR2GRAY)
+    if hasattr(cv2.aruco, 'ArucoDetector'):
+        aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_100)
+        parameters = cv2.aruco.DetectorParameters()
+        corners, ids, _ = cv2.aruco.ArucoDetector(aruco_dict, parameters).detectMarkers(gray)
+    else:
+        aruco_dict = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_100)
+        parameters = cv2.aruco.DetectorParameters_create()
+        corners, ids, _ = cv2.aruco.detectMarkers(gray, aruco_dict, parameters=parameters)
+    if ids is not None:
+        cv2.aruco.drawDetectedMarkers(cp_frame, corners, ids, borderColor=(100, 0, 240))
+    return cp_frame
+
+
+def time_per_frame(function, frame: numpy.ndarray, n_frames: int = N_FRAMES) -> float:
+    function(frame)  # warm-up
+    start_time = time.perf_counter()
+    for _ in range(n_frames):
+        function(frame)
+    return (time.perf_counter() - start_time) / n_frames
+
+
+def report(name: str, duration: float, reference: float):
+    print(f'{name:<28} {duration * 1000:8.3f} ms/frame   x{reference / duration:5.2f}')
+
+
+if __name__ == "__main__":
+    test_frame = build_test_frame()
+    MarkersDetector.setup(pixel_format='rgb24')
+    MarkersDetector.run(test_frame)
+    found_ids = [] if DetectedMarkersStatus.ids is None else sorted(numpy.ravel(DetectedMarkersStatus.ids).tolist())
+    print('Markers found :', found_ids)
+
+    legacy_time = time_per_frame(legacy_run, test_frame)
+    report('legacy (rebuilt detector)', legacy_time, legacy_time)
+    MarkersDetector.PARAM_TRACKING = False
+    report('cached detector', time_per_frame(MarkersDetector.run, test_frame), legacy_time)
+
+    # Tracking mode, the target is the marker with the min id (as selected by SelectTargetMarker)
+    MarkersDetector.PARAM_TRACKING = True
+    target_corners = DetectedMarkersStatus.corners[int(numpy.argmin(DetectedMarkersStatus.ids))][0].copy()
+    report('tracking (ROI search)',
+           time_per_frame(lambda frame: MarkersDetector.run(frame, target_corners), test_frame), legacy_time)
+
+    # Pyramid mode, full frame scans only
+    MarkersDetector.PARAM_TRACKING = False
+    for levels in (1, 2):
+        MarkersDetector.PARAM_PYRAMID_LEVELS = levels
+        report(f'pyramid ({levels} levels)', time_per_frame(MarkersDetector.run, test_frame), legacy_time)
+        print(' ' * 4, 'last frame :', MarkersDetector.__get_dict__()['Levels ms'], 'ms')
+    MarkersDetector.PARAM_PYRAMID_LEVELS = 0
@@ -0,0 +1,87 @@
+"""
+Benchmark of the markers geometry of SelectTargetMarker, run with : python bench_select_target_marker.py
+Compares the per-marker computation in pure Python (as it was done for the target marker only) applied to every
+detected marker, with the batched computation on the (N, 4, 2) corners array, and checks that both agree.
+"""
+import time
+
+import numpy
+
+from parameters import DRONE_POS
+from subsys_select_target_marker import SelectTargetMarker
+
+N_CALLS: int = 2000
+OFFSET: tuple = (-4, 0)
+MARKER_COUNTS: tuple = (1, 5, 20)
+
+
+def legacy_midpoint(corners) -> tuple:
+    xc = yc = 0
+    for x, y in corners:
+        xc += x
+        yc += y
+    return int(xc / len(corners)), int(yc / len(corners))
+
+
+def legacy_angle_between(p1, p2, vertical: bool = False) -> float:
+    dx = p1[0] - p2[0]
+    dy = p1[1] - p2[1]
+    if not vertical:
+        return numpy.arctan(-dy / (dx + 0.000001))
+    return numpy.arctan(-dx / (dy + 0.000001))
+
+
+def legacy_length_segment(p1, p2) -> float:
+    return numpy.sqrt((p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2)
+
+
+def legacy_geometry(corners: numpy.ndarray) -> list:
+    """ Geometry of every marker, one marker at a time, as SelectTargetMarker.run did for the target marker """
+    markers = []
+    for br, bl, tl, tr in corners:
+        center_pt = legacy_midpoint([br, bl, tl, tr])
+        left_pt = legacy_midpoint([bl, tl])
+        right_pt = legacy_midpoint([br, tr])
+        bottom_pt = legacy_midpoint([br, bl])
+        top_pt = legacy_midpoint([tl, tr])
+        height = legacy_length_segment(bottom_pt, top_pt)
+        width = legacy_length_segment(left_pt, right_pt)
+        h_angle = legacy_angle_between(left_pt, right_pt)
+        v_angle = legacy_angle_between(top_pt, bottom_pt, vertical=True)
+        offset = (int(OFFSET[0] * width), int(OFFSET[1] * height))
+        marker_pos = (center_pt[0] + offset[0], center_pt[1] + offset[1])
+        m_angle = legacy_angle_between(DRONE_POS, marker_pos, vertical=True)
+        m_distance = legacy_length_segment(DRONE_POS, marker_pos)
+        markers.append((center_pt, height, width, h_angle, v_angle, m_angle, m_distance))
+    return markers
+
+
+def random_markers(n_markers: int, rng: numpy.random.Generator) -> (numpy.ndarray, numpy.ndarray):
+    sides = rng.uniform(30, 150, (n_markers, 1, 1))
+    square = numpy.array([[1, 1], [0, 1], [0, 0], [1, 0]])
+    corners = rng.uniform(0, 480, (n_markers, 1, 2)) + sides * square + rng.normal(0, 2, (n_markers, 4, 2))
+    return numpy.arange(n_markers), corners.astype(numpy.float32)
+
+
+def time_per_call(function, n_calls: int = N_CALLS) -> float:
+    function()  # warm-up
+    start_time = time.perf_counter()
+    for _ in range(n_calls):
+        function()
+    return (time.perf_counter() - start_time) / n_calls
+
+
+if __name__ == "__main__":
+    rng = numpy.random.default_rng(0)
+    for n_markers in MARKER_COUNTS:
+        ids, corners = random_markers(n_markers, rng)
+        geometry = SelectTargetMarker.compute_geometry(ids, corners, OFFSET)
+        for i, (center_pt, height, width, h_angle, v_angle, m_angle, m_distance) in enumerate(legacy_geometry(corners)):
+            assert tuple(geometry.centers[i]) == center_pt
+            assert numpy.allclose((geometry.heights[i], geometry.widths[i], geometry.h_angles[i],
+                                   geometry.v_angles[i], geometry.m_angles[i], geometry.m_distances[i]),
+                                  (height, width, h_angle, v_angle, m_angle, m_distance))
+        legacy_time = time_per_call(lambda: legacy_geometry(corners))
+        batched_time = time_per_call(lambda: SelectTargetMarker.compute_geometry(ids, corners, OFFSET))
+        print(f'{n_markers:3d} markers   per marker {legacy_time * 1e6:8.1f} us   '
+              f'batched {batched_time * 1e6:8.1f} us   x{legacy_time / batched_time:5.2f}')
@@ -0,0 +1,41 @@
+"""
+Micro-benchmark of the Tello state packets parsing, run with : python bench_state_parser.py
+Compares the dict parser (Tello.parse_state) with the precompiled StateParser, and the field accesses of both results.
+"""
+import time
+
+from DJITelloPy.djitellopy.async_tello import AsyncTello
+from DJITelloPy.djitellopy.state import StateParser
+
+N_PACKETS: int = 100000
+STATE_PACKET: str = ('mid:-1;x:0;y:0;z:0;mpry:0,0,0;pitch:1;roll:-2;yaw:-87;vgx:0;vgy:0;vgz:0;templ:62;temph:65;'
+                     'tof:10;h:0;bat:87;baro:52.34;time:0;agx:-5.00;agy:1.00;agz:-998.00;\r\n')
+
+
+def time_per_call(function, n_calls: int = N_PACKETS) -> float:
+    start_time = time.perf_counter()
+    for _ in range(n_calls):
+        function()
+    return (time.perf_counter() - start_time) / n_calls
+
+
+def report(name: str, duration: float, reference: float):
+    print(f'{name:<32} {duration * 1e6:8.3f} us   x{reference / duration:5.2f}')
+
+
+if __name__ == "__main__":
+    parser = StateParser()
+    state_dict = AsyncTello.parse_state(STATE_PACKET)
+    state_snapshot = parser.parse(STATE_PACKET, time.time())
+    assert state_snapshot.to_dict() == state_dict
+
+    parse_time = time_per_call(lambda: AsyncTello.parse_state(STATE_PACKET))
+    report('parse : dict (parse_state)', parse_time, parse_time)
+    report('parse : StateParser', time_per_call(lambda: parser.parse(STATE_PACKET, 0.0)), parse_time)
+
+    # Fields read by TelloSensors.update_state
+    read_time = time_per_call(lambda: (state_dict['bat'], state_dict['roll'], state_dict['pitch'], state_dict['yaw']))
+    report('read 4 fields : dict', read_time, read_time)
+    report('read 4 fields : TelloState',
+           time_per_call(lambda: (state_snapshot.bat, state_snapshot.roll, state_snapshot.pitch, state_snapshot.yaw)),
+           read_time)
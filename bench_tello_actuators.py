@@ -0,0 +1,46 @@
+"""
+Benchmark of the decision of TelloActuators to send a RC command, run with : python bench_tello_actuators.py
+Compares building and comparing the RCStatus.toStr() strings on every control cycle, with the comparison of the
+versions of the RCStatus.command snapshots.
+"""
+import time
+
+from subsys_read_user_input import RCStatus
+
+N_CYCLES: int = 200000
+CHANGE_PERIOD: int = 10     # The command changes once every CHANGE_PERIOD cycles
+
+
+def string_compare() -> int:
+    sent, previous_state = 0, None
+    for cycle in range(N_CYCLES):
+        if cycle % CHANGE_PERIOD == 0:
+            RCStatus.set(a=cycle % 100)
+        if RCStatus.toStr() != previous_state:
+            previous_state = RCStatus.toStr()
+            sent += 1
+    return sent
+
+
+def version_compare() -> int:
+    sent, sent_version = 0, -1
+    for cycle in range(N_CYCLES):
+        if cycle % CHANGE_PERIOD == 0:
+            RCStatus.set(a=cycle % 100)
+        command = RCStatus.command
+        if command.version != sent_version:
+            sent_version = command.version
+            sent += 1
+    return sent
+
+
+def time_per_cycle(function) -> (float, int):
+    start_time = time.perf_counter()
+    sent = function()
+    return (time.perf_counter() - start_time) / N_CYCLES, sent
+
+
+if __name__ == "__main__":
+    for name, function in (('toStr() compare', string_compare), ('version compare', version_compare)):
+        cycle_time, sent = time_per_cycle(function)
+        print(f'{name}   {cycle_time * 1e6:5.2f} us per cycle   {sent} commands sent')
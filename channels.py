@@ -0,0 +1,70 @@
+import time
+from threading import Condition
+from typing import Any, Optional, Tuple
+
+
+class LatestMailbox:
+    """
+    Single-slot mailbox that only keeps the most recent value put by a producer thread.
+    Each value is stored with a sequence number (starting at 1) and a timestamp.
+    - put() never blocks the producer for longer than a slot swap, older values are overwritten
+    - peek() is lock-free : the slot is a tuple replaced in a single (atomic) assignment,
+      so a reader always gets a consistent (seq, timestamp, value) triplet
+    - get() waits on a condition until a value newer than the last one seen is available,
+      so the same value is never handled twice
+    - wait_taken() waits on the same condition until the most recent value has been taken by a consumer
+    Overwritten values that were never taken by a consumer are counted as dropped.
+    """
+    EMPTY: Tuple[int, float, Any] = (0, 0.0, None)
+
+    def __init__(self):
+        self._slot: Tuple[int, float, Any] = self.EMPTY
+        self._taken_seq: int = 0
+        self._new_value = Condition()
+        self.dropped: int = 0
+
+    def put(self, value: Any, timestamp: float = None) -> int:
+        if timestamp is None:
+            timestamp = time.time()
+        with self._new_value:
+            seq = self._slot[0] + 1
+            if self._slot[0] > self._taken_seq:
+                self.dropped += 1
+            self._slot = (seq, timestamp, value)
+            self._new_value.notify_all()
+        return seq
+
+    def peek(self) -> Tuple[int, float, Any]:
+        return self._slot
+
+    def get(self, last_seq: int = 0, timeout: float = None) -> Optional[Tuple[int, float, Any]]:
+        """
+        Returns the (seq, timestamp, value) triplet of the most recent value if its sequence number is
+        greater than last_seq, waiting for it at most timeout seconds (forever if None).
+        Returns None when the timeout is reached.
+        """
+        slot = self._slot
+        if slot[0] <= last_seq:
+            with self._new_value:
+                if not self._new_value.wait_for(lambda: self._slot[0] > last_seq, timeout):
+                    return None
+                slot = self._slot
+        if slot[0] > self._taken_seq:
+            with self._new_value:
+                self._taken_seq = max(self._taken_seq, slot[0])
+                self._new_value.notify_all()
+        return slot
+
+    def wait_taken(self, timeout: float = None) -> bool:
+        """ Waits until the most recent value has been taken, at most timeout seconds (forever if None) """
+        with self._new_value:
+            return self._new_value.wait_for(lambda: self._slot[0] <= self._taken_seq, timeout)
+
+    @property
+    def seq(self) -> int:
+        return self._slot[0]
+
+    @property
+    def pending(self) -> int:
+        """ Number of values waiting to be taken (0 or 1) """
+        return int(self._slot[0] > self._taken_seq)
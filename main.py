@@ -1,36 +1,73 @@
 import logging
 import time
 
+import numpy
+
 import parameters
 from DJITelloPy.djitellopy.tello import Tello, BackgroundFrameRead
+from DJITelloPy.djitellopy.emulator import TelloEmulator
 from subsys_display_view import Display
+from subsys_preview_stream import PreviewStream
 from subsys_read_user_input import ReadUserInput, ModeStatus, RCStatus
-from subsys_markers_detected import MarkersDetector, DetectedMarkersStatus
-from subsys_select_target_marker import SelectTargetMarker
+from subsys_markers_detected import MarkersDetector, MarkersDetectorPool, DetectedMarkersStatus
+from subsys_select_target_marker import SelectTargetMarker, MarkerStatus
+from subsys_marker_pose import MarkerPoseEstimator, MarkerPoses
+from subsys_course_planner import CourseMap, CoursePlanner
+from subsys_target_tracker import TargetTracker
 from subsys_tello_sensors import TelloSensors, FrameReader
 from subsys_tello_actuators import TelloActuators
+from subsys_telemetry import TelemetryRecorder
+from subsys_replay import ReplayTello
 from subsys_visual_control import VisualControl
+from channels import LatestMailbox
+from metrics import StageStats, LatencyHistogram
+from scheduler import FixedRateTimer
 from threading import Thread
+from types import SimpleNamespace
+from typing import List, NamedTuple
 
 
 def setup():
-    Display.setup()
-    ReadUserInput.setup()
+    if not parameters.HEADLESS:
+        Display.setup()
+    ReadUserInput.setup(headless=parameters.HEADLESS)
+    if parameters.PREVIEW_PORT:
+        PreviewStream.setup(parameters.PREVIEW_PORT)
+    MarkersDetector.setup()
     SelectTargetMarker.setup()
-    tello, frame_reader = init_env()
+    if parameters.POSE_ESTIMATION:
+        MarkerPoseEstimator.setup(parameters.MARKER_SIZE)
+    TargetTracker.setup()
+    CoursePlanner.setup()
+    # A replayed flight is not recorded again
+    record_telemetry = parameters.TELEMETRY_ENABLED and parameters.ENV.status != parameters.ENV.REPLAY
+    if record_telemetry:
+        # Started before the video stream, so that its first packets are recorded
+        TelemetryRecorder.setup(parameters.TELEMETRY_DIR)
+    tello, frame_reader = init_env(record_telemetry)
     tello.LOGGER.setLevel(logging.INFO)
     fh = logging.FileHandler(filename='Tello.log')
     fileLogFormat='%(asctime)s - %(levelname)s - %(message)s'
     fileFormatter = logging.Formatter(fileLogFormat)
     Tello.LOGGER.addHandler(fh)
+    if record_telemetry:
+        tello.add_state_callback(TelemetryRecorder.record_state)
+        StageStats.on_sample = TelemetryRecorder.record_timing
     FrameReader.setup(frame_reader)
     TelloActuators.setup(tello)
     TelloSensors.setup(tello)
+    if parameters.DETECTION_WORKERS > 0:
+        frame_shape = (parameters.IMG_SIZE[1], parameters.IMG_SIZE[0])
+        if parameters.FRAME_PIXEL_FORMAT != 'gray':
+            frame_shape += (3,)
+        MarkersDetectorPool.setup(parameters.DETECTION_WORKERS, frame_shape)
+    if parameters.ENV.status == parameters.ENV.REPLAY:
+        tello.play()
     frame_reception_check = ImageProcess.setup(timeout=2)
     return frame_reception_check
 
 
-def init_env() -> (Tello, BackgroundFrameRead):
+def init_env(record_telemetry: bool = False) -> (Tello, BackgroundFrameRead):
     # Init Tello python object that interacts with the Tello UAV
     tello = None
     if parameters.ENV.status == parameters.ENV.SIMULATION:
@@ -39,11 +76,29 @@ def init_env() -> (Tello, BackgroundFrameRead):
     elif parameters.ENV.status == parameters.ENV.REAL:
         Tello.CONTROL_UDP_PORT_CLIENT = Tello.CONTROL_UDP_PORT
         tello = Tello("192.168.10.1", image_received_method=FrameReader.update_frame)
+    elif parameters.ENV.status == parameters.ENV.EMULATOR:
+        emulator = TelloEmulator("127.0.0.1",
+                                 state_rate=parameters.EMULATOR_STATE_RATE,
+                                 video_file=parameters.EMULATOR_VIDEO_FILE,
+                                 latency=parameters.EMULATOR_LATENCY,
+                                 jitter=parameters.EMULATOR_JITTER,
+                                 loss=parameters.EMULATOR_LOSS)
+        emulator.start()  # Runs in a daemon thread until the end of the program
+        Tello.CONTROL_UDP_PORT_CLIENT = 9000
+        tello = Tello("127.0.0.1", image_received_method=FrameReader.update_frame)
+    elif parameters.ENV.status == parameters.ENV.REPLAY:
+        tello = ReplayTello(parameters.REPLAY_DIR, parameters.REPLAY_SPEED,
+                            image_received_method=FrameReader.update_frame,
+                            frame_taken=FrameReader.wait_frame_taken)
     tello.connect()
     tello.streamoff()
     tello.streamon()
     try:
-        frame_reader = tello.get_frame_read()
+        frame_reader = tello.get_frame_read(frame_size=parameters.IMG_SIZE,
+                                            pixel_format=parameters.FRAME_PIXEL_FORMAT,
+                                            ring_size=parameters.FRAME_RING_SIZE,
+                                            packet_callback=TelemetryRecorder.record_video if record_telemetry
+                                            else None)
         parameters.RUN.status = parameters.RUN.START
     except Exception as exc:
         parameters.RUN.status = parameters.RUN.STOP
@@ -51,74 +106,311 @@ def init_env() -> (Tello, BackgroundFrameRead):
     return tello, frame_reader
 
 
+class Detection(NamedTuple):
+    """ Output of the detection stage, shared with the control and render stages """
+    frame: numpy.ndarray
+    overlay: numpy.ndarray
+    marker: SimpleNamespace     # Snapshot of MarkerStatus
+    marker_dict: dict           # MarkerStatus.__get_dict__() for the display panel
+    poses: MarkerPoses          # Metric poses of all the markers in view, None without POSE_ESTIMATION or marker
+    pts: int                    # Presentation timestamp of the frame in the video stream
+    decode_time: float          # Time the frame was decoded, the detection started and ended (time.perf_counter())
+    detect_start: float
+    detect_end: float
+
+
 class ImageProcess:
-    # The image processing features are run in a separate thread in order to allow the pygame window update
+    # The image processing features are run in separate threads in order to allow the pygame window update
     # and the Tello frames reception at a high rate, even during time-expensive image processing computations.
-    # Then, the processed frame is always the most recent one, and the not-processed outdated frames are dismissed.
+    # The processing is split in pipelined stages, each one running in its own thread :
+    #   decode (BackgroundFrameRead) -> detect -> control / actuate
+    #                                          -> render (pygame window) or preview (MJPEG stream, when HEADLESS)
+    # The control stage runs at the fixed CONTROL_RATE, whatever the frame rate and its jitter : each iteration
+    # uses the most recent detection if a new one is available, and sends the resulting RC command.
+    # With TARGET_TRACKING, each iteration steers towards the target position predicted by TargetTracker at that time,
+    # so that the markers only need to be searched in one frame out of DETECTION_PERIOD.
+    # When the detection runs in worker processes (MarkersDetectorPool), the detect stage is split in a feeder thread
+    # that hands the most recent frame to the next idle worker, and a thread that publishes the results in order.
+    # The stages are connected by single-slot mailboxes that only keep the most recent value. Then, the processed
+    # frame is always the most recent one, the control stage always runs on the freshest detection, and the render
+    # stage can lag behind or skip detections without delaying the commands sent to the UAV.
+    # With HEADLESS, there is no render stage, and the preview stage only runs with PREVIEW_PORT, at PREVIEW_RATE.
     stop_request = False
-    image_processing_thread: Thread = None
+    threads: List[Thread] = []
+    detections: LatestMailbox = None
+    pending_frames: dict = {}   # Frames being processed by MarkersDetectorPool : seq -> (frame, timestamp, pts,
+                                #                                                     decode time, start)
+    FRAME_TIMEOUT: float = 0.5  # Max waiting time for a new input, so that a stop request is never missed
+    # The frames are views on the ring of buffers of the decoder, which overwrites them a few frames later. They are
+    # copied into the detections when a render or preview stage, that can lag behind, displays them.
+    COPY_FRAMES: bool = not parameters.HEADLESS or bool(parameters.PREVIEW_PORT)
+    # A replayed flight is controlled once per detection, right after it and on the recorded time of its frame, so
+    # that every replay of a flight gives the same commands whatever the replay speed
+    REPLAY: bool = parameters.ENV.status == parameters.ENV.REPLAY
+    TARGET_OFFSET: tuple = (-4, 0)  # Shift of the point to reach from the marker center, in ratios of its size
+
+    stats: dict = {'detect': StageStats('detect'),
+                   'control': StageStats('control'),
+                   'render': StageStats('render'),
+                   'preview': StageStats('preview')}
+    # Latency of the frames, from their decoding to the RC command computed from them :
+    #   wait    : decoded -> detection started
+    #   detect  : detection started -> target selected
+    #   control : target selected -> RC command computed
+    #   total   : decoded -> RC command sent (only when a new command was sent, not for the keep-alive resends)
+    control_timer: FixedRateTimer = FixedRateTimer('Control', parameters.CONTROL_RATE)
+    preview_timer: FixedRateTimer = FixedRateTimer('Preview', parameters.PREVIEW_RATE)
+    latency: dict = {'wait': LatencyHistogram('Lat wait'),
+                     'detect': LatencyHistogram('Lat detect'),
+                     'control': LatencyHistogram('Lat control'),
+                     'total': LatencyHistogram('Lat total')}
 
     @classmethod
     def setup(cls, timeout: int = 2):
         # Warning : Blocking code in the main thread !!!
         # Since the program cannot perform any image process before having received a frame from the Tello,
         # this part of the program waits for the first frame to be available before finishing the setup.
-        start_time = time.time()
+        if parameters.COURSE_PLANNING and not parameters.POSE_ESTIMATION:
+            # The course planner locates the gates from the metric poses of their markers
+            print('ImageProcess | Pose estimation enabled for the course planning')
+            parameters.POSE_ESTIMATION = True
+            MarkerPoseEstimator.setup(parameters.MARKER_SIZE)
         print('ImageProcess | Attempting to get frame...')
-        while True:
-            if not FrameReader.frames_queue.empty():
-                frame_received = True
-                print('ImageProcess | Frame received')
-                break
-            if time.time() - start_time > timeout:
-                print('ImageProcess | Timeout reached, no frame received')
-                frame_received = False
-                stop()
-                break
+        frame_received = FrameReader.wait_first_frame(timeout)
         if frame_received:
-            cls.image_processing_thread = Thread(target=cls.run)
-            cls.image_processing_thread.start()
+            print('ImageProcess | Frame received')
+            cls.detections = LatestMailbox()
+            if MarkersDetectorPool.n_workers > 0:
+                cls.threads = [Thread(target=cls.run_detection_feeder),
+                               Thread(target=cls.run_pooled_detection)]
+            else:
+                cls.threads = [Thread(target=cls.run_detection)]
+            if not cls.REPLAY:
+                cls.threads += [Thread(target=cls.run_control)]
+            if not parameters.HEADLESS:
+                cls.threads += [Thread(target=cls.run_render)]
+            if parameters.PREVIEW_PORT:
+                cls.threads += [Thread(target=cls.run_preview)]
+            for thread in cls.threads:
+                thread.start()
+        else:
+            print('ImageProcess | Timeout reached, no frame received')
+            stop()
         return frame_received
 
     @classmethod
-    def run(cls):
-        print('Image processing thread started')
-        while True:
-            if cls.stop_request:
-                break
-            # Retrieve UAV internal variables
-            TelloSensors.run()
+    def run_detection(cls):
+        print('Detection stage started')
+        stats = cls.stats['detect']
+        while not cls.stop_request:
             # Retrieve most recent frame from the Tello
-            frame = FrameReader.get_most_recent_frame()
-            # Search for all ARUCO markers in the frame
-            frame_with_markers = MarkersDetector.run(frame)
-            # Select the ARUCO marker to reach first
-            marker_status = SelectTargetMarker.run(frame_with_markers,
-                                                   DetectedMarkersStatus,
-                                                   offset=(-4, 0))
+            frame = FrameReader.get_most_recent_frame(timeout=cls.FRAME_TIMEOUT)
+            if frame is None or FrameReader.last_seq % parameters.DETECTION_PERIOD:
+                continue
+            stats.received(FrameReader.last_seq)
+            start_time = stats.start()
+            # Search for all ARUCO markers in the frame, first around the previous target
+            markers_overlay = MarkersDetector.run(frame, MarkerStatus.corners)
+            cls.select_target(frame, markers_overlay, FrameReader.last_seq, FrameReader.last_timestamp,
+                              FrameReader.last_pts, FrameReader.last_decode_time, start_time)
+            stats.stop(start_time)
+        print('Detection stage stopped')
+
+    @classmethod
+    def run_detection_feeder(cls):
+        print('Detection feeder started')
+        while not cls.stop_request:
+            worker_index = MarkersDetectorPool.acquire_worker(timeout=cls.FRAME_TIMEOUT)
+            if worker_index is None:
+                continue
+            # Retrieve most recent frame from the Tello, once a worker is ready to process it
+            frame = FrameReader.get_most_recent_frame(timeout=cls.FRAME_TIMEOUT)
+            if frame is None or FrameReader.last_seq % parameters.DETECTION_PERIOD:
+                MarkersDetectorPool.release_worker(worker_index)
+                continue
+            seq = FrameReader.last_seq
+            cls.pending_frames[seq] = (frame, FrameReader.last_timestamp, FrameReader.last_pts,
+                                       FrameReader.last_decode_time, StageStats.start())
+            MarkersDetectorPool.submit(worker_index, frame, seq, MarkerStatus.corners)
+        print('Detection feeder stopped')
+
+    @classmethod
+    def run_pooled_detection(cls):
+        print('Detection stage started')
+        stats = cls.stats['detect']
+        while not cls.stop_request:
+            result = MarkersDetectorPool.get_result(timeout=cls.FRAME_TIMEOUT)
+            if result is None:
+                continue
+            seq, corners, ids = result
+            pending_frame = cls.pending_frames.pop(seq, None)
+            if pending_frame is None or seq < stats.last_seq:
+                continue  # A more recent frame has already been published by another worker
+            frame, timestamp, pts, decode_time, start_time = pending_frame
+            for older_seq in [pending_seq for pending_seq in list(cls.pending_frames) if pending_seq < seq]:
+                cls.pending_frames.pop(older_seq, None)
+            stats.received(seq)
+            markers_overlay = MarkersDetector.publish(frame.shape[:2], corners, ids)
+            cls.select_target(frame, markers_overlay, seq, timestamp, pts, decode_time, start_time)
+            stats.stop(start_time)
+        print('Detection stage stopped')
+
+    @classmethod
+    def select_target(cls, frame: numpy.ndarray, markers_overlay: numpy.ndarray, seq: int, timestamp: float,
+                      pts: int, decode_time: float, detect_start: float):
+        TelemetryRecorder.record_markers(timestamp, seq, DetectedMarkersStatus.corners, DetectedMarkersStatus.ids)
+        # Select the ARUCO marker to reach first, then hand the result over to the next stages
+        marker_status = SelectTargetMarker.run(markers_overlay,
+                                               DetectedMarkersStatus,
+                                               offset=cls.TARGET_OFFSET)
+        geometry = SelectTargetMarker.geometry
+        poses = None
+        if parameters.POSE_ESTIMATION and geometry is not None:
+            # Metric pose of every marker in view, the target one is added to MarkerStatus
+            poses = MarkerPoseEstimator.run(geometry.ids, geometry.corners, offset=cls.TARGET_OFFSET)
+        detect_end = time.perf_counter()
+        cls.latency['wait'].add(1000 * (detect_start - decode_time))
+        cls.latency['detect'].add(1000 * (detect_end - detect_start))
+        if cls.COPY_FRAMES:
+            frame = frame.copy()
+        detection = Detection(frame, markers_overlay, marker_status.snapshot(), marker_status.__get_dict__(), poses,
+                              pts, decode_time, detect_start, detect_end)
+        seq = cls.detections.put(detection, timestamp)
+        if cls.REPLAY:
+            cls.control((seq, timestamp, detection), replay_time=timestamp)
+
+    @classmethod
+    def run_control(cls):
+        print('Control stage started')
+        stats = cls.stats['control']
+        last_seq = 0
+        while not cls.stop_request:
+            cls.control_timer.wait()
+            slot = cls.detections.get(last_seq, timeout=0)
+            if slot is not None:
+                last_seq = slot[0]
+            cls.control(slot)
+        print('Control stage stopped')
+
+    @classmethod
+    def control(cls, slot: tuple = None, replay_time: float = None):
+        """
+        One iteration of the control stage, with the new detection slot (seq, timestamp, detection) if there is one.
+        The clock is time.perf_counter(), or replay_time when a flight is replayed.
+        """
+        stats = cls.stats['control']
+        start_time = stats.start()
+        # Retrieve UAV internal variables, at the time the processed frame was received
+        TelloSensors.run(frame_timestamp=slot[1] if slot is not None else None)
+        if slot is not None:
+            seq, _, detection = slot
+            stats.received(seq)
+            detection_time = detection.decode_time if replay_time is None else replay_time
+            if parameters.COURSE_PLANNING:
+                CoursePlanner.update(detection.poses, detection_time, TelloSensors.yaw)
+                SelectTargetMarker.preferred_id = CoursePlanner.next_gate_id()
+            elif parameters.TARGET_TRACKING:
+                TargetTracker.update(detection.marker, detection_time, TelloSensors.yaw_rate)
             # Get the velocity commands from the automatic control module
-            if ModeStatus.value == parameters.MODE.AUTO_FLIGHT:
-                VisualControl.run(marker_status)
-            # Send the commands to the UAV
-            TelloActuators.run(RCStatus)
+            elif ModeStatus.value == parameters.MODE.AUTO_FLIGHT:
+                VisualControl.run(detection.marker, detection_time)
+        if ModeStatus.value == parameters.MODE.AUTO_FLIGHT:
+            now = time.perf_counter() if replay_time is None else replay_time
+            if parameters.COURSE_PLANNING:
+                CoursePlanner.run(now, TelloSensors.yaw)
+            elif parameters.TARGET_TRACKING:
+                VisualControl.run(TargetTracker.get_target(now, TelloSensors.yaw_rate), now)
+        # Send the commands to the UAV
+        new_command_sent = TelloActuators.run(RCStatus)
+        if slot is not None:
+            cls.record_latency(slot, new_command_sent)
+        stats.stop(start_time)
+
+    @classmethod
+    def record_latency(cls, slot: tuple, new_command_sent: bool):
+        seq, timestamp, detection = slot
+        now = time.perf_counter()
+        wait_ms = 1000 * (detection.detect_start - detection.decode_time)
+        detect_ms = 1000 * (detection.detect_end - detection.detect_start)
+        control_ms = 1000 * (now - detection.detect_end)
+        total_ms = 1000 * (now - detection.decode_time) if new_command_sent else float('nan')
+        cls.latency['control'].add(control_ms)
+        if new_command_sent:
+            cls.latency['total'].add(total_ms)
+        TelemetryRecorder.record_latency(timestamp, seq, detection.pts, wait_ms, detect_ms, control_ms, total_ms)
+
+    @classmethod
+    def run_render(cls):
+        print('Render stage started')
+        stats = cls.stats['render']
+        last_seq = 0
+        while not cls.stop_request:
+            slot = cls.detections.get(last_seq, timeout=cls.FRAME_TIMEOUT)
+            if slot is None:
+                continue
+            last_seq, _, detection = slot
+            stats.received(last_seq)
+            start_time = stats.start()
             # Update pygame display window
             variables_to_print = parameters.merge_dicts([TelloSensors.__get_dict__(),
+                                                         FrameReader.__get_dict__(),
+                                                         MarkersDetector.__get_dict__(),
                                                          ModeStatus.__get_dict__(),
                                                          RCStatus.__get_dict__(),
-                                                         marker_status.__get_dict__()])
-            Display.run(frame_with_markers, variables_to_print)
-        print('Image processing thread stopped')
+                                                         detection.marker_dict,
+                                                         TargetTracker.__get_dict__(),
+                                                         MarkerPoseEstimator.__get_dict__(),
+                                                         CourseMap.__get_dict__(),
+                                                         CoursePlanner.__get_dict__(),
+                                                         PreviewStream.__get_dict__(),
+                                                         ReadUserInput.__get_dict__(),
+                                                         cls.__get_dict__()])
+            Display.run(detection.frame, detection.overlay, variables_to_print)
+            stats.stop(start_time)
+        print('Render stage stopped')
+
+    @classmethod
+    def run_preview(cls):
+        print('Preview stage started')
+        stats = cls.stats['preview']
+        last_seq = 0
+        while not cls.stop_request:
+            # Capped rate, the detections published in between are skipped
+            cls.preview_timer.wait()
+            slot = cls.detections.get(last_seq, timeout=cls.FRAME_TIMEOUT)
+            if slot is None:
+                continue
+            last_seq, _, detection = slot
+            stats.received(last_seq)
+            start_time = stats.start()
+            PreviewStream.run(detection.frame, detection.overlay)
+            stats.stop(start_time)
+        print('Preview stage stopped')
 
     @classmethod
     def stop(cls):
         cls.stop_request = True
-        cls.image_processing_thread.join()
+        for thread in cls.threads:
+            thread.join()
+
+    @classmethod
+    def __get_dict__(cls) -> dict:
+        pipeline: dict = {'Queue': f'frames {FrameReader.frames_mailbox.pending} '
+                                   f'detections {cls.detections.pending}'}
+        return parameters.merge_dicts([pipeline] +
+                                      [stage.__get_dict__() for stage in cls.stats.values() if stage.count] +
+                                      ([] if cls.REPLAY else [cls.control_timer.__get_dict__()]) +
+                                      [histogram.__get_dict__() for histogram in cls.latency.values()])
 
 
 def stop():
     # Important : first stop ImageProcess, then stop TelloActuator or pygame will crash
     ImageProcess.stop()
+    PreviewStream.stop()
+    if MarkersDetectorPool.n_workers > 0:
+        MarkersDetectorPool.stop()
     TelloActuators.stop()
+    TelemetryRecorder.stop()
 
 
 if __name__ == "__main__":
@@ -129,5 +421,7 @@ if __name__ == "__main__":
         # pygame window with the latest available frame
         flight_finished = ReadUserInput.run_pygame_loop()
         stop()
+        if parameters.HEADLESS:
+            print(ImageProcess.__get_dict__())
     else:
         stop()
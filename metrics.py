@@ -0,0 +1,127 @@
+import bisect
+import math
+import time
+from typing import List, Sequence
+
+import numpy
+
+
+class StageStats:
+    """
+    Low-overhead counters of a pipeline stage :
+    number of processed items, processing latency (last, smoothed mean and max in ms),
+    and number of input items the stage skipped because a newer one was already available
+    """
+    SMOOTHING: float = 0.05  # Weight of the last sample in the smoothed mean
+    on_sample = None         # Optional function(stage name, duration in ms) called with every sample
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count: int = 0
+        self.skipped: int = 0
+        self.last_ms: float = 0.0
+        self.mean_ms: float = 0.0
+        self.max_ms: float = 0.0
+        self.last_seq: int = 0
+
+    @staticmethod
+    def start() -> float:
+        return time.perf_counter()
+
+    def stop(self, start_time: float):
+        duration = 1000 * (time.perf_counter() - start_time)
+        self.count += 1
+        self.last_ms = duration
+        self.mean_ms = duration if self.count == 1 else self.mean_ms + self.SMOOTHING * (duration - self.mean_ms)
+        self.max_ms = max(self.max_ms, duration)
+        if StageStats.on_sample is not None:
+            StageStats.on_sample(self.name, duration)
+
+    def received(self, seq: int):
+        """ Counts the items skipped between the previous received item and this one """
+        if self.last_seq:
+            self.skipped += max(seq - self.last_seq - 1, 0)
+        self.last_seq = seq
+
+    def __get_dict__(self) -> dict:
+        stats: dict = {f'{self.name} ms': f'{self.mean_ms:.1f} (max {self.max_ms:.0f})',
+                       f'{self.name} skip': self.skipped}
+        return stats
+
+
+class LatencyHistogram:
+    """
+    Low-overhead latency histogram with fixed logarithmic bins (BINS_PER_DECADE bins per decade from MIN_MS to MAX_MS):
+    adding a sample is a bisection and an increment, and the percentiles are read from the cumulated bin counts,
+    with a relative precision of about 6 % (half a bin)
+    """
+    MIN_MS: float = 0.1
+    MAX_MS: float = 10000.0
+    BINS_PER_DECADE: int = 20
+    EDGES: List[float] = (MIN_MS * numpy.logspace(0, math.log10(MAX_MS / MIN_MS),
+                                                  round(BINS_PER_DECADE * math.log10(MAX_MS / MIN_MS)) + 1)).tolist()
+    PERCENTILES: tuple = (50, 95, 99)
+
+    def __init__(self, name: str):
+        self.name = name
+        self.counts: List[int] = [0] * (len(self.EDGES) + 1)   # Bin i holds the samples in [EDGES[i-1], EDGES[i][
+        self.count: int = 0
+
+    def add(self, duration_ms: float):
+        self.counts[bisect.bisect_right(self.EDGES, duration_ms)] += 1
+        self.count += 1
+
+    def bin_value(self, i: int) -> float:
+        """ Geometric center of bin i, the bounds of the histogram for the samples out of them """
+        if i == 0:
+            return self.EDGES[0]
+        if i == len(self.EDGES):
+            return self.EDGES[-1]
+        return math.sqrt(self.EDGES[i - 1] * self.EDGES[i])
+
+    def percentiles(self, percentiles: Sequence[float] = PERCENTILES) -> List[float]:
+        """ Returns the given percentiles of the samples in ms (in increasing order), 0 for an empty histogram """
+        values = []
+        cumulated = 0
+        i = 0
+        for percentile in percentiles:
+            rank = max(percentile / 100 * self.count, 1)
+            while i < len(self.counts) and cumulated + self.counts[i] < rank:
+                cumulated += self.counts[i]
+                i += 1
+            values.append(self.bin_value(i) if self.count else 0.0)
+        return values
+
+    def __get_dict__(self) -> dict:
+        p50, p95, p99 = self.percentiles()
+        latency: dict = {f'{self.name} p50/95/99': f'{p50:.0f}/{p95:.0f}/{p99:.0f}'}
+        return latency
+
+
+class CpuUsage:
+    """
+    CPU use of the whole process (all its threads) and of the calling thread, in percent of one core, measured over
+    windows of PERIOD seconds : update() is called from the measured thread, at any rate
+    """
+    PERIOD: float = 1.0  # in seconds
+
+    def __init__(self, name: str):
+        self.name = name
+        self.process_percent: float = 0.0
+        self.thread_percent: float = 0.0
+        self.window_start: tuple = None     # (wall time, process time, thread time) at the start of the window
+
+    def update(self):
+        now = (time.perf_counter(), time.process_time(), time.thread_time())
+        if self.window_start is None:
+            self.window_start = now
+            return
+        elapsed = now[0] - self.window_start[0]
+        if elapsed >= self.PERIOD:
+            self.process_percent = 100 * (now[1] - self.window_start[1]) / elapsed
+            self.thread_percent = 100 * (now[2] - self.window_start[2]) / elapsed
+            self.window_start = now
+
+    def __get_dict__(self) -> dict:
+        cpu: dict = {'CPU %': f'{self.process_percent:.0f} ({self.name} {self.thread_percent:.0f})'}
+        return cpu
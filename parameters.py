@@ -13,16 +13,63 @@ DEG2RAD: float = math.pi/180
 RAD2DEG: float = 180/math.pi
 
 FPS: int = 120
+# Runs without the pygame window nor the rendering (e.g. on a companion computer), the joysticks still work.
+# With PREVIEW_PORT, the annotated frames are streamed as MJPEG on http://<host>:PREVIEW_PORT/ (see PreviewStream),
+# at PREVIEW_RATE frames per second at most, and only while someone is watching.
+HEADLESS: bool = False
+PREVIEW_PORT: int = None
+PREVIEW_RATE: float = 5.0
+# Sampling rate of the joysticks and keys (see ReadUserInput), dead zone around the center of the sticks (from 0 to 1)
+# and max variation of the manual RC commands, in RC units per second
+INPUT_POLL_RATE: float = 100.0
+INPUT_DEADBAND: float = 0.05
+INPUT_SLEW_RATE: float = 1000.0
+# Rate of the control stage, that computes and sends the RC commands from the most recent detection
+CONTROL_RATE: float = 50.0
+# Predicts the target position between the detections (see TargetTracker), so that the markers only need to be
+# searched in one frame out of DETECTION_PERIOD
+TARGET_TRACKING: bool = False
+DETECTION_PERIOD: int = 1
+# Metric pose of the markers (see MarkerPoseEstimator), from their side MARKER_SIZE in meters and the camera
+# intrinsics stored in CAMERA_CALIBRATION_FILE. With POSE_CONTROL, VisualControl steers on the metric pose.
+POSE_ESTIMATION: bool = False
+POSE_CONTROL: bool = False
+MARKER_SIZE: float = 0.15
+CAMERA_CALIBRATION_FILE: str = 'camera_calibration.json'
+# Flies the course through the next gates with feed-forward velocities (see CoursePlanner), needs POSE_ESTIMATION (enabled if needed)
+COURSE_PLANNING: bool = False
 # Real Tello frame size : (960, 720) -> needs a reshape to be correctly displayed on the pygame window
 # Simulator frame size : (640, 480)
 IMG_SIZE: tuple = (640, 480)
 DRONE_POS: ScreenPosition = ScreenPosition((IMG_SIZE[0]//2, 480))
-SCREEN_SIZE: tuple = (800, 480)
+# The information panel on the left of the frame holds columns of Display.COLUMN_WIDTH pixels
+PANEL_WIDTH: int = 480
+SCREEN_SIZE: tuple = (PANEL_WIDTH + IMG_SIZE[0], IMG_SIZE[1])
+# Frames are scaled to IMG_SIZE and converted to FRAME_PIXEL_FORMAT by the video decoder itself,
+# then written in a ring of FRAME_RING_SIZE reusable buffers (see BackgroundFrameRead)
+FRAME_PIXEL_FORMAT: str = 'rgb24'   # 'rgb24', 'bgr24' or 'gray'
+FRAME_RING_SIZE: int = 4
+# Number of worker processes running the markers detection, 0 to run it in a thread of the main process
+DETECTION_WORKERS: int = 0
+# Flight telemetry recording (see TelemetryRecorder), one sub-directory per flight
+TELEMETRY_ENABLED: bool = False
+TELEMETRY_DIR: str = 'flights'
+# Flight replayed in the ENV.REPLAY environment, at REPLAY_SPEED times the real time (0 : as fast as possible)
+REPLAY_DIR: str = 'flights/flight_00000000_000000'
+REPLAY_SPEED: float = 1.0
+# Local Tello emulator of the ENV.EMULATOR environment (see TelloEmulator) and its network conditions
+EMULATOR_STATE_RATE: float = 10.0  # State packets per second
+EMULATOR_VIDEO_FILE: str = None    # Raw H.264 file streamed by the emulator (e.g. a recorded video.h264), None : test pattern
+EMULATOR_LATENCY: float = 0.0      # in seconds
+EMULATOR_JITTER: float = 0.0       # in seconds
+EMULATOR_LOSS: float = 0.0         # Probability of losing a packet
 
 
 class ENV:
     REAL: int = 0
     SIMULATION: int = 1
+    REPLAY: int = 2
+    EMULATOR: int = 3
     status: int = SIMULATION
     
 
@@ -0,0 +1,58 @@
+import time
+
+
+class FixedRateTimer:
+    """
+    Paces a loop at a fixed rate. The deadlines are on an absolute schedule (start + k * period), so the rate does not
+    drift with the duration of the iterations or the sleep inaccuracy.
+    An iteration that ends after the next deadline misses it :
+    - if it is late by less than a period, the next iteration starts at once, to catch up with the schedule
+    - otherwise, the schedule restarts from now instead of running a burst of late iterations
+    Every missed deadline is counted.
+    """
+    SMOOTHING: float = 0.05  # Weight of the last sample in the smoothed interval and lateness
+
+    def __init__(self, name: str, rate: float):
+        self.name = name
+        self.period: float = 1 / rate
+        self.next_deadline: float = None
+        self.last_tick: float = None
+        self.ticks: int = 0
+        self.missed: int = 0
+        self.interval: float = 0.0      # Smoothed measured time between two iterations, in seconds
+        self.lateness_ms: float = 0.0   # Smoothed delay between the deadlines and the wake-ups
+
+    def wait(self, sleep=time.sleep):
+        """ Sleeps until the next deadline, with sleep(delay in seconds), e.g. to wait for events meanwhile """
+        now = time.perf_counter()
+        if self.next_deadline is None:
+            self.next_deadline = now
+        else:
+            self.next_deadline += self.period
+            if now > self.next_deadline:
+                late_periods = int((now - self.next_deadline) / self.period)
+                self.missed += 1 + late_periods
+                if late_periods > 0:
+                    self.next_deadline = now
+            else:
+                sleep(self.next_deadline - now)
+        self.tick(self.next_deadline)
+
+    def tick(self, deadline: float):
+        now = time.perf_counter()
+        self.ticks += 1
+        self.lateness_ms += self.SMOOTHING * (1000 * (now - deadline) - self.lateness_ms)
+        if self.last_tick is not None:
+            interval = now - self.last_tick
+            self.interval = interval if self.ticks == 2 else self.interval + self.SMOOTHING * (interval - self.interval)
+        self.last_tick = now
+
+    @property
+    def rate(self) -> float:
+        """ Measured rate, in Hz """
+        return 1 / self.interval if self.interval > 0 else 0.0
+
+    def __get_dict__(self) -> dict:
+        timer: dict = {f'{self.name} Hz': f'{self.rate:.0f} (late {self.lateness_ms:.1f} ms)',
+                       f'{self.name} missed': self.missed}
+        return timer
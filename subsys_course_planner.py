@@ -0,0 +1,262 @@
+import math
+from typing import Dict, List, Optional
+
+import numpy
+
+from parameters import DEG2RAD, RAD2DEG
+from subsys_marker_pose import MarkerPoses
+from subsys_read_user_input import RCStatus
+from subsys_target_tracker import TargetTracker
+from subsys_visual_control import VisualControl
+
+
+class CourseMap:
+    """
+    Model of the race course : the gates are indexed by the id of their marker, and flown in increasing id order.
+    The relative positions of the gates are learned during the first lap, from the frames in which several markers
+    are in view : the point to reach of gate j (MarkerPoses.gate_pts) is stored in the frame of the marker of gate i,
+    averaged over all the frames. Then, the position of a gate out of view is predicted from any other located gate.
+    """
+    ids: List[int] = []                             # Known gate ids, in course order
+    relative: Dict[tuple, numpy.ndarray] = {}       # (i, j) -> point to reach of gate j in the frame of marker i
+    samples: Dict[tuple, int] = {}                  # (i, j) -> number of frames averaged in relative[(i, j)]
+    learning: bool = True                           # Relative positions are learned during the first lap only
+
+    @classmethod
+    def setup(cls):
+        cls.ids = []
+        cls.relative = {}
+        cls.samples = {}
+        cls.learning = True
+
+    @classmethod
+    def learn(cls, poses: MarkerPoses):
+        """ Indexes the gates in view, and averages their relative positions during the first lap """
+        for marker_id in poses.ids.tolist():
+            if marker_id not in cls.ids:
+                cls.ids = sorted(cls.ids + [marker_id])
+        if not cls.learning:
+            return
+        for i, id_i in enumerate(poses.ids.tolist()):
+            for j, id_j in enumerate(poses.ids.tolist()):
+                if i == j:
+                    continue
+                relative = poses.rotations[i].T @ (poses.gate_pts[j] - poses.tvecs[i])
+                n = cls.samples.get((id_i, id_j), 0) + 1
+                previous = cls.relative.get((id_i, id_j), relative)
+                cls.relative[(id_i, id_j)] = previous + (relative - previous) / n
+                cls.samples[(id_i, id_j)] = n
+
+    @classmethod
+    def predict(cls, gate_id: int, bases: Dict[int, tuple]) -> Optional[numpy.ndarray]:
+        """
+        Returns the point to reach of a gate, predicted from the best known of the located markers bases
+        (id -> (position, rotation) in the same frame), None if its position relatively to them is unknown
+        """
+        best, best_samples = None, 0
+        for base_id in bases:
+            n = cls.samples.get((base_id, gate_id), 0)
+            if n > best_samples:
+                best, best_samples = base_id, n
+        if best is None:
+            return None
+        position, rotation = bases[best]
+        return position + rotation @ cls.relative[(best, gate_id)]
+
+    @classmethod
+    def next_ids(cls, gate_id: int, count: int) -> List[int]:
+        """ Returns the ids of the count gates from gate_id, in course order, wrapping around the lap """
+        if gate_id not in cls.ids:
+            return [gate_id]
+        start = cls.ids.index(gate_id)
+        return [cls.ids[(start + k) % len(cls.ids)] for k in range(min(count, len(cls.ids)))]
+
+    @classmethod
+    def __get_dict__(cls) -> dict:
+        course: dict = {'Course': f'gates {len(cls.ids)} links {len(cls.relative)}'
+                                  f'{" (learning)" if cls.learning else ""}'}
+        return course
+
+
+class CoursePlanner:
+    """
+    Flies the course through the next PARAM_LOOKAHEAD_GATES gates of CourseMap, instead of chasing the gate in view.
+    The plan holds the points to reach of the next gates in the body frame of the UAV (x right, y down, z forward,
+    in meters). It is refreshed with the marker poses of every new detection : the gates in view are measured, the
+    gates seen in the last PARAM_GATE_MEMORY seconds are kept, and the others are predicted by CourseMap from them.
+    Between the detections, and while no gate is in view, the gates are moved with the yaw of the UAV and the distance
+    flown at the commanded velocity.
+    The RC commands are feed-forward velocities towards a carrot point that slides from the next gate towards the
+    following one when getting close, for a smooth path through the gates. The speed is PARAM_MAX_SPEED far from the
+    gates, and decreases to a cornering speed depending on the turn angle at the next gate when approaching it.
+    A gate is passed when the UAV reaches its plane, then the plan moves on to the next gate of the course.
+    """
+    PARAM_LOOKAHEAD_GATES: int = 3
+    PARAM_MAX_SPEED: int = 80           # Forward speed on straight lines, RC command
+    PARAM_MIN_SPEED: int = 25           # Speed through a gate followed by a U-turn, RC command
+    PARAM_BRAKE_DISTANCE: float = 2.0   # Distance to the next gate from which the speed decreases, in meters
+    PARAM_CARROT_DISTANCE: float = 1.5  # Distance to the next gate from which the carrot slides to the following one
+    PARAM_CARROT_MAX_SHIFT: float = 0.1     # Max shift of the carrot towards the following gate, ratio of the segment
+    PARAM_PASS_DISTANCE: float = 0.2    # Depth of the next gate below which it is passed, in meters
+    PARAM_PASS_RANGE: float = 1.0       # Max lateral distance to the next gate when it is passed, in meters
+    PARAM_MAX_COAST: float = 1.5        # Max time the plan is followed without any gate in view, in seconds
+    PARAM_GATE_MEMORY: float = 5.0      # Time a gate out of view is kept in the plan since last seen, in seconds
+    PARAM_KP_YAW: float = 1.0           # Yaw velocity per degree of bearing of the carrot
+    PARAM_SPEED_PER_RC: float = 0.01    # Velocity of the UAV per unit of RC command, in m/s (approximate)
+
+    gates: Dict[int, tuple] = {}        # Located gates : id -> (marker position, marker rotation or None if it is
+                                        #   predicted, point to reach, time last seen), in the frame of the last update
+    plan_ids: List[int] = []
+    plan_points: numpy.ndarray = numpy.zeros((0, 3))    # Points to reach in the body frame at the last update
+    passed_id: int = -1                 # Last gate passed
+    lap: int = 0
+    last_update_time: float = 0.0       # Time of the last detection with a gate in view (same clock as run())
+    last_run_time: float = 0.0
+    anchor_yaw: float = 0.0             # Yaw of the UAV at the last update, in degrees
+    heading: float = 0.0                # Yaw change since the last update, in radians
+    position: numpy.ndarray = numpy.zeros(3)    # Displacement since the last update, in the body frame at that time
+    speed: int = 0
+
+    @classmethod
+    def setup(cls):
+        CourseMap.setup()
+        cls.gates = {}
+        cls.plan_ids = []
+        cls.plan_points = numpy.zeros((0, 3))
+        cls.passed_id = -1
+        cls.lap = 0
+        cls.last_update_time = 0.0
+        cls.last_run_time = 0.0
+        cls.heading = 0.0
+        cls.position = numpy.zeros(3)
+        cls.speed = 0
+
+    @classmethod
+    def next_gate_id(cls) -> int:
+        """ Id of the gate to reach next, -1 if there is none yet """
+        return cls.plan_ids[0] if cls.plan_ids else -1
+
+    @classmethod
+    def update(cls, poses: Optional[MarkerPoses], detection_time: float, yaw: float):
+        """
+        Refreshes the plan with the marker poses of a new detection, detection_time being the decoding time of its
+        frame and yaw the yaw of the UAV at that time, in degrees
+        """
+        if poses is None or len(poses.ids) == 0:
+            return
+        CourseMap.learn(poses)
+        # Gates located in the previous frames, moved to the current body frame, then the gates in view
+        rotation = cls.__body_rotation(yaw)
+        cls.gates = {gate_id: ((position - cls.position) @ rotation.T,
+                               None if orientation is None else rotation @ orientation,
+                               (point - cls.position) @ rotation.T, seen_time)
+                     for gate_id, (position, orientation, point, seen_time) in cls.gates.items()
+                     if detection_time - seen_time < cls.PARAM_GATE_MEMORY}
+        for i, gate_id in enumerate(poses.ids.tolist()):
+            cls.gates[gate_id] = (poses.tvecs[i], poses.rotations[i], poses.gate_pts[i], detection_time)
+
+        first_id = cls.next_gate_id()
+        ids_after = [marker_id for marker_id in sorted(poses.ids.tolist()) if marker_id > cls.passed_id]
+        if first_id not in cls.gates:
+            # No plan yet, or the plan was lost : starts from the first gate in view after the last one passed
+            first_id = ids_after[0] if ids_after else int(poses.ids.min())
+        elif ids_after and (first_id < cls.passed_id or ids_after[0] < first_id):
+            # A gate in view comes before the planned one (e.g. a gate not seen yet during the first lap)
+            first_id = ids_after[0]
+        bases = {gate_id: (position, orientation)
+                 for gate_id, (position, orientation, _, _) in cls.gates.items() if orientation is not None}
+        plan_ids, plan_points = [], []
+        for gate_id in CourseMap.next_ids(first_id, cls.PARAM_LOOKAHEAD_GATES):
+            if gate_id not in cls.gates:
+                point = CourseMap.predict(gate_id, bases)
+                if point is None:
+                    break   # The following gates are planned once this one is located
+                cls.gates[gate_id] = (point, None, point, detection_time)
+            plan_ids.append(gate_id)
+            plan_points.append(cls.gates[gate_id][2])
+        cls.plan_ids = plan_ids
+        cls.plan_points = numpy.array(plan_points).reshape(-1, 3)
+        cls.anchor_yaw = yaw
+        cls.heading = 0.0
+        cls.position = numpy.zeros(3)
+        cls.last_update_time = detection_time
+        cls.last_run_time = max(cls.last_run_time, detection_time)
+
+    @classmethod
+    def run(cls, t: float, yaw: float) -> type(RCStatus):
+        """ Computes the RC commands at time t from the plan, yaw being the current yaw of the UAV in degrees """
+        cls.__dead_reckon(t)
+        if not cls.plan_ids or t - cls.last_update_time > cls.PARAM_MAX_COAST:
+            cls.speed = 0
+            return VisualControl.run(TargetTracker.LOST_TARGET, t)  # Smoothly stops the UAV
+        points = cls.__to_body_frame(cls.plan_points, yaw)
+        if points[0, 2] < cls.PARAM_PASS_DISTANCE and abs(points[0, 0]) < cls.PARAM_PASS_RANGE:
+            cls.__pass_gate()
+            points = points[1:]
+            if not cls.plan_ids:
+                cls.speed = 0
+                return VisualControl.run(TargetTracker.LOST_TARGET, t)
+
+        target = points[0, [0, 2]]
+        distance = float(numpy.hypot(*target))
+        carrot, turn = target, 0.0
+        if len(points) > 1:
+            segment = points[1, [0, 2]] - target
+            turn = abs(math.atan2(target[0] * segment[1] - target[1] * segment[0], target @ segment))
+            if distance < cls.PARAM_CARROT_DISTANCE:
+                carrot = target + cls.PARAM_CARROT_MAX_SHIFT * (1 - distance / cls.PARAM_CARROT_DISTANCE) * segment
+
+        # Feed-forward speed : cornering speed near the gate, depending on the turn angle, full speed far from it
+        corner_speed = cls.PARAM_MIN_SPEED + (cls.PARAM_MAX_SPEED - cls.PARAM_MIN_SPEED) * max(math.cos(turn), 0.0)
+        approach = min(distance / cls.PARAM_BRAKE_DISTANCE, 1.0)
+        cls.speed = int(corner_speed + (cls.PARAM_MAX_SPEED - corner_speed) * approach)
+
+        bearing = math.atan2(carrot[0], carrot[1])
+        RCStatus.set(a=int(cls.speed * math.sin(bearing)),      # left_right_velocity
+                     b=int(cls.speed * math.cos(bearing)),      # forward_backward_velocity
+                     c=0,                                       # up_down_velocity
+                     d=int(numpy.clip(cls.PARAM_KP_YAW * bearing * RAD2DEG, -100, 100)))   # yaw_velocity
+        VisualControl.lost_time = None
+        return RCStatus
+
+    @classmethod
+    def __pass_gate(cls):
+        if cls.plan_ids[0] < cls.passed_id:
+            # Back to the first gates : every gate of the course has been seen during the first lap
+            cls.lap += 1
+            CourseMap.learning = False
+        cls.passed_id = cls.plan_ids[0]
+        cls.plan_ids = cls.plan_ids[1:]
+        cls.plan_points = cls.plan_points[1:]
+
+    @classmethod
+    def __dead_reckon(cls, t: float):
+        """ Moves the UAV in the frame of the last update, at the velocity commanded since the last run """
+        dt = t - cls.last_run_time
+        cls.last_run_time = t
+        if dt <= 0 or dt > cls.PARAM_MAX_COAST:
+            return
+        command = RCStatus.command
+        vx = command.a * cls.PARAM_SPEED_PER_RC
+        vz = command.b * cls.PARAM_SPEED_PER_RC
+        cos_h, sin_h = math.cos(cls.heading), math.sin(cls.heading)
+        cls.position = cls.position + numpy.array([vx * cos_h + vz * sin_h, 0.0, -vx * sin_h + vz * cos_h]) * dt
+
+    @classmethod
+    def __body_rotation(cls, yaw: float) -> numpy.ndarray:
+        """ Returns the rotation from the body frame of the last update to the current body frame of the UAV """
+        cls.heading = ((yaw - cls.anchor_yaw + 180) % 360 - 180) * DEG2RAD
+        cos_h, sin_h = math.cos(cls.heading), math.sin(cls.heading)
+        return numpy.array([[cos_h, 0.0, -sin_h],
+                            [0.0, 1.0, 0.0],
+                            [sin_h, 0.0, cos_h]])
+
+    @classmethod
+    def __to_body_frame(cls, points: numpy.ndarray, yaw: float) -> numpy.ndarray:
+        """ Returns the points of the frame of the last update in the current body frame of the UAV """
+        return (points - cls.position) @ cls.__body_rotation(yaw).T
+
+    @classmethod
+    def __get_dict__(cls) -> dict:
+        planner: dict = {'Plan': f'lap {cls.lap} gates {cls.plan_ids} speed {cls.speed}'}
+        return planner
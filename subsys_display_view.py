@@ -1,50 +1,110 @@
 import numpy
 import pygame
-from parameters import RED, IMG_SIZE, SCREEN_SIZE
-from typing import Any
+from parameters import RED, IMG_SIZE, SCREEN_SIZE, FRAME_PIXEL_FORMAT
+from threading import Lock
+from typing import Any, Dict, List
 
 
 class Display:
     """
     Displays the frame acquired by the Tello camera and the marker detection results
     on a pygame window
+    The panel lines are rendered once per (title, value) and kept in a cache, and only the lines whose value changed
+    are redrawn. The areas drawn by run() are gathered as dirty rectangles, and update() only pushes them to the
+    window, instead of the whole screen.
+    The panel lines fill the columns of the panel from top to bottom, then from left to right, each line is clipped to
+    its column. The lines that do not fit in the panel are not drawn.
+    The frame and the overlay are written in persistent surfaces with a single copy each : the (height, width) frames
+    are transposed to the (width, height) layout of pygame by a view, without any copy nor surface allocation.
+    The grayscale frames are written in an 8-bit surface with a gray palette, the BGR frames are read in reverse
+    channel order.
     """
     # Parameters
     SCREEN: pygame.Surface = None
 
     LEFT_MARGIN: int = 5
     TOP_MARGIN: int = 0
-    INTER_LINE: int = 20
+    INTER_LINE: int = 16
+    COLUMN_WIDTH: int = 240
 
     FONT_PANEL_INFO: pygame.font.Font = None
+    FONT_SIZE: int = 14
+    TEXT_CACHE_SIZE: int = 1024     # Max number of rendered panel lines kept
 
     # global Variables
     pos_img_in_screen: tuple = (0, 0)
     current_line: int = TOP_MARGIN
+    current_column: int = 0
     log_dict: dict = {}
+    text_cache: Dict[tuple, pygame.Surface] = {}
+    img_rect: pygame.Rect = None
+    frame_surface: pygame.Surface = None
+    overlay_surface: pygame.Surface = None
+    dirty_rects: List[pygame.Rect] = []
+    lock: Lock = Lock()             # run() draws in the render thread, update() is called by the pygame loop
 
     @classmethod
     def setup(cls):
         # Init pygame
         pygame.init()
         pygame.font.init()
-        cls.FONT_PANEL_INFO = pygame.font.Font('freesansbold.ttf', 18)
+        cls.FONT_PANEL_INFO = pygame.font.Font('freesansbold.ttf', cls.FONT_SIZE)
 
         # create pygame screen
         shift_left = SCREEN_SIZE[0] - IMG_SIZE[0]
         cls.pos_img_in_screen = (shift_left, 0)
+        cls.img_rect = pygame.Rect(cls.pos_img_in_screen, IMG_SIZE)
         cls.SCREEN = pygame.display.set_mode(SCREEN_SIZE)
+        cls.SCREEN.fill([0, 0, 0])
+        cls.log_dict = {}
+        cls.current_line = cls.TOP_MARGIN
+        cls.current_column = 0
+        cls.text_cache = {}
+        cls.dirty_rects = [cls.SCREEN.get_rect()]
+        cls.frame_surface = None
+        cls.overlay_surface = None
 
     @classmethod
-    def run(cls, frame: numpy.ndarray, variables_dict: dict):
-        cls.SCREEN.fill([0, 0, 0])
+    def run(cls, frame: numpy.ndarray, overlay: numpy.ndarray, variables_dict: dict):
+        """
+        Displays the frame with the overlay layer on top of it (black overlay pixels are transparent)
+        """
         for key in variables_dict:
             cls._log(f"{key}: ", f"{variables_dict[key]}")
-        frame = numpy.rot90(frame)
-        frame = numpy.flipud(frame)
-        frame = pygame.surfarray.make_surface(frame)
-        cls._update_log()
-        cls.SCREEN.blit(frame, cls.pos_img_in_screen)
+        if FRAME_PIXEL_FORMAT == 'bgr24':
+            frame = frame[..., ::-1]
+        frame_surface = cls._get_surface('frame_surface', frame)
+        pygame.surfarray.blit_array(frame_surface, frame.swapaxes(0, 1))
+        overlay_surface = cls._get_surface('overlay_surface', overlay)
+        pygame.surfarray.blit_array(overlay_surface, overlay.swapaxes(0, 1))
+        with cls.lock:
+            cls._update_log()
+            cls.SCREEN.blit(frame_surface, cls.pos_img_in_screen)
+            cls.SCREEN.blit(overlay_surface, cls.pos_img_in_screen)
+            cls.dirty_rects.append(cls.img_rect)
+
+    @classmethod
+    def _get_surface(cls, name: str, image: numpy.ndarray) -> pygame.Surface:
+        """ Returns the persistent surface name, (re)created when the size or the number of channels of image change """
+        surface = getattr(cls, name)
+        size = (image.shape[1], image.shape[0])
+        depth = 8 if image.ndim == 2 else 24
+        if surface is None or surface.get_size() != size or surface.get_bitsize() != depth:
+            surface = pygame.Surface(size, depth=depth)
+            if depth == 8:
+                surface.set_palette([(level, level, level) for level in range(256)])
+            if name == 'overlay_surface':
+                surface.set_colorkey((0, 0, 0))     # Black overlay pixels are transparent
+            setattr(cls, name, surface)
+        return surface
+
+    @classmethod
+    def update(cls):
+        """ Pushes the areas drawn since the last update to the pygame window """
+        with cls.lock:
+            if cls.dirty_rects:
+                pygame.display.update(cls.dirty_rects)
+                cls.dirty_rects = []
 
     @classmethod
     def _log(cls, title: str, value: Any):
@@ -53,13 +113,45 @@ class Display:
             cls.log_dict[title]['value'] = value
         else:
             next_line = cls.current_line + cls.INTER_LINE
-            position = (cls.LEFT_MARGIN, next_line)
-            cls.log_dict[title] = {"pos": position, 'value': value}
+            if next_line + cls.INTER_LINE > cls.SCREEN.get_height():
+                # Next column
+                cls.current_column += 1
+                next_line = cls.TOP_MARGIN + cls.INTER_LINE
+            position = (cls.LEFT_MARGIN + cls.current_column * cls.COLUMN_WIDTH, next_line)
+            visible = position[0] + cls.COLUMN_WIDTH - cls.LEFT_MARGIN <= cls.pos_img_in_screen[0]
+            if not visible:
+                print('Display | No room left in the panel for', title)
+            cls.log_dict[title] = {"pos": position, 'title': title, 'value': value, 'drawn': None, 'rect': None,
+                                   'visible': visible}
             cls.current_line = next_line
 
     @classmethod
     def _update_log(cls):
-        for title, item in cls.log_dict.items():
-            text = f"{title} {item['value']}"
-            panel_info = cls.FONT_PANEL_INFO.render(text, True, RED)
-            cls.SCREEN.blit(panel_info, item['pos'])
+        changed = [item for item in cls.log_dict.values() if item['value'] != item['drawn'] and item['visible']]
+        # Clears the previous values, then redraws the changed lines and the ones they overlap (the text is higher
+        # than INTER_LINE), in the same order as a full redraw
+        cleared = [item['rect'] for item in changed if item['rect'] is not None]
+        for rect in cleared:
+            cls.SCREEN.fill([0, 0, 0], rect)
+        for item in cls.log_dict.values():
+            if item['value'] == item['drawn'] and (item['rect'] is None or item['rect'].collidelist(cleared) == -1):
+                continue
+            if not item['visible']:
+                continue
+            panel_info = cls._render(item['title'], item['value'])
+            rect = panel_info.get_rect(topleft=item['pos'])
+            rect.width = min(rect.width, cls.COLUMN_WIDTH - cls.LEFT_MARGIN)
+            cls.SCREEN.blit(panel_info, item['pos'], area=pygame.Rect((0, 0), rect.size))
+            cls.dirty_rects.append(rect if item['rect'] is None else rect.union(item['rect']))
+            item['drawn'] = item['value']
+            item['rect'] = rect
+
+    @classmethod
+    def _render(cls, title: str, value: str) -> pygame.Surface:
+        key = (title, value)
+        panel_info = cls.text_cache.get(key)
+        if panel_info is None:
+            if len(cls.text_cache) >= cls.TEXT_CACHE_SIZE:
+                cls.text_cache.clear()
+            panel_info = cls.text_cache[key] = cls.FONT_PANEL_INFO.render(f"{title} {value}", True, RED)
+        return panel_info
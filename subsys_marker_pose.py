@@ -0,0 +1,222 @@
+import glob
+import json
+import math
+import os
+import sys
+import time
+from typing import Dict, List, NamedTuple
+
+import cv2
+import numpy
+
+from parameters import IMG_SIZE, DEG2RAD, CAMERA_CALIBRATION_FILE, MARKER_SIZE, Angle
+from subsys_select_target_marker import MarkerStatus
+
+
+class CameraCalibration:
+    """
+    Intrinsics of the Tello camera : camera matrix and distortion coefficients, stored in CAMERA_CALIBRATION_FILE
+    for the resolution of the calibration images, and scaled to the processed frame size (IMG_SIZE) when loaded.
+    Without calibration file, a distortion-free camera with the nominal field of view of the Tello is assumed.
+    Calibrate with the frames of a printed chessboard seen from various angles :
+        python subsys_marker_pose.py calibrate "calibration/*.png"
+    """
+    PARAM_NOMINAL_HFOV: float = 82.6            # Horizontal field of view of the Tello camera, in degrees
+    PARAM_NOMINAL_SIZE: tuple = (960, 720)      # Resolution of the Tello camera
+    PARAM_BOARD_SIZE: tuple = (9, 6)            # Number of inner corners of the chessboard, per row and column
+    PARAM_SQUARE_SIZE: float = 0.025            # Side of a chessboard square, in meters
+
+    camera_matrix: numpy.ndarray = None         # For frames of IMG_SIZE
+    dist_coeffs: numpy.ndarray = numpy.zeros(5)
+    calibrated: bool = False
+
+    @classmethod
+    def setup(cls, path: str = CAMERA_CALIBRATION_FILE, frame_size: tuple = IMG_SIZE):
+        if os.path.exists(path):
+            with open(path) as calibration_file:
+                calibration = json.load(calibration_file)
+            camera_matrix = numpy.array(calibration['camera_matrix'], dtype=float)
+            cls.dist_coeffs = numpy.array(calibration['dist_coeffs'], dtype=float).ravel()
+            calibration_size = tuple(calibration['image_size'])
+            cls.calibrated = True
+            print('CameraCalibration | Loaded', path)
+        else:
+            width, height = cls.PARAM_NOMINAL_SIZE
+            focal = width / 2 / math.tan(cls.PARAM_NOMINAL_HFOV * DEG2RAD / 2)
+            camera_matrix = numpy.array([[focal, 0.0, width / 2],
+                                         [0.0, focal, height / 2],
+                                         [0.0, 0.0, 1.0]])
+            cls.dist_coeffs = numpy.zeros(5)
+            calibration_size = cls.PARAM_NOMINAL_SIZE
+            cls.calibrated = False
+            print('CameraCalibration | No calibration file, nominal intrinsics are used')
+        # The frames are resized to frame_size : the focal lengths and the principal point scale with them
+        scale = numpy.array([frame_size[0] / calibration_size[0], frame_size[1] / calibration_size[1], 1.0])
+        cls.camera_matrix = camera_matrix * scale[:, numpy.newaxis]
+
+    @classmethod
+    def calibrate(cls, image_paths: List[str], path: str = CAMERA_CALIBRATION_FILE) -> float:
+        """ Calibrates the camera from chessboard images, saves the result in path and returns the RMS error """
+        board_points = numpy.zeros((cls.PARAM_BOARD_SIZE[0] * cls.PARAM_BOARD_SIZE[1], 3), numpy.float32)
+        board_points[:, :2] = numpy.mgrid[0:cls.PARAM_BOARD_SIZE[0],
+                                          0:cls.PARAM_BOARD_SIZE[1]].T.reshape(-1, 2) * cls.PARAM_SQUARE_SIZE
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+        object_points, image_points = [], []
+        image_size = None
+        for image_path in image_paths:
+            gray = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+            if gray is None:
+                continue
+            image_size = gray.shape[::-1]
+            found, corners = cv2.findChessboardCorners(gray, cls.PARAM_BOARD_SIZE)
+            if not found:
+                print('CameraCalibration | No chessboard in', image_path)
+                continue
+            object_points.append(board_points)
+            image_points.append(cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria))
+        if len(image_points) < 3:
+            raise ValueError(f'At least 3 chessboard images are needed, {len(image_points)} found')
+        rms, camera_matrix, dist_coeffs, _, _ = cv2.calibrateCamera(object_points, image_points, image_size,
+                                                                    None, None)
+        with open(path, 'w') as calibration_file:
+            json.dump({'image_size': list(image_size),
+                       'camera_matrix': camera_matrix.tolist(),
+                       'dist_coeffs': dist_coeffs.ravel().tolist(),
+                       'rms': rms}, calibration_file, indent=2)
+        return rms
+
+
+class MarkerPoses(NamedTuple):
+    """
+    Pose of N markers in the camera frame (x right, y down, z forward), one row per marker
+    """
+    ids: numpy.ndarray          # (N,)
+    rvecs: numpy.ndarray        # (N, 3) Rotation vectors, marker frame -> camera frame
+    rotations: numpy.ndarray    # (N, 3, 3) Rotation matrices, marker frame -> camera frame
+    tvecs: numpy.ndarray        # (N, 3) Position of the marker centers, in meters
+    ranges: numpy.ndarray       # (N,) Distance to the marker centers, in meters
+    bearings: numpy.ndarray     # (N,) Horizontal angle of the marker centers from the camera axis (right > 0), rad
+    elevations: numpy.ndarray   # (N,) Vertical angle of the marker centers from the camera axis (up > 0), rad
+    gate_yaws: numpy.ndarray    # (N,) Horizontal angle of the marker normal, 0 when it faces the camera, > 0 when it
+                                #      faces the right of the camera, rad
+    gate_pts: numpy.ndarray     # (N, 3) Position of the points to reach (marker centers with the offset), in meters
+    cached: numpy.ndarray       # (N,) True if the pose was reused from a previous frame
+
+
+class MarkerPoseEstimator:
+    """
+    Estimates the 6-DoF pose of every detected marker of known side MARKER_SIZE, with the camera intrinsics of
+    CameraCalibration : metric range, bearing and orientation of the gates, independent from the image size.
+    The corners of all the markers are undistorted in a single call, then each marker is solved on normalized image
+    coordinates by the iterative solver (the planar solvers IPPE and IPPE_SQUARE of OpenCV 5.0 return wrong poses for
+    many views).
+    The poses are cached per marker id : while a marker stays in view and its corners move by less than
+    PARAM_CACHE_TOLERANCE pixels, its pose is reused without solving. Otherwise, the solver starts from the cached
+    pose, which is faster and keeps the orientation consistent with the previous frames (the pose of a small marker
+    is ambiguous).
+    """
+    PARAM_CACHE_TOLERANCE: float = 0.5  # Max corner motion for which a cached pose is reused, in pixels
+    PARAM_CACHE_TTL: float = 0.5        # Time after which a marker out of view is removed from the cache, in seconds
+
+    marker_size: float = MARKER_SIZE
+    object_points: numpy.ndarray = None
+    cache: Dict[int, tuple] = {}        # id -> (corners, rvec, tvec, last seen time)
+    poses: MarkerPoses = None           # Poses of the markers of the last frame, None if there is none
+    solved: int = 0
+    reused: int = 0
+
+    @classmethod
+    def setup(cls, marker_size: float = MARKER_SIZE):
+        CameraCalibration.setup()
+        cls.marker_size = marker_size
+        half = marker_size / 2
+        # Corners in the order of the ARUCO detector (top-left, top-right, bottom-right, bottom-left), z = 0
+        cls.object_points = numpy.array([[-half, half, 0.0],
+                                         [half, half, 0.0],
+                                         [half, -half, 0.0],
+                                         [-half, -half, 0.0]])
+        cls.cache = {}
+        cls.poses = None
+
+    @classmethod
+    def run(cls, ids: numpy.ndarray, corners: numpy.ndarray, offset: tuple = (0, 0)) -> MarkerPoses:
+        """
+        Estimates the poses of N markers from their ids (N,) and corners (N, 4, 2) in pixels, then fills the pose of
+        the target marker in MarkerStatus. offset is the (x, y) shift of the point to reach, in ratios of the marker
+        side, as for SelectTargetMarker
+        """
+        now = time.perf_counter()
+        n_markers = len(ids)
+        rvecs = numpy.zeros((n_markers, 3))
+        tvecs = numpy.zeros((n_markers, 3))
+        cached = numpy.zeros(n_markers, dtype=bool)
+        normalized = cv2.undistortPoints(corners.reshape(-1, 1, 2).astype(numpy.float64),
+                                         CameraCalibration.camera_matrix,
+                                         CameraCalibration.dist_coeffs).reshape(n_markers, 4, 2)
+        for i, marker_id in enumerate(ids.tolist()):
+            entry = cls.cache.get(marker_id)
+            if entry is not None and numpy.abs(corners[i] - entry[0]).max() < cls.PARAM_CACHE_TOLERANCE:
+                rvecs[i], tvecs[i] = entry[1], entry[2]
+                cached[i] = True
+                cls.reused += 1
+            else:
+                rvecs[i], tvecs[i] = cls.__solve(normalized[i], entry)
+                cls.solved += 1
+            cls.cache[marker_id] = (corners[i].copy(), rvecs[i].copy(), tvecs[i].copy(), now)
+        for marker_id in [key for key, entry in cls.cache.items() if now - entry[3] > cls.PARAM_CACHE_TTL]:
+            del cls.cache[marker_id]
+
+        x, y, z = tvecs[:, 0], tvecs[:, 1], tvecs[:, 2]
+        # Axes of the marker frames in the camera frame : columns of the rotation matrices
+        rotations = numpy.array([cv2.Rodrigues(rvec)[0] for rvec in rvecs]).reshape(n_markers, 3, 3)
+        normals = rotations[:, :, 2]
+        # The offset is along the marker sides : x to the right, y downwards on screen (upwards in the marker frame)
+        gate_pts = tvecs + cls.marker_size * (offset[0] * rotations[:, :, 0] - offset[1] * rotations[:, :, 1])
+        cls.poses = MarkerPoses(ids, rvecs, rotations, tvecs,
+                                ranges=numpy.sqrt(x ** 2 + y ** 2 + z ** 2),
+                                bearings=numpy.arctan2(x, z),
+                                elevations=numpy.arctan2(-y, numpy.hypot(x, z)),
+                                gate_yaws=numpy.arctan2(normals[:, 0], -normals[:, 2]),
+                                gate_pts=gate_pts,
+                                cached=cached)
+        cls.update_status()
+        return cls.poses
+
+    @classmethod
+    def update_status(cls):
+        """ Copies the pose of the target marker selected by SelectTargetMarker in MarkerStatus """
+        matches = numpy.flatnonzero(cls.poses.ids == MarkerStatus.id)
+        if len(matches) == 0:
+            return
+        i = matches[0]
+        MarkerStatus.range = float(cls.poses.ranges[i])
+        MarkerStatus.bearing = Angle(float(cls.poses.bearings[i]))
+        MarkerStatus.elevation = Angle(float(cls.poses.elevations[i]))
+        MarkerStatus.gate_yaw = Angle(float(cls.poses.gate_yaws[i]))
+        MarkerStatus.gate_pos = tuple(cls.poses.gate_pts[i].tolist())
+
+    @classmethod
+    def __solve(cls, normalized_corners: numpy.ndarray, entry: tuple) -> (numpy.ndarray, numpy.ndarray):
+        if entry is not None:
+            # Starts from the previous pose of the marker : faster, and consistent with the previous frames
+            _, rvec, tvec = cv2.solvePnP(cls.object_points, normalized_corners, numpy.eye(3), None,
+                                         entry[1].copy(), entry[2].copy(), useExtrinsicGuess=True,
+                                         flags=cv2.SOLVEPNP_ITERATIVE)
+            if numpy.isfinite(tvec).all() and tvec[2] > 0:
+                return rvec.ravel(), tvec.ravel()
+        _, rvec, tvec = cv2.solvePnP(cls.object_points, normalized_corners, numpy.eye(3), None,
+                                     flags=cv2.SOLVEPNP_ITERATIVE)
+        return rvec.ravel(), tvec.ravel()
+
+    @classmethod
+    def __get_dict__(cls) -> dict:
+        pose: dict = {'Poses': f'solved {cls.solved} cached {cls.reused}'}
+        return pose
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == 'calibrate':
+        rms_error = CameraCalibration.calibrate(sorted(glob.glob(sys.argv[2])))
+        print(f'CameraCalibration | Saved in {CAMERA_CALIBRATION_FILE}, RMS reprojection error {rms_error:.3f} px')
+    else:
+        print('Usage : python subsys_marker_pose.py calibrate "<chessboard images pattern>"')
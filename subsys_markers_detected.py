@@ -1,7 +1,12 @@
+import multiprocessing
+import time
+from multiprocessing.shared_memory import SharedMemory
+from queue import Queue, Empty
+
 import cv2
 import numpy
-from parameters import ScreenPosition
-from typing import List
+from parameters import ScreenPosition, FRAME_PIXEL_FORMAT
+from typing import List, Optional
 
 
 class DetectedMarkersStatus:
@@ -16,27 +21,398 @@ class MarkersDetector:
     """
     Detects every marker on the frame coming from the Tello front camera,
     then returns a single DetectedMarkersStatus class containing data for all detected markers
+
+    The ARUCO detector is built once in setup() and reused for every frame, as well as the grayscale buffer.
+    The markers are drawn in the overlay layer (black pixels are transparent), so the source frame is never copied
+    nor modified. Each detection gets its own overlay, since the stages displaying it can lag behind the detection;
+    when no marker is detected, a shared read-only empty overlay is returned instead.
     """
     PARAM_DRAW_MARKERS: bool = True
 
+    # Detection parameters, applied by setup()
+    PARAM_DICTIONARY: int = cv2.aruco.DICT_4X4_100
+    # Adaptive thresholding : fewer window sizes (larger step) means fewer thresholding passes
+    PARAM_ADAPTIVE_THRESH_WIN_SIZE_MIN: int = 3
+    PARAM_ADAPTIVE_THRESH_WIN_SIZE_MAX: int = 23
+    PARAM_ADAPTIVE_THRESH_WIN_SIZE_STEP: int = 10
+    # cv2.aruco.CORNER_REFINE_NONE / CORNER_REFINE_SUBPIX / CORNER_REFINE_CONTOUR
+    PARAM_CORNER_REFINEMENT: int = cv2.aruco.CORNER_REFINE_NONE
+    # Markers with a perimeter smaller than this ratio of the largest frame dimension are not searched
+    PARAM_MIN_MARKER_PERIMETER_RATE: float = 0.03
+
+    # Tracking mode : the markers are first searched in a region of interest around the predicted position
+    # of the target marker, the full frame is scanned only when the target is lost or every FULL_SCAN_PERIOD frames
+    PARAM_TRACKING: bool = False
+    PARAM_ROI_PADDING: float = 0.5          # Padding added around the predicted marker, ratio of its size
+    PARAM_ROI_MIN_SIZE: int = 64            # Minimum width and height of the region of interest, in pixels
+    PARAM_FULL_SCAN_PERIOD: int = 10        # Max number of successive frames searched in the region of interest
+
+    # Pyramid mode : the full frame scans start on a frame downscaled PYRAMID_LEVELS times by 2, then the next finer
+    # levels are tried until markers are found. The corners found on a downscaled level are rescaled and refined on
+    # the full resolution frame, in a small window around each corner only. The full resolution frame is only searched
+    # when no downscaled level finds a marker, or every PYRAMID_FULL_SCAN_PERIOD scans with the markers already found
+    # masked out, for the small (far) markers that the downscaled levels cannot resolve. 0 disables the pyramid mode.
+    PARAM_PYRAMID_LEVELS: int = 0
+    PARAM_PYRAMID_FULL_SCAN_PERIOD: int = 10
+    PARAM_PYRAMID_MASK_MARGIN: float = 0.25  # Margin masked around the markers found, ratio of their size
+    PARAM_PYRAMID_REFINE_CRITERIA: tuple = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 10, 0.1)
+
+    GRAY_CONVERSIONS: dict = {'rgb24': cv2.COLOR_RGB2GRAY,
+                              'bgr24': cv2.COLOR_BGR2GRAY,
+                              'gray': None}
+
+    detect_markers = None
+    gray_conversion: int = None
+    gray: numpy.ndarray = None
+    empty_overlay: numpy.ndarray = None     # Read-only, shared by all the detections without marker
+
+    # Tracking variables
+    previous_target_center: numpy.ndarray = None
+    frames_since_full_scan: int = 0
+    roi: tuple = None       # (x0, y0, x1, y1) region searched in the last frame, None for a full scan
+
+    # Pyramid variables
+    pyramid_buffers: dict = {}      # Downscaled grayscale frames, by level
+    masked_gray: numpy.ndarray = None   # Full resolution frame with the markers found on the coarse levels masked out
+    scans_since_full_resolution: int = 0    # Pyramid scans answered by a downscaled level since the last level 0 scan
+    level_timings: dict = {}        # Detection time in ms of each level searched during the last full scan
+
+    @classmethod
+    def setup(cls, pixel_format: str = FRAME_PIXEL_FORMAT):
+        cls.gray_conversion = cls.GRAY_CONVERSIONS[pixel_format]
+        cls.detect_markers = cls.create_detector()
+        cls.gray = None
+        cls.empty_overlay = None
+        cls.previous_target_center = None
+        cls.frames_since_full_scan = 0
+        cls.roi = None
+        cls.pyramid_buffers = {}
+        cls.level_timings = {}
+        cls.scans_since_full_resolution = 0
+
+    @classmethod
+    def create_detector(cls):
+        """ Returns a function that finds the markers in a grayscale image -> (corners, ids, rejected) """
+        if hasattr(cv2.aruco, 'ArucoDetector'):  # OpenCV >= 4.7
+            dictionary = cv2.aruco.getPredefinedDictionary(cls.PARAM_DICTIONARY)
+            parameters = cv2.aruco.DetectorParameters()
+        else:
+            dictionary = cv2.aruco.Dictionary_get(cls.PARAM_DICTIONARY)
+            parameters = cv2.aruco.DetectorParameters_create()
+        parameters.adaptiveThreshWinSizeMin = cls.PARAM_ADAPTIVE_THRESH_WIN_SIZE_MIN
+        parameters.adaptiveThreshWinSizeMax = cls.PARAM_ADAPTIVE_THRESH_WIN_SIZE_MAX
+        parameters.adaptiveThreshWinSizeStep = cls.PARAM_ADAPTIVE_THRESH_WIN_SIZE_STEP
+        parameters.cornerRefinementMethod = cls.PARAM_CORNER_REFINEMENT
+        parameters.minMarkerPerimeterRate = cls.PARAM_MIN_MARKER_PERIMETER_RATE
+
+        if hasattr(cv2.aruco, 'ArucoDetector'):
+            return cv2.aruco.ArucoDetector(dictionary, parameters).detectMarkers
+        return lambda gray: cv2.aruco.detectMarkers(gray, dictionary, parameters=parameters)
+
+    @classmethod
+    def run(cls, frame: numpy.ndarray, target_corners: List[ScreenPosition] = None) -> numpy.ndarray:
+        """
+        Returns the overlay layer on which the detected markers are drawn
+        target_corners are the corners of the target marker selected in the previous frame (MarkerStatus.corners),
+        used by the tracking mode to predict where to search first.
+        """
+        corners, ids = cls.detect(frame, target_corners)
+        return cls.publish(frame.shape[:2], corners, ids)
+
+    @classmethod
+    def detect(cls, frame: numpy.ndarray, target_corners: List[ScreenPosition] = None) -> (List[ScreenPosition],
+                                                                                            List[int]):
+        if cls.detect_markers is None:
+            cls.setup()
+        gray = cls.__to_gray(frame)
+        cls.roi = cls.__predict_roi(target_corners, gray.shape) if cls.PARAM_TRACKING else None
+        ids = None
+        if cls.roi is not None:
+            corners, ids = cls.__find_markers_in_roi(gray, cls.roi)
+            cls.frames_since_full_scan += 1
+        if ids is None:  # Target lost, or full scan requested
+            cls.roi = None
+            if cls.PARAM_PYRAMID_LEVELS > 0:
+                corners, ids = cls.__find_markers_in_pyramid(gray)
+            else:
+                corners, ids = cls.__find_markers(gray)
+            cls.frames_since_full_scan = 0
+        return corners, ids
+
     @classmethod
-    def run(cls, frame: numpy.ndarray) -> numpy.ndarray:
-        cp_frame = frame.copy()
-        corners, ids = cls.__find_markers(cp_frame)
-        if cls.PARAM_DRAW_MARKERS and ids is not None:
-            cls.__draw_markers(cp_frame, corners, ids)
+    def publish(cls, frame_size: tuple, corners: List[ScreenPosition], ids: List[int]) -> numpy.ndarray:
+        """ Updates DetectedMarkersStatus, then returns the overlay layer on which the markers are drawn """
+        if ids is not None:
+            # The target marker is drawn in it as well (see SelectTargetMarker)
+            overlay = numpy.zeros((frame_size[0], frame_size[1], 3), dtype=numpy.uint8)
+            if cls.PARAM_DRAW_MARKERS:
+                cls.__draw_markers(overlay, corners, ids)
+        else:
+            overlay = cls.__get_empty_overlay(frame_size)
         DetectedMarkersStatus.ids = ids
         DetectedMarkersStatus.corners = corners
-        return cp_frame
+        return overlay
+
+    @classmethod
+    def __to_gray(cls, frame: numpy.ndarray) -> numpy.ndarray:
+        if cls.gray_conversion is None:
+            return frame
+        if cls.gray is None or cls.gray.shape != frame.shape[:2]:
+            cls.gray = numpy.empty(frame.shape[:2], dtype=numpy.uint8)
+        return cv2.cvtColor(frame, cls.gray_conversion, dst=cls.gray)
+
+    @classmethod
+    def __get_empty_overlay(cls, size: tuple) -> numpy.ndarray:
+        if cls.empty_overlay is None or cls.empty_overlay.shape[:2] != size:
+            cls.empty_overlay = numpy.zeros((size[0], size[1], 3), dtype=numpy.uint8)
+            cls.empty_overlay.flags.writeable = False
+        return cls.empty_overlay
+
+    @classmethod
+    def __predict_roi(cls, target_corners: List[ScreenPosition], frame_size: tuple) -> tuple:
+        """
+        Predicts the position of the target marker in the current frame from its last position and velocity
+        (constant velocity between two frames), then returns the padded bounding box (x0, y0, x1, y1) to search in.
+        Returns None when a full scan of the frame is needed.
+        """
+        if target_corners is None or len(target_corners) == 0:
+            cls.previous_target_center = None
+            return None
+        target_corners = numpy.asarray(target_corners, dtype=numpy.float32).reshape(4, 2)
+        center = target_corners.mean(axis=0)
+        velocity = center - cls.previous_target_center if cls.previous_target_center is not None else 0
+        cls.previous_target_center = center
+        if cls.frames_since_full_scan >= cls.PARAM_FULL_SCAN_PERIOD:
+            return None
+
+        predicted_corners = target_corners + velocity
+        top_left = predicted_corners.min(axis=0)
+        bottom_right = predicted_corners.max(axis=0)
+        size = max(bottom_right - top_left)
+        padding = max(cls.PARAM_ROI_PADDING * size, (cls.PARAM_ROI_MIN_SIZE - size) / 2)
+        height, width = frame_size[:2]
+        x0 = int(max(top_left[0] - padding, 0))
+        y0 = int(max(top_left[1] - padding, 0))
+        x1 = int(min(bottom_right[0] + padding, width))
+        y1 = int(min(bottom_right[1] + padding, height))
+        if x1 - x0 < cls.PARAM_ROI_MIN_SIZE // 2 or y1 - y0 < cls.PARAM_ROI_MIN_SIZE // 2:
+            return None  # Predicted out of the frame
+        return x0, y0, x1, y1
+
+    @classmethod
+    def __find_markers_in_roi(cls, gray: numpy.ndarray, roi: tuple) -> (List[ScreenPosition], List[int]):
+        x0, y0, x1, y1 = roi
+        corners, ids = cls.__find_markers(gray[y0:y1, x0:x1])
+        for marker_corners in corners:
+            marker_corners += (x0, y0)  # Back to frame coordinates
+        return corners, ids
+
+    @classmethod
+    def __find_markers_in_pyramid(cls, gray: numpy.ndarray) -> (List[ScreenPosition], List[int]):
+        cls.level_timings = {}
+        height, width = gray.shape
+        coarse_corners, coarse_ids = (), None
+        for level in range(cls.PARAM_PYRAMID_LEVELS, 0, -1):
+            start_time = time.perf_counter()
+            scale = 2 ** level
+            size = (width // scale, height // scale)
+            buffer = cls.pyramid_buffers.get(level)
+            if buffer is None or buffer.shape[::-1] != size:
+                buffer = cls.pyramid_buffers[level] = numpy.empty(size[::-1], dtype=numpy.uint8)
+            cv2.resize(gray, size, dst=buffer, interpolation=cv2.INTER_AREA)
+            corners, ids = cls.__find_markers(buffer)
+            cls.level_timings[f'L{level}'] = 1000 * (time.perf_counter() - start_time)
+            if ids is not None:
+                start_time = time.perf_counter()
+                coarse_corners, coarse_ids = cls.__refine_corners(gray, corners, scale), ids
+                cls.level_timings['refine'] = 1000 * (time.perf_counter() - start_time)
+                break
+
+        if coarse_ids is not None:
+            cls.scans_since_full_resolution += 1
+            if cls.scans_since_full_resolution < cls.PARAM_PYRAMID_FULL_SCAN_PERIOD:
+                return coarse_corners, coarse_ids
+        cls.scans_since_full_resolution = 0
+
+        # The intermediate levels would only find markers that the full resolution level finds as well
+        start_time = time.perf_counter()
+        if coarse_ids is not None:
+            gray = cls.__mask_markers(gray, coarse_corners)
+        corners, ids = cls.__find_markers(gray)
+        cls.level_timings['L0'] = 1000 * (time.perf_counter() - start_time)
+        if coarse_ids is None:
+            return corners, ids
+        if ids is None:
+            return coarse_corners, coarse_ids
+        return tuple(coarse_corners) + tuple(corners), numpy.concatenate((coarse_ids, ids))
+
+    @classmethod
+    def __mask_markers(cls, gray: numpy.ndarray, corners: List[ScreenPosition]) -> numpy.ndarray:
+        """ Returns a copy of the frame where the markers and a margin around them are filled in white """
+        if cls.masked_gray is None or cls.masked_gray.shape != gray.shape:
+            cls.masked_gray = numpy.empty_like(gray)
+        numpy.copyto(cls.masked_gray, gray)
+        for marker_corners in corners:
+            marker_corners = marker_corners.reshape(4, 2)
+            center = marker_corners.mean(axis=0)
+            polygon = center + (1 + 2 * cls.PARAM_PYRAMID_MASK_MARGIN) * (marker_corners - center)
+            cv2.fillConvexPoly(cls.masked_gray, polygon.round().astype(numpy.int32), 255)
+        return cls.masked_gray
+
+    @classmethod
+    def __refine_corners(cls, gray: numpy.ndarray, corners: List[ScreenPosition],
+                         scale: int) -> List[ScreenPosition]:
+        """ Rescales the corners found on a downscaled level, then refines them on the full resolution frame """
+        points = numpy.concatenate(corners).reshape(-1, 1, 2).astype(numpy.float32)
+        points = (points + 0.5) * scale - 0.5  # Pixel centers of the downscaled level in full resolution
+        window = (scale + 1, scale + 1)        # Half size of the search window, covers the rescaling error
+        cv2.cornerSubPix(gray, points, window, (-1, -1), cls.PARAM_PYRAMID_REFINE_CRITERIA)
+        return tuple(points.reshape(-1, 1, 4, 2))
 
     @classmethod
-    def __find_markers(cls, frame: numpy.ndarray) -> (List[ScreenPosition], List[int]):
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        aruco_dict = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_100)
-        parameters = cv2.aruco.DetectorParameters_create()
-        corners, ids, _ = cv2.aruco.detectMarkers(gray, aruco_dict, parameters=parameters)
+    def __find_markers(cls, gray: numpy.ndarray) -> (List[ScreenPosition], List[int]):
+        corners, ids, _ = cls.detect_markers(gray)
         return corners, ids
 
+    @classmethod
+    def __get_dict__(cls) -> dict:
+        detector: dict = {'Search': 'ROI' if cls.roi is not None else 'FULL'}
+        if cls.PARAM_PYRAMID_LEVELS > 0:
+            detector['Levels ms'] = ' '.join(f'{level}:{duration:.1f}'
+                                             for level, duration in cls.level_timings.items())
+        return detector
+
     @classmethod
     def __draw_markers(cls, frame: numpy.ndarray, corners: List[ScreenPosition], ids: List[int]):
         cv2.aruco.drawDetectedMarkers(frame, corners, ids, borderColor=(100, 0, 240))
+
+
+def detection_worker(worker_index: int, shared_memory_name: str, frame_shape: tuple, pixel_format: str,
+                     detector_parameters: dict, tasks: multiprocessing.Queue, results: multiprocessing.Queue):
+    """
+    Detection loop run by each process of MarkersDetectorPool.
+    The frames are read from the shared memory block of the worker, the results are sent back as compact arrays :
+    (worker index, frame sequence number, corners (N, 4, 2) float32, ids (N,) int32)
+    """
+    shared_memory = SharedMemory(name=shared_memory_name)
+    frame = numpy.ndarray(frame_shape, dtype=numpy.uint8, buffer=shared_memory.buf)
+    for name, value in detector_parameters.items():
+        setattr(MarkersDetector, name, value)
+    MarkersDetector.setup(pixel_format)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            seq, target_corners = task
+            corners, ids = MarkersDetector.detect(frame, target_corners)
+            if ids is None:
+                results.put((worker_index, seq, MarkersDetectorPool.NO_CORNERS, MarkersDetectorPool.NO_IDS))
+            else:
+                results.put((worker_index, seq,
+                             numpy.concatenate(corners).reshape(-1, 4, 2).astype(numpy.float32),
+                             numpy.ravel(ids).astype(numpy.int32)))
+    finally:
+        del frame
+        shared_memory.close()
+
+
+class MarkersDetectorPool:
+    """
+    Runs MarkersDetector.detect() in worker processes, to escape the GIL of the main process.
+    Each worker owns a shared memory block holding the frame to process : the frames are copied once in it
+    instead of being pickled. The idle workers are handed the frames in round-robin order, so several frames
+    can be processed at the same time by different workers.
+    The workers are spawned, not forked : the main process already runs threads (asyncio loop, video decoder, SDL)
+    whose locks could be held forever in a forked child.
+    With several workers, each one only sees one frame out of n_workers, so the tracking mode, that predicts the
+    target position from the previous frame, is disabled in the workers.
+    """
+    NO_CORNERS: numpy.ndarray = numpy.empty((0, 4, 2), dtype=numpy.float32)
+    NO_IDS: numpy.ndarray = numpy.empty((0,), dtype=numpy.int32)
+    RESULT_TIMEOUT: float = 2.0  # Max waiting time for a worker to stop
+    START_METHOD: str = 'spawn'
+
+    n_workers: int = 0
+    workers: List[multiprocessing.Process] = []
+    shared_memories: List[SharedMemory] = []
+    frames: List[numpy.ndarray] = []
+    tasks: List[multiprocessing.Queue] = []
+    results: multiprocessing.Queue = None
+    idle_workers: Queue = None
+
+    @classmethod
+    def setup(cls, n_workers: int, frame_shape: tuple, pixel_format: str = FRAME_PIXEL_FORMAT):
+        cls.n_workers = n_workers
+        context = multiprocessing.get_context(cls.START_METHOD)
+        cls.results = context.Queue()
+        cls.idle_workers = Queue()
+        detector_parameters = {name: value for name, value in vars(MarkersDetector).items()
+                               if name.startswith('PARAM_')}
+        if n_workers > 1 and detector_parameters['PARAM_TRACKING']:
+            print('MarkersDetectorPool | Tracking mode disabled with several workers')
+            detector_parameters['PARAM_TRACKING'] = False
+        frame_size = int(numpy.prod(frame_shape))
+        for worker_index in range(n_workers):
+            shared_memory = SharedMemory(create=True, size=frame_size)
+            tasks = context.Queue()
+            worker = context.Process(target=detection_worker,
+                                     args=(worker_index, shared_memory.name, frame_shape, pixel_format,
+                                           detector_parameters, tasks, cls.results),
+                                     daemon=True)
+            worker.start()
+            cls.shared_memories.append(shared_memory)
+            cls.frames.append(numpy.ndarray(frame_shape, dtype=numpy.uint8, buffer=shared_memory.buf))
+            cls.tasks.append(tasks)
+            cls.workers.append(worker)
+            cls.idle_workers.put(worker_index)
+        print(f'MarkersDetectorPool | {n_workers} detection worker(s) started')
+
+    @classmethod
+    def acquire_worker(cls, timeout: float = None) -> Optional[int]:
+        """ Waits for an idle worker (the least recently used one), returns its index or None on timeout """
+        try:
+            return cls.idle_workers.get(timeout=timeout)
+        except Empty:
+            return None
+
+    @classmethod
+    def release_worker(cls, worker_index: int):
+        """ Gives back a worker acquired but not used """
+        cls.idle_workers.put(worker_index)
+
+    @classmethod
+    def submit(cls, worker_index: int, frame: numpy.ndarray, seq: int, target_corners: List[ScreenPosition] = None):
+        numpy.copyto(cls.frames[worker_index], frame)
+        if target_corners is not None and len(target_corners) == 0:
+            target_corners = None
+        cls.tasks[worker_index].put((seq, target_corners))
+
+    @classmethod
+    def get_result(cls, timeout: float = None) -> Optional[tuple]:
+        """
+        Returns the next detection result (seq, corners, ids), with corners and ids in the cv2.aruco format,
+        or None on timeout. Results may come out of order when several workers are running.
+        """
+        try:
+            worker_index, seq, corners, ids = cls.results.get(timeout=timeout)
+        except Empty:
+            return None
+        cls.idle_workers.put(worker_index)
+        if len(ids) == 0:
+            return seq, (), None
+        return seq, tuple(corners.reshape(-1, 1, 4, 2)), ids.reshape(-1, 1)
+
+    @classmethod
+    def stop(cls):
+        for tasks in cls.tasks:
+            tasks.put(None)
+        for worker in cls.workers:
+            worker.join(cls.RESULT_TIMEOUT)
+            if worker.is_alive():
+                worker.terminate()
+        cls.frames = []
+        for shared_memory in cls.shared_memories:
+            shared_memory.close()
+            shared_memory.unlink()
+        cls.workers, cls.shared_memories, cls.tasks = [], [], []
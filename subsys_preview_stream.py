@@ -0,0 +1,120 @@
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+import cv2
+import numpy
+
+from channels import LatestMailbox
+from parameters import FRAME_PIXEL_FORMAT
+
+
+class PreviewStream:
+    """
+    Serves the annotated frames as an MJPEG stream over HTTP, to watch a headless flight from a browser :
+    http://<companion computer>:<PREVIEW_PORT>/
+    run() is called by the preview stage of ImageProcess at a capped rate. It only composes and encodes a frame when
+    at least one viewer is connected, then hands the JPEG over to the viewers through a mailbox : a slow viewer only
+    skips frames, and neither the viewers nor the encoding can slow down the other stages.
+    """
+    PARAM_QUALITY: int = 70         # JPEG quality, from 0 to 100
+    PARAM_TIMEOUT: float = 1.0      # Max waiting time of a viewer for a new JPEG, so that a stop request is never missed
+    BOUNDARY: str = 'frame'
+
+    server: ThreadingHTTPServer = None
+    server_thread: Thread = None
+    jpegs: LatestMailbox = None
+    clients: int = 0
+    clients_lock: Lock = Lock()
+    sent_frames: int = 0
+    encode_ms: float = 0.0
+    stop_request: bool = False
+
+    @classmethod
+    def setup(cls, port: int, quality: int = PARAM_QUALITY):
+        cls.PARAM_QUALITY = quality
+        cls.jpegs = LatestMailbox()
+        cls.clients = 0
+        cls.sent_frames = 0
+        cls.stop_request = False
+        cls.server = ThreadingHTTPServer(('', port), _PreviewRequestHandler)
+        cls.server.daemon_threads = True
+        cls.server_thread = Thread(target=cls.server.serve_forever, daemon=True)
+        cls.server_thread.start()
+        print(f'PreviewStream | Serving the preview on http://localhost:{port}/')
+
+    @classmethod
+    def run(cls, frame: numpy.ndarray, overlay: numpy.ndarray):
+        """ Encodes the frame with the overlay layer on top of it, if anyone is watching """
+        if cls.server is None or cls.clients == 0:
+            return
+        start_time = time.perf_counter()
+        image = cls.__to_bgr(frame)
+        mask = overlay.any(axis=2)      # Black overlay pixels are transparent
+        image[mask] = overlay[mask][:, ::-1]
+        encoded, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, cls.PARAM_QUALITY])
+        if encoded:
+            cls.jpegs.put(jpeg.tobytes())
+        cls.encode_ms = 1000 * (time.perf_counter() - start_time)
+
+    @classmethod
+    def __to_bgr(cls, frame: numpy.ndarray) -> numpy.ndarray:
+        """ Returns a BGR copy of the frame, the frame itself is shared with the other stages """
+        if frame.ndim == 2:
+            return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+        if FRAME_PIXEL_FORMAT == 'bgr24':
+            return frame.copy()
+        return cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+
+    @classmethod
+    def serve(cls, handler: BaseHTTPRequestHandler):
+        """ Streams the JPEGs to a viewer until it disconnects """
+        handler.send_response(200)
+        handler.send_header('Content-Type', f'multipart/x-mixed-replace; boundary={cls.BOUNDARY}')
+        handler.send_header('Cache-Control', 'no-cache')
+        handler.end_headers()
+        with cls.clients_lock:
+            cls.clients += 1
+        last_seq = cls.jpegs.seq
+        try:
+            while not cls.stop_request:
+                slot = cls.jpegs.get(last_seq, timeout=cls.PARAM_TIMEOUT)
+                if slot is None:
+                    continue
+                last_seq, _, jpeg = slot
+                handler.wfile.write(f'--{cls.BOUNDARY}\r\nContent-Type: image/jpeg\r\n'
+                                    f'Content-Length: {len(jpeg)}\r\n\r\n'.encode())
+                handler.wfile.write(jpeg)
+                handler.wfile.write(b'\r\n')
+                cls.sent_frames += 1
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with cls.clients_lock:
+                cls.clients -= 1
+
+    @classmethod
+    def stop(cls):
+        if cls.server is not None:
+            cls.stop_request = True
+            cls.server.shutdown()
+            cls.server.server_close()
+            cls.server = None
+
+    @classmethod
+    def __get_dict__(cls) -> dict:
+        if cls.server is None:
+            return {}
+        preview: dict = {'Preview': f'viewers {cls.clients} sent {cls.sent_frames} encode {cls.encode_ms:.1f} ms'}
+        return preview
+
+
+class _PreviewRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/stream.mjpg'):
+            self.send_error(404)
+            return
+        PreviewStream.serve(self)
+
+    def log_message(self, format, *args):
+        pass    # No log line per request
@@ -1,6 +1,13 @@
-from parameters import RunStatus, RUN, MODE
+from parameters import RunStatus, RUN, MODE, FPS, INPUT_POLL_RATE, INPUT_DEADBAND, INPUT_SLEW_RATE, merge_dicts
+from subsys_display_view import Display
 from subsys_gamepad import Gamepad
-from typing import List
+from metrics import CpuUsage
+from scheduler import FixedRateTimer
+from threading import Lock, Thread
+from typing import Dict, List, NamedTuple
+import math
+import os
+import time
 import pygame
 
 
@@ -13,6 +20,15 @@ class KeyStatus:
     type_pressed: int = None  # Index of the key
 
 
+class RCCommand(NamedTuple):
+    """ Velocity commands, with a version number incremented every time they change """
+    version: int
+    a: int  # Left / Right velocity
+    b: int  # Forward / Backward velocity
+    c: int  # Upward / Downward velocity
+    d: int  # Yaw velocity
+
+
 class RCStatus:
     """
     Contains the velocity commands that will be forwarded to the Tello
@@ -20,24 +36,40 @@ class RCStatus:
         b : Forward / Backward velocity
         c : Upward / Downward velocity
         d : Yaw rate
+    The commands are written by several threads (user inputs, control stage), so they are held in a single immutable
+    RCCommand replaced at once by set() : a reader of RCStatus.command always gets a consistent command, and compares
+    its version to know whether it changed.
     """
 
-    a: int = 0  # Left / Right velocity
-    b: int = 0  # Forward / Backward velocity
-    c: int = 0  # Upward / Downward velocity
-    d: int = 0  # Yaw velocity
+    command: RCCommand = RCCommand(0, 0, 0, 0, 0)
+    lock: Lock = Lock()     # Only serializes the writers
+
+    @classmethod
+    def set(cls, a: int = None, b: int = None, c: int = None, d: int = None) -> RCCommand:
+        """ Updates the given velocities, the other ones are kept """
+        with cls.lock:
+            command = cls.command
+            velocities = (command.a if a is None else int(a),
+                          command.b if b is None else int(b),
+                          command.c if c is None else int(c),
+                          command.d if d is None else int(d))
+            if velocities != command[1:]:
+                command = cls.command = RCCommand(command.version + 1, *velocities)
+        return command
 
     @classmethod
     def __get_dict__(cls) -> dict:
-        rc: dict = {'a': cls.a,
-                    'b': cls.b,
-                    'c': cls.c,
-                    'd': cls.d}
+        command = cls.command
+        rc: dict = {'a': command.a,
+                    'b': command.b,
+                    'c': command.c,
+                    'd': command.d}
         return rc
     
     @classmethod
     def toStr(cls):
-        return "rc " + str(cls.a) + " " + str(cls.b) + " " + str(cls.c) + " " + str(cls.d)
+        command = cls.command
+        return "rc " + str(command.a) + " " + str(command.b) + " " + str(command.c) + " " + str(command.d)
     
 
 class ModeStatus:
@@ -57,17 +89,35 @@ class ReadUserInput:
     """
     Handles the user inputs to manually control the Tello
     The controls are defined in the subsys_gamepad.py -> Gamepad class
+    The pygame loop presents the display at FPS. Between two presentations, it blocks on the event queue, so that the
+    inputs are handled as soon as they arrive, without spinning.
+    The events only update the stick and key positions (inputs, from -1 to 1). A poller thread samples them at
+    INPUT_POLL_RATE, applies the INPUT_DEADBAND around the center of the sticks, and moves the RC commands towards
+    them by INPUT_SLEW_RATE per second at most. It publishes the commands in one RCStatus.set(), except in automatic
+    flight, where it follows the commands of the automatic control instead.
     """
+    CHANNELS: Dict[str, int] = {'a': 0, 'b': 0, 'c': 1, 'd': 2}     # Index of the threshold of each RC channel
 
     joysticks: List[pygame.joystick.Joystick] = []
     joystick_maps: List[dict] = []
     rc_threshold: 3*[int] = [100, 100, 100]
+    inputs: Dict[str, float] = {channel: 0.0 for channel in CHANNELS}
+    poll_timer: FixedRateTimer = FixedRateTimer('Input', INPUT_POLL_RATE)
+    POLLER_STOP_TIMEOUT: float = 1.0    # Max waiting time for the poller to stop, in seconds
+    poller_thread: Thread = None
+    loop_timer: FixedRateTimer = FixedRateTimer('UI', FPS)
+    cpu_usage: CpuUsage = CpuUsage('UI')
 
     @classmethod
     def setup(cls,
               rc_roll_pitch_threshold: int = 100,
               rc_height_threshold: int = 20,
-              rc_yaw_threshold: int = 20) -> (type(RCStatus), type(KeyStatus), type(ModeStatus)):
+              rc_yaw_threshold: int = 20,
+              headless: bool = False) -> (type(RCStatus), type(KeyStatus), type(ModeStatus)):
+        if headless:
+            # No window : the pygame events are only needed for the joysticks
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
+            pygame.init()
         cls.rc_threshold = [rc_roll_pitch_threshold, rc_height_threshold, rc_yaw_threshold]
         RunStatus.value = RUN.START
         ModeStatus.value = -1
@@ -85,16 +135,65 @@ class ReadUserInput:
                 gp_map = [gp['name'] for gp in Gamepad.map_list].index('Default')
                 cls.joystick_maps.append(Gamepad.map_list[gp_map])
             joystick.init()
+        cls.inputs = {channel: 0.0 for channel in cls.CHANNELS}
+        cls.poller_thread = Thread(target=cls.run_input_poller, daemon=True)
+        cls.poller_thread.start()
 
     @classmethod
     def run_pygame_loop(cls):
-        while True:
-            for event in pygame.event.get():
-                cls.run(event)
-            pygame.display.update()
+        try:
+            while RunStatus.value != RUN.STOP:
+                cls.loop_timer.wait(sleep=cls.wait_events)
+                for event in pygame.event.get():
+                    cls.run(event)
+                Display.update()
+                cls.cpu_usage.update()
+        except KeyboardInterrupt:
+            # The only way to stop a headless run without joystick
+            RunStatus.value = RUN.STOP
+        return 1
+
+    @classmethod
+    def run_input_poller(cls):
+        rc = dict(zip(cls.CHANNELS, RCStatus.command[1:]))  # Rate-limited commands, not rounded
+        while RunStatus.value != RUN.STOP:
+            cls.poll_timer.wait()
             if RunStatus.value == RUN.STOP:
+                break   # Never overwrites the zero command set by Stop
+            if ModeStatus.value == MODE.AUTO_FLIGHT:
+                # Starts from the automatic control commands when the user takes over
+                rc = dict(zip(cls.CHANNELS, RCStatus.command[1:]))
+                continue
+            max_step = INPUT_SLEW_RATE * cls.poll_timer.period
+            for channel, threshold_index in cls.CHANNELS.items():
+                target = cls.rc_threshold[threshold_index] * cls.deadband(cls.inputs[channel])
+                rc[channel] += min(max(target - rc[channel], -max_step), max_step)
+            RCStatus.set(**{channel: round(value) for channel, value in rc.items()})
+
+    @staticmethod
+    def deadband(value: float) -> float:
+        """ Zeroes the values within INPUT_DEADBAND of 0, and rescales the other ones to start from 0 """
+        if abs(value) <= INPUT_DEADBAND:
+            return 0.0
+        return math.copysign((abs(value) - INPUT_DEADBAND) / (1 - INPUT_DEADBAND), value)
+
+    @classmethod
+    def wait_events(cls, delay: float):
+        """ Handles the events arriving in the next delay seconds """
+        deadline = time.perf_counter() + delay
+        while RunStatus.value != RUN.STOP:
+            timeout_ms = math.ceil(1000 * (deadline - time.perf_counter()))
+            if timeout_ms <= 0:
                 break
-        return 1
+            event = pygame.event.wait(timeout_ms)   # Never 0, that would wait forever
+            if event.type != pygame.NOEVENT:
+                cls.run(event)
+
+    @classmethod
+    def __get_dict__(cls) -> dict:
+        return merge_dicts([cls.loop_timer.__get_dict__(),
+                            cls.poll_timer.__get_dict__(),
+                            cls.cpu_usage.__get_dict__()])
 
     @classmethod
     def run(cls, event):
@@ -133,11 +232,12 @@ class ReadUserInput:
     @classmethod
     def buttons(cls, button: str, key_status: type(KeyStatus)):
         if button == 'Stop' and key_status.is_pressed:
-            RCStatus.a = 0
-            RCStatus.b = 0
-            RCStatus.c = 0
-            RCStatus.d = 0
+            cls.inputs = {channel: 0.0 for channel in cls.CHANNELS}
             RunStatus.value = RUN.STOP
+            # The input poller is stopped first, so that it cannot publish a command after the zero one
+            if cls.poller_thread is not None:
+                cls.poller_thread.join(cls.POLLER_STOP_TIMEOUT)
+            RCStatus.set(0, 0, 0, 0)        # Immediate, not rate-limited
         elif button == 'Emergency' and key_status.is_pressed:
             ModeStatus.value = MODE.EMERGENCY
         elif button == 'Takeoff' and key_status.is_pressed:
@@ -151,33 +251,33 @@ class ReadUserInput:
             print('User input detected, automatic control module disabled')
 
         if button == 'Left':
-            RCStatus.a = - key_status.is_pressed * int(cls.rc_threshold[0])
+            cls.inputs['a'] = - float(key_status.is_pressed)
         elif button == 'Right':
-            RCStatus.a = key_status.is_pressed * int(cls.rc_threshold[0])
+            cls.inputs['a'] = float(key_status.is_pressed)
         elif button == 'Forward':
-            RCStatus.b = key_status.is_pressed * int(cls.rc_threshold[0])
+            cls.inputs['b'] = float(key_status.is_pressed)
         elif button == 'Backward':
-            RCStatus.b = - key_status.is_pressed * int(cls.rc_threshold[0])
+            cls.inputs['b'] = - float(key_status.is_pressed)
         elif button == 'Up':
-            RCStatus.c = key_status.is_pressed * int(cls.rc_threshold[1])
+            cls.inputs['c'] = float(key_status.is_pressed)
         elif button == 'Down':
-            RCStatus.c = - key_status.is_pressed * int(cls.rc_threshold[1])
+            cls.inputs['c'] = - float(key_status.is_pressed)
         elif button == 'Yaw+':
-            RCStatus.d = key_status.is_pressed * int(cls.rc_threshold[2])
+            cls.inputs['d'] = float(key_status.is_pressed)
         elif button == 'Yaw-':
-            RCStatus.d = - key_status.is_pressed * int(cls.rc_threshold[2])
+            cls.inputs['d'] = - float(key_status.is_pressed)
 
     @classmethod
     def axis_motion(cls, axis: str, value: float):
         if axis == 'Roll':
-            RCStatus.a = int(cls.rc_threshold[0] * value)
+            cls.inputs['a'] = value
         elif axis == 'Pitch':
-            RCStatus.b = - int(cls.rc_threshold[0] * value)
+            cls.inputs['b'] = - value
         elif axis == 'Height':
-            RCStatus.c = - int(cls.rc_threshold[1] * value)
+            cls.inputs['c'] = - value
         elif axis == 'Yaw':
-            RCStatus.d = int(cls.rc_threshold[2] * value)
+            cls.inputs['d'] = value
         elif axis == 'Yaw+':
-            RCStatus.d = int(cls.rc_threshold[2] * 0.5 * (value + 1))
+            cls.inputs['d'] = 0.5 * (value + 1)
         elif axis == 'Yaw-':
-            RCStatus.d = int(cls.rc_threshold[2] * 0.5 * (value - 1))
+            cls.inputs['d'] = 0.5 * (value - 1)
@@ -0,0 +1,168 @@
+import os
+import time
+from typing import List, Optional
+
+import av
+import numpy
+
+from DJITelloPy.djitellopy.tello import Tello, BackgroundFrameRead
+from DJITelloPy.djitellopy.state import TelloState, StateHistory
+from subsys_telemetry import TelemetryRecorder
+
+
+class ReplayFrameRead(BackgroundFrameRead):
+    """
+    Plays back the video and the state packets of a flight recorded by TelemetryRecorder.
+    The recorded H.264 packets and state packets are merged in a single timeline and delivered in the order they were
+    received, with their recorded timestamps (frame_timestamp, TelloState.timestamp), so that every replay of a flight
+    feeds the pipeline with the same frames and states.
+    speed : 1.0 replays in real time (2.0 twice as fast, ...), 0 replays as fast as possible. In the latter case,
+    the replay waits until each frame has been taken by the consumer (frame_taken callable) before decoding the next one,
+    so that no frame is dropped.
+    """
+    FRAME_TAKEN_TIMEOUT: float = 1.0    # Maximum wait for a frame to be taken, in seconds
+
+    def __init__(self, flight_directory: str, flight: dict, state_callback, speed: float = 1.0, frame_taken=None,
+                 frame_update_callback=None, frame_size=None, pixel_format=None, ring_size=None):
+        self.flight = flight
+        self.state_callback = state_callback
+        self.speed = speed
+        self.frame_taken = frame_taken
+        self.video_path = os.path.join(flight_directory, TelemetryRecorder.VIDEO_FILE)
+        super().__init__(flight_directory, frame_update_callback,
+                         frame_size=frame_size, pixel_format=pixel_format, ring_size=ring_size)
+
+    def open_container(self):
+        # The recorded packets are decoded one by one, so that each frame gets the reception time of its packet
+        return av.CodecContext.create('h264', 'r')
+
+    def update_frame(self):
+        states = self.flight['state']
+        video = self.flight['video']
+        n_states = len(states)
+        packets = numpy.memmap(self.video_path, dtype=numpy.uint8, mode='r') if len(video) else None
+        offsets = numpy.concatenate(([0], numpy.cumsum(video['size'], dtype=numpy.int64)))
+        # Timeline of the states followed by the packets, sorted by time (states first on ties)
+        times = numpy.concatenate((states['t'], video['t']))
+        kinds = numpy.concatenate((numpy.zeros(n_states), numpy.ones(len(video))))
+        timeline = numpy.lexsort((kinds, times))
+
+        start_clock = time.perf_counter()
+        start_time = times[timeline[0]] if len(timeline) else 0.0
+        for i in timeline:
+            if self.stopped:
+                break
+            timestamp = float(times[i])
+            if self.speed > 0:
+                delay = start_clock + (timestamp - start_time) / self.speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            if i < n_states:
+                self.state_callback(states[i])
+                continue
+            j = i - n_states
+            try:
+                frames = self.container.decode(av.Packet(bytes(packets[offsets[j]:offsets[j + 1]])))
+            except av.error.InvalidDataError:
+                continue    # Packets recorded before the first key frame cannot be decoded
+            for frame in frames:
+                self.set_frame(frame, timestamp)
+                if self.frame_update_callback is not None:
+                    self.frame_update_callback()
+                if self.speed == 0 and self.frame_taken is not None:
+                    self.frame_taken(self.FRAME_TAKEN_TIMEOUT)
+        # End of the flight : the consumer sees the reader stopped at its next frame update
+        Tello.LOGGER.info('Replay finished')
+        self.stopped = True
+        if self.frame_update_callback is not None:
+            self.frame_update_callback()
+
+
+class ReplayTello:
+    """
+    Stands in for Tello to replay a flight recorded by TelemetryRecorder (ENV.REPLAY), without the simulator
+    or the drone. It has the methods of Tello used by the application : the recorded state packets are published
+    through get_state_snapshot(), get_state_history() and the state callbacks, the recorded video through
+    get_frame_read(). The flight commands are not sent anywhere, the last RC command is kept in rc.
+    The replay starts when play() is called, once the frame consumer is ready.
+    The recorded RC commands can be compared with the replayed ones in flight['rc'].
+    """
+    LOGGER = Tello.LOGGER
+
+    def __init__(self, flight_directory: str, speed: float = 1.0, image_received_method=None, frame_taken=None):
+        self.flight_directory = flight_directory
+        self.flight: dict = TelemetryRecorder.load(flight_directory)
+        self.speed = speed
+        self.update_frame_method = image_received_method
+        self.frame_taken = frame_taken
+        self.background_frame_read: Optional[ReplayFrameRead] = None
+        self.state_snapshot: Optional[TelloState] = None
+        self.state_history = StateHistory()
+        self.state_callbacks: List = []
+        self.rc: tuple = (0, 0, 0, 0)
+
+    def connect(self):
+        states = self.flight['state']
+        duration = states['t'][-1] - states['t'][0] if len(states) else 0.0
+        self.LOGGER.info("Replaying flight '{}' : {:.1f} s, {} state packets, {} video packets, speed {}".format(
+            self.flight_directory, duration, len(states), len(self.flight['video']), self.speed or 'max'))
+
+    def streamon(self):
+        pass
+
+    def streamoff(self):
+        pass
+
+    def takeoff(self):
+        self.LOGGER.info('Replay : takeoff')
+
+    def land(self):
+        self.LOGGER.info('Replay : land')
+
+    def emergency(self):
+        self.LOGGER.info('Replay : emergency')
+
+    def send_rc_control(self, left_right_velocity: int, forward_backward_velocity: int, up_down_velocity: int,
+                        yaw_velocity: int):
+        self.rc = (left_right_velocity, forward_backward_velocity, up_down_velocity, yaw_velocity)
+
+    def get_frame_read(self, frame_size=None, pixel_format=None, ring_size=None,
+                       packet_callback=None) -> ReplayFrameRead:
+        """ Same as Tello.get_frame_read(), the packet_callback is ignored since the stream is already recorded """
+        if self.background_frame_read is None:
+            self.background_frame_read = ReplayFrameRead(self.flight_directory, self.flight, self.receive_state,
+                                                         speed=self.speed,
+                                                         frame_taken=self.frame_taken,
+                                                         frame_update_callback=self.update_frame_method,
+                                                         frame_size=frame_size,
+                                                         pixel_format=pixel_format,
+                                                         ring_size=ring_size)
+        return self.background_frame_read
+
+    def play(self):
+        self.get_frame_read().start()
+
+    def receive_state(self, record: numpy.void):
+        """ Publishes a recorded state packet like AsyncTello does with a received one """
+        state = TelloState(int(record['seq']), float(record['t']), StateHistory.FIELDS)
+        for key in TelloState.INT_FIELDS:
+            setattr(state, key, int(record[key]))
+        for key in TelloState.FLOAT_FIELDS:
+            setattr(state, key, float(record[key]))
+        self.state_snapshot = state
+        self.state_history.append(state)
+        for callback in self.state_callbacks:
+            callback(state)
+
+    def get_state_snapshot(self) -> Optional[TelloState]:
+        return self.state_snapshot
+
+    def get_state_history(self) -> StateHistory:
+        return self.state_history
+
+    def add_state_callback(self, callback):
+        self.state_callbacks.append(callback)
+
+    def end(self):
+        if self.background_frame_read is not None:
+            self.background_frame_read.stop()
@@ -3,7 +3,8 @@ import numpy
 
 from parameters import RED, BLUE, RAD2DEG, DRONE_POS, Distance, Angle, ScreenPosition
 from subsys_markers_detected import DetectedMarkersStatus
-from typing import List
+from types import SimpleNamespace
+from typing import List, NamedTuple
 
 
 class MarkerStatus:
@@ -27,13 +28,21 @@ class MarkerStatus:
     h_angle: Angle = Angle(0)
     # Vertical angle
     v_angle: Angle = Angle(0)
-    # angle and distance between marker and drone
+    # Point to reach (center of the marker with the offset), angle and distance between this point and the drone
+    marker_pos: ScreenPosition = ScreenPosition((0, 0))
     m_angle: Angle = Angle(0)
     m_distance: Distance = Distance(0)
 
     height: Distance = Distance(0)
     width: Distance = Distance(0)
 
+    # Metric pose (see MarkerPoseEstimator), range is 0 when unknown
+    range: float = 0.0                  # Distance to the marker center, in meters
+    bearing: Angle = Angle(0)           # Horizontal and vertical angles of the marker center from the camera axis
+    elevation: Angle = Angle(0)
+    gate_yaw: Angle = Angle(0)          # Horizontal angle of the marker normal, 0 when it faces the camera
+    gate_pos: tuple = (0.0, 0.0, 0.0)   # Position of the point to reach in the camera frame, in meters
+
     @classmethod
     def reset(cls):
         cls.id = -1
@@ -45,10 +54,33 @@ class MarkerStatus:
         cls.right_pt = ScreenPosition((0, 0))
         cls.h_angle = Angle(0)
         cls.v_angle = Angle(0)
+        cls.marker_pos = ScreenPosition((0, 0))
         cls.m_angle = Angle(0)
         cls.m_distance = Distance(0)
         cls.height = Distance(0)
         cls.width = Distance(0)
+        cls.range = 0.0
+        cls.bearing = Angle(0)
+        cls.elevation = Angle(0)
+        cls.gate_yaw = Angle(0)
+        cls.gate_pos = (0.0, 0.0, 0.0)
+
+    @classmethod
+    def snapshot(cls) -> SimpleNamespace:
+        """
+        Returns a copy of the current status, with the same attributes, that can be handed over to another thread
+        while the next frame is being processed
+        """
+        return SimpleNamespace(id=cls.id, corners=cls.corners,
+                               center_pt=cls.center_pt,
+                               top_pt=cls.top_pt, bottom_pt=cls.bottom_pt,
+                               left_pt=cls.left_pt, right_pt=cls.right_pt,
+                               h_angle=cls.h_angle, v_angle=cls.v_angle,
+                               marker_pos=cls.marker_pos,
+                               m_angle=cls.m_angle, m_distance=cls.m_distance,
+                               height=cls.height, width=cls.width,
+                               range=cls.range, bearing=cls.bearing, elevation=cls.elevation,
+                               gate_yaw=cls.gate_yaw, gate_pos=cls.gate_pos)
 
     @classmethod
     def __get_dict__(cls) -> dict:
@@ -58,18 +90,55 @@ class MarkerStatus:
                     'm_angle': int(cls.m_angle * RAD2DEG),
                     'm_distance': cls.m_distance,
                     'm_height': cls.height,
-                    'm_width': cls.width}
+                    'm_width': cls.width,
+                    'range': f'{cls.range:.2f} m',
+                    'bearing': int(cls.bearing * RAD2DEG),
+                    'gate_yaw': int(cls.gate_yaw * RAD2DEG)}
         return ms
 
 
+class MarkersGeometry(NamedTuple):
+    """
+    Geometry of N markers, computed at once by SelectTargetMarker.compute_geometry() :
+    one row per marker, points are (x, y) integer screen positions, angles are in radians
+    """
+    ids: numpy.ndarray          # (N,)
+    corners: numpy.ndarray      # (N, 4, 2) float
+    centers: numpy.ndarray      # (N, 2)
+    left_pts: numpy.ndarray     # (N, 2) Vertical axis
+    right_pts: numpy.ndarray    # (N, 2)
+    bottom_pts: numpy.ndarray   # (N, 2) Horizontal axis
+    top_pts: numpy.ndarray      # (N, 2)
+    heights: numpy.ndarray      # (N,)
+    widths: numpy.ndarray       # (N,)
+    h_angles: numpy.ndarray     # (N,)
+    v_angles: numpy.ndarray     # (N,)
+    marker_pos: numpy.ndarray   # (N, 2) Centers with the offset
+    m_angles: numpy.ndarray     # (N,) Angle and distance between marker_pos and the drone
+    m_distances: numpy.ndarray  # (N,)
+
+
 class SelectTargetMarker:
     """
     Selects the marker to reach first from the list of markers detected by the Tello onboard camera,
     then returns the corresponding MarkerStatus class filled with the position of the Tello relatively
     to this marker
+    The geometry of all the detected markers is computed at once on their (N, 4, 2) corners array, so ranking several
+    candidate markers costs about the same as handling a single one. It is kept in geometry for the other subsystems.
+    The target is the marker with the smallest id, or the marker of preferred_id when it is in view (the next gate of
+    the course, see CoursePlanner).
     """
     marker_pos: ScreenPosition = (0.0, 0.0)
     offset: tuple = (0, 0)
+    geometry: MarkersGeometry = None    # Geometry of all the markers detected in the last frame, None if there is none
+    preferred_id: int = -1
+    DRONE_POS_ARRAY: numpy.ndarray = numpy.array(DRONE_POS)
+    # Weights of the corners [br, bl, tl, tr] in the center, left, right, bottom and top points of a marker
+    MIDPOINT_WEIGHTS: numpy.ndarray = numpy.array([[0.25, 0.25, 0.25, 0.25],
+                                                   [0.0, 0.5, 0.5, 0.0],
+                                                   [0.5, 0.0, 0.0, 0.5],
+                                                   [0.5, 0.5, 0.0, 0.0],
+                                                   [0.0, 0.0, 0.5, 0.5]])
 
     @classmethod
     def setup(cls):
@@ -79,101 +148,79 @@ class SelectTargetMarker:
     def run(cls, frame: numpy.ndarray, markers: type(DetectedMarkersStatus),
             offset: tuple = (0, 0)) -> type(MarkerStatus):
 
-        target_marker_id, corners = cls._get_marker_with_min_id(markers)
-        if target_marker_id == -1:
+        if markers.ids is None or len(markers.ids) == 0:
+            cls.geometry = None
             MarkerStatus.reset()
             return MarkerStatus
+        cls.geometry = geometry = cls.compute_geometry(numpy.ravel(markers.ids),
+                                                       numpy.concatenate(markers.corners).reshape(-1, 4, 2),
+                                                       offset)
+        # The marker to reach first is the preferred one, or the one with the smallest id
+        preferred = numpy.flatnonzero(geometry.ids == cls.preferred_id)
+        i = int(preferred[0]) if len(preferred) > 0 else int(numpy.argmin(geometry.ids))
 
-        br, bl, tl, tr = corners[0], corners[1], corners[2], corners[3]
-        center_pt = cls._get_midpoint([br, bl, tl, tr])
-        # get symmetry axes
-        left_pt = cls._get_midpoint([bl, tl])
-        right_pt = cls._get_midpoint([br, tr])
-        bottom_pt = cls._get_midpoint([br, bl])
-        top_pt = cls._get_midpoint([tl, tr])
-
-        height = cls._length_segment(bottom_pt, top_pt)
-        width = cls._length_segment(left_pt, right_pt)
-
-        h_angle = cls._angle_between(left_pt, right_pt)
-        v_angle = cls._angle_between(top_pt, bottom_pt, vertical=True)
+        cls.offset = (int(offset[0] * geometry.widths[i]), int(offset[1] * geometry.heights[i]))
+        cls.marker_pos = ScreenPosition(tuple(geometry.marker_pos[i].tolist()))
 
-        cls.offset = (int(offset[0] * width), int(offset[1] * height))
-        cls.marker_pos = ScreenPosition((center_pt[0] + cls.offset[0],
-                                         center_pt[1] + cls.offset[1]))
-        # DRONE_POS is a tuple (x, y) that represents the position of the UAV on the pygame display
-        m_angle = cls._angle_between(DRONE_POS, cls.marker_pos, vertical=True)
-        m_distance = cls._length_segment(DRONE_POS, cls.marker_pos)
+        # update output
+        MarkerStatus.id = int(geometry.ids[i])
+        MarkerStatus.corners = geometry.corners[i]
+        MarkerStatus.center_pt = ScreenPosition(tuple(geometry.centers[i].tolist()))
+        MarkerStatus.left_pt = ScreenPosition(tuple(geometry.left_pts[i].tolist()))
+        MarkerStatus.right_pt = ScreenPosition(tuple(geometry.right_pts[i].tolist()))
+        MarkerStatus.bottom_pt = ScreenPosition(tuple(geometry.bottom_pts[i].tolist()))
+        MarkerStatus.top_pt = ScreenPosition(tuple(geometry.top_pts[i].tolist()))
+        MarkerStatus.h_angle = Angle(geometry.h_angles[i])
+        MarkerStatus.v_angle = Angle(geometry.v_angles[i])
+        MarkerStatus.marker_pos = cls.marker_pos
+        MarkerStatus.m_angle = Angle(geometry.m_angles[i])
+        MarkerStatus.m_distance = Distance(geometry.m_distances[i])
+        MarkerStatus.height = Distance(geometry.heights[i])
+        MarkerStatus.width = Distance(geometry.widths[i])
 
         cls.draw(frame)
-
-        # update output
-        MarkerStatus.id = target_marker_id
-        MarkerStatus.corners = corners
-        MarkerStatus.center_pt = center_pt
-        MarkerStatus.left_pt = left_pt
-        MarkerStatus.right_pt = right_pt
-        MarkerStatus.bottom_pt = bottom_pt
-        MarkerStatus.top_pt = top_pt
-        MarkerStatus.h_angle = h_angle
-        MarkerStatus.v_angle = v_angle
-        MarkerStatus.m_angle = m_angle
-        MarkerStatus.m_distance = m_distance
-        MarkerStatus.height = height
-        MarkerStatus.width = width
         return MarkerStatus
 
-    @staticmethod
-    def _get_marker_with_min_id(markers: DetectedMarkersStatus) -> (int, List[ScreenPosition]):
-        target_id = -1
-        target_corners = []
-
-        if markers.ids is None:
-            return target_id, target_corners
-
-        for i in range(len(markers.ids)):
-            marker_id = markers.ids[i][0]
-            if marker_id < target_id or target_id == -1:
-                target_id = marker_id
-                target_corners = markers.corners[i][0]
-
-        return target_id, target_corners
-
-    @staticmethod
-    def _get_midpoint(corners: List[ScreenPosition]) -> ScreenPosition:
-        # corners = [p1,p2,p3,p4] with pi = (xi, yi)
-        xc = yc = 0
-        n = len(corners)
-        for x, y in corners:
-            xc += x
-            yc += y
-        xc = int(xc / n)
-        yc = int(yc / n)
-        midpoint = (xc, yc)
-        return ScreenPosition(midpoint)
-
-    @staticmethod
-    def _angle_between(p1: ScreenPosition, p2: ScreenPosition, vertical: bool = False) -> Angle:
-        dx = p1[0] - p2[0]
-        dy = p1[1] - p2[1]
-        if not vertical:  # Angle between horizontal axis and segment (p1,p2)
-            alpha = numpy.arctan(-dy / (dx + 0.000001))
-            return Angle(alpha)
-        else:  # Angle between vertical axis and segment (p1,p2)
-            beta = numpy.arctan(-dx / (dy + 0.000001))
-            return Angle(beta)
-
-    @staticmethod
-    def _length_segment(p1: ScreenPosition, p2: ScreenPosition) -> Distance:
-        length = numpy.sqrt((p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2)
-        return Distance(length)
+    @classmethod
+    def compute_geometry(cls, ids: numpy.ndarray, corners: numpy.ndarray, offset: tuple = (0, 0)) -> MarkersGeometry:
+        """
+        Computes the geometry of N markers from their ids (N,) and corners (N, 4, 2),
+        offset being the (x, y) shift of the point to reach, in ratios of the marker width and height
+        """
+        # Center and midpoints of the 4 sides of every marker in a single product, truncated to screen positions
+        points = (cls.MIDPOINT_WEIGHTS @ corners).astype(int)
+        # Symmetry axes : left -> right and bottom -> top vectors
+        axes = points[:, 1::2] - points[:, 2::2]
+        sizes = numpy.hypot(axes[..., 0], axes[..., 1])
+        widths, heights = sizes[:, 0], sizes[:, 1]
+        # Angle between horizontal axis and (left, right), angle between vertical axis and (top, bottom)
+        h_angles = numpy.arctan(-axes[:, 0, 1] / (axes[:, 0, 0] + 0.000001))
+        v_angles = numpy.arctan(axes[:, 1, 0] / (-axes[:, 1, 1] + 0.000001))
+
+        marker_pos = points[:, 0] + (sizes * offset).astype(int)
+        m_angles, m_distances = cls.locate(marker_pos)
+        return MarkersGeometry(ids, corners, points[:, 0], points[:, 1], points[:, 2], points[:, 3], points[:, 4],
+                               heights, widths, h_angles, v_angles, marker_pos, m_angles, m_distances)
+
+    @classmethod
+    def locate(cls, marker_pos) -> (Angle, Distance):
+        """
+        Returns the angle and the distance between the UAV and a point of the screen,
+        or the arrays of angles and distances of an (N, 2) array of points
+        """
+        # DRONE_POS is a tuple (x, y) that represents the position of the UAV on the pygame display
+        d = cls.DRONE_POS_ARRAY - marker_pos
+        dx, dy = d[..., 0], d[..., 1]
+        m_angle = numpy.arctan(-dx / (dy + 0.000001))   # Angle between vertical axis and segment (drone, marker)
+        m_distance = numpy.hypot(dx, dy)
+        return Angle(m_angle), Distance(m_distance)
 
     @classmethod
     def draw(cls, frame: numpy.ndarray):
         if MarkerStatus.id == -1:
             return
         cv2.aruco.drawDetectedMarkers(frame,
-                                      numpy.array([[MarkerStatus.corners]]),
+                                      MarkerStatus.corners.reshape(1, 1, 4, 2),
                                       numpy.array([[MarkerStatus.id]]),
                                       borderColor=RED)
         cv2.line(frame,
@@ -185,18 +232,14 @@ class SelectTargetMarker:
                  MarkerStatus.right_pt,
                  RED, 2)
 
-        top_pt_with_offset = tuple(numpy.array(MarkerStatus.top_pt) + numpy.array(cls.offset))
-        bottom_pt_with_offset = tuple(numpy.array(MarkerStatus.bottom_pt) + numpy.array(cls.offset))
-        left_pt_with_offset = tuple(numpy.array(MarkerStatus.left_pt) + numpy.array(cls.offset))
-        right_pt_with_offset = tuple(numpy.array(MarkerStatus.right_pt) + numpy.array(cls.offset))
-
+        dx, dy = cls.offset
         cv2.line(frame,
-                 top_pt_with_offset,
-                 bottom_pt_with_offset,
+                 (MarkerStatus.top_pt[0] + dx, MarkerStatus.top_pt[1] + dy),
+                 (MarkerStatus.bottom_pt[0] + dx, MarkerStatus.bottom_pt[1] + dy),
                  RED, 2)
         cv2.line(frame,
-                 left_pt_with_offset,
-                 right_pt_with_offset,
+                 (MarkerStatus.left_pt[0] + dx, MarkerStatus.left_pt[1] + dy),
+                 (MarkerStatus.right_pt[0] + dx, MarkerStatus.right_pt[1] + dy),
                  RED, 2)
 
         if DRONE_POS[0] != 0:
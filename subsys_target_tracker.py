@@ -0,0 +1,124 @@
+import math
+from types import SimpleNamespace
+
+import numpy
+
+from parameters import DEG2RAD, IMG_SIZE, ScreenPosition
+from subsys_select_target_marker import SelectTargetMarker
+
+
+class TargetTracker:
+    """
+    Estimates the position and velocity of the target marker in the image between two detections,
+    with a constant-velocity Kalman filter on its screen position (marker_pos of MarkerStatus) :
+        state x = [u, v, du/dt, dv/dt] in pixels and pixels/s
+    The rotation of the UAV shifts the whole image horizontally : the yaw rate measured by the Tello is applied as
+    a known input of the prediction (u decreases by focal * yaw rate * dt), so the filter velocity only holds
+    the apparent motion of the marker due to the translation of the UAV.
+    The measurements are dated with the decoding time of their frame, and the target is predicted at any time, so the
+    control stage can run faster than the detection, through skipped frames and brief occlusions of the marker.
+    The target is lost when it has not been detected for PARAM_MAX_COAST seconds, or when another marker is selected.
+    All times are time.perf_counter() times, or the recorded times of the frames when a flight is replayed.
+    """
+    PARAM_PROCESS_NOISE: float = 600.0      # Standard deviation of the marker acceleration on screen, in pixels/s²
+    PARAM_MEASUREMENT_NOISE: float = 4.0    # Standard deviation of the detected position, in pixels
+    PARAM_INITIAL_VELOCITY_STD: float = 200.0   # in pixels/s
+    PARAM_MAX_COAST: float = 0.5            # Max prediction time without detection, in seconds
+    PARAM_CAMERA_HFOV: float = 82.6         # Horizontal field of view of the Tello camera, in degrees
+
+    FOCAL: float = IMG_SIZE[0] / 2 / math.tan(PARAM_CAMERA_HFOV * DEG2RAD / 2)  # in pixels
+
+    target_id: int = -1
+    x: numpy.ndarray = numpy.zeros(4)
+    P: numpy.ndarray = numpy.eye(4)
+    estimate_time: float = 0.0      # Time of the state estimate
+    last_detection_time: float = 0.0
+    last_query_time: float = 0.0    # Time of the last prediction of the target
+    marker: SimpleNamespace = None  # Snapshot of MarkerStatus of the last detection of the target
+    LOST_TARGET: SimpleNamespace = SimpleNamespace(id=-1)
+    H: numpy.ndarray = numpy.array([[1.0, 0.0, 0.0, 0.0],
+                                    [0.0, 1.0, 0.0, 0.0]])
+
+    @classmethod
+    def setup(cls):
+        cls.reset()
+
+    @classmethod
+    def reset(cls):
+        cls.target_id = -1
+        cls.marker = None
+
+    @classmethod
+    def transition(cls, dt: float) -> (numpy.ndarray, numpy.ndarray):
+        F = numpy.eye(4)
+        F[0, 2] = F[1, 3] = dt
+        # Piecewise constant white acceleration noise
+        q = cls.PARAM_PROCESS_NOISE ** 2
+        Q1 = q * numpy.array([[dt ** 4 / 4, dt ** 3 / 2],
+                              [dt ** 3 / 2, dt ** 2]])
+        Q = numpy.zeros((4, 4))
+        Q[numpy.ix_((0, 2), (0, 2))] = Q1
+        Q[numpy.ix_((1, 3), (1, 3))] = Q1
+        return F, Q
+
+    @classmethod
+    def predict(cls, t: float, yaw_rate: float) -> (numpy.ndarray, numpy.ndarray):
+        """ Returns the state and covariance predicted at time t, without changing the estimate """
+        dt = max(t - cls.estimate_time, 0.0)
+        F, Q = cls.transition(dt)
+        x = F @ cls.x
+        x[0] -= cls.FOCAL * yaw_rate * DEG2RAD * dt
+        return x, F @ cls.P @ F.T + Q
+
+    @classmethod
+    def update(cls, marker: SimpleNamespace, detection_time: float, yaw_rate: float):
+        """
+        Corrects the estimate with the target selected in a new frame (MarkerStatus snapshot),
+        detection_time being the decoding time of the frame, and yaw_rate the yaw rate of the UAV in deg/s
+        """
+        if marker.id == -1:
+            return
+        z = numpy.array(marker.marker_pos, dtype=float)
+        if marker.id != cls.target_id or detection_time - cls.last_detection_time > cls.PARAM_MAX_COAST:
+            # New target : starts from the detected position, at rest
+            cls.x = numpy.array([z[0], z[1], 0.0, 0.0])
+            cls.P = numpy.diag([cls.PARAM_MEASUREMENT_NOISE ** 2] * 2 + [cls.PARAM_INITIAL_VELOCITY_STD ** 2] * 2)
+        else:
+            x, P = cls.predict(detection_time, yaw_rate)
+            R = numpy.eye(2) * cls.PARAM_MEASUREMENT_NOISE ** 2
+            S = cls.H @ P @ cls.H.T + R
+            K = P @ cls.H.T @ numpy.linalg.inv(S)
+            cls.x = x + K @ (z - cls.H @ x)
+            cls.P = (numpy.eye(4) - K @ cls.H) @ P
+        cls.target_id = marker.id
+        cls.estimate_time = detection_time
+        cls.last_detection_time = detection_time
+        cls.marker = marker
+
+    @classmethod
+    def get_target(cls, t: float, yaw_rate: float) -> SimpleNamespace:
+        """
+        Returns the target predicted at time t, as a copy of the last MarkerStatus snapshot of the target
+        with its position (marker_pos, m_angle, m_distance) predicted at t, or a snapshot with id -1 if the target
+        is lost
+        """
+        cls.last_query_time = t
+        if cls.target_id == -1 or t - cls.last_detection_time > cls.PARAM_MAX_COAST:
+            return cls.LOST_TARGET
+        x, _ = cls.predict(t, yaw_rate)
+        marker_pos = ScreenPosition((int(x[0]), int(x[1])))
+        m_angle, m_distance = SelectTargetMarker.locate(marker_pos)
+        target = SimpleNamespace(**vars(cls.marker))
+        target.marker_pos = marker_pos
+        target.m_angle = m_angle
+        target.m_distance = m_distance
+        return target
+
+    @classmethod
+    def __get_dict__(cls) -> dict:
+        now = max(cls.last_query_time, cls.last_detection_time)
+        if cls.target_id == -1 or now - cls.last_detection_time > cls.PARAM_MAX_COAST:
+            return {'Track': '-'}
+        return {'Track': f'id {cls.target_id} '
+                         f'v ({int(cls.x[2])}, {int(cls.x[3])}) '
+                         f'age {1000 * (now - cls.last_detection_time):.0f} ms'}
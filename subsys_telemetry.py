@@ -0,0 +1,181 @@
+import json
+import os
+import time
+from queue import SimpleQueue, Empty
+from threading import Thread, Event
+from typing import Dict, List
+
+import numpy
+
+from DJITelloPy.djitellopy.state import TelloState, StateHistory
+
+
+class TelemetryRecorder:
+    """
+    Records the flight telemetry in a directory holding one append-only binary file per channel.
+    Each file is a flat sequence of fixed-size numpy records (the dtypes are saved in schema.json), so a whole flight
+    can be loaded back in a few milliseconds with numpy.memmap, see load().
+    Channels :
+        state   : every state packet received from the Tello
+        rc      : every RC command sent by TelloActuators
+        markers : one record per marker detected in a frame (DetectedMarkersStatus)
+        timings : per-stage processing times
+        latency : latency of each frame handed to the control stage, from its decoding to the RC command (see
+                  ImageProcess.latency), total is NaN when no new command was sent
+        video   : one record (reception time, size) per raw H.264 packet of the video stream, the packets themselves
+                  are appended to video.h264, which can be played by any video player (see ReplayTello)
+    The record_*() methods only push a tuple in a queue, the records are converted and written by batches
+    from a background thread.
+    """
+    CHANNELS: Dict[str, numpy.dtype] = {
+        'state': numpy.dtype([('t', 'f8'), ('seq', 'i8')] + [(key, 'f4') for key in StateHistory.FIELDS]),
+        'rc': numpy.dtype([('t', 'f8'), ('a', 'i1'), ('b', 'i1'), ('c', 'i1'), ('d', 'i1')]),
+        'markers': numpy.dtype([('t', 'f8'), ('frame_seq', 'i8'), ('id', 'i4'), ('corners', 'f4', (4, 2))]),
+        'timings': numpy.dtype([('t', 'f8'), ('stage', 'u1'), ('ms', 'f4')]),
+        'video': numpy.dtype([('t', 'f8'), ('size', 'u4')]),
+        'latency': numpy.dtype([('t', 'f8'), ('frame_seq', 'i8'), ('pts', 'i8'),
+                                ('wait', 'f4'), ('detect', 'f4'), ('control', 'f4'), ('total', 'f4')]),
+    }
+    STAGES: List[str] = ['detect', 'control', 'render']     # Stage codes of the timings channel, extended on the fly
+    SCHEMA_FILE: str = 'schema.json'
+    VIDEO_FILE: str = 'video.h264'
+    BATCH_PERIOD: float = 0.5   # Time between two batched writes, in seconds
+    RC_LIMIT: int = 100         # The RC commands are clamped by the Tello client, and fit in the int8 columns
+
+    enabled: bool = False
+    directory: str = None
+    files: dict = {}
+    video_file = None
+    records: SimpleQueue = None
+    stop_request: Event = None
+    writer_thread: Thread = None
+    schema_stages: list = None  # Stage codes saved in the schema file
+
+    @classmethod
+    def setup(cls, root_directory: str, directory: str = None):
+        """ Starts recording in root_directory/directory (named after the current date and time by default) """
+        if directory is None:
+            directory = time.strftime('flight_%Y%m%d_%H%M%S')
+        cls.directory = os.path.join(root_directory, directory)
+        os.makedirs(cls.directory, exist_ok=True)
+        cls.files = {channel: open(os.path.join(cls.directory, f'{channel}.bin'), 'ab') for channel in cls.CHANNELS}
+        cls.video_file = open(os.path.join(cls.directory, cls.VIDEO_FILE), 'ab')
+        cls.records = SimpleQueue()
+        cls.stop_request = Event()
+        cls.schema_stages = None
+        cls.writer_thread = Thread(target=cls.run, daemon=True)
+        cls.writer_thread.start()
+        cls.enabled = True
+        print('TelemetryRecorder | Recording in', cls.directory)
+
+    @classmethod
+    def record(cls, channel: str, row: tuple):
+        if cls.enabled:
+            cls.records.put((channel, row))
+
+    @classmethod
+    def record_state(cls, state: TelloState):
+        cls.record('state', (state.timestamp, state.seq) + tuple(getattr(state, key) for key in StateHistory.FIELDS))
+
+    @classmethod
+    def record_rc(cls, a: int, b: int, c: int, d: int):
+        limit = cls.RC_LIMIT
+        cls.record('rc', (time.time(),) + tuple(max(-limit, min(int(rc), limit)) for rc in (a, b, c, d)))
+
+    @classmethod
+    def record_markers(cls, timestamp: float, frame_seq: int, corners: list, ids: numpy.ndarray):
+        if ids is None:
+            return
+        for marker_corners, marker_id in zip(corners, numpy.ravel(ids)):
+            cls.record('markers', (timestamp, frame_seq, int(marker_id), numpy.reshape(marker_corners, (4, 2))))
+
+    @classmethod
+    def record_timing(cls, stage: str, duration_ms: float):
+        if stage not in cls.STAGES:
+            cls.STAGES.append(stage)
+        cls.record('timings', (time.time(), cls.STAGES.index(stage), duration_ms))
+
+    @classmethod
+    def record_latency(cls, timestamp: float, frame_seq: int, pts: int,
+                       wait_ms: float, detect_ms: float, control_ms: float, total_ms: float):
+        cls.record('latency', (timestamp, frame_seq, pts, wait_ms, detect_ms, control_ms, total_ms))
+
+    @classmethod
+    def record_video(cls, packet: bytes):
+        """ Packet callback of BackgroundFrameRead """
+        cls.record('video', (time.time(), packet))
+
+    @classmethod
+    def run(cls):
+        while not cls.stop_request.wait(cls.BATCH_PERIOD):
+            cls.safe_write_batch()
+        cls.safe_write_batch()
+
+    @classmethod
+    def safe_write_batch(cls):
+        """ Writes a batch, an invalid record only loses its batch instead of stopping the recording """
+        try:
+            cls.write_batch()
+        except Exception as exc:
+            print('TelemetryRecorder | Batch lost :', repr(exc))
+
+    @classmethod
+    def write_batch(cls):
+        batches: Dict[str, list] = {channel: [] for channel in cls.CHANNELS}
+        while True:
+            try:
+                channel, row = cls.records.get_nowait()
+            except Empty:
+                break
+            batches[channel].append(row)
+        if batches['video']:
+            # The packets go to the video file, their channel only keeps their size
+            cls.video_file.write(b''.join(packet for _, packet in batches['video']))
+            cls.video_file.flush()
+            batches['video'] = [(timestamp, len(packet)) for timestamp, packet in batches['video']]
+        for channel, rows in batches.items():
+            if rows:
+                cls.files[channel].write(numpy.array(rows, dtype=cls.CHANNELS[channel]).tobytes())
+                cls.files[channel].flush()
+        if cls.schema_stages != cls.STAGES:
+            cls.write_schema()
+
+    @classmethod
+    def write_schema(cls):
+        cls.schema_stages = list(cls.STAGES)
+        schema = {'channels': {channel: dtype.descr for channel, dtype in cls.CHANNELS.items()},
+                  'stages': cls.STAGES}
+        with open(os.path.join(cls.directory, cls.SCHEMA_FILE), 'w') as schema_file:
+            json.dump(schema, schema_file)
+
+    @classmethod
+    def stop(cls):
+        if not cls.enabled:
+            return
+        cls.enabled = False
+        cls.stop_request.set()
+        cls.writer_thread.join()
+        for file in cls.files.values():
+            file.close()
+        cls.video_file.close()
+        cls.files = {}
+
+    @staticmethod
+    def load(directory: str) -> Dict[str, numpy.ndarray]:
+        """
+        Maps the channels of a recorded flight in memory, as numpy record arrays (columns are accessed by name,
+        e.g. flight['state']['yaw']). The stage names of the timings channel are returned under the 'stages' key.
+        """
+        with open(os.path.join(directory, TelemetryRecorder.SCHEMA_FILE)) as schema_file:
+            schema = json.load(schema_file)
+        flight = {}
+        for channel, descr in schema['channels'].items():
+            dtype = numpy.dtype([tuple(field) for field in descr])
+            path = os.path.join(directory, f'{channel}.bin')
+            n_records = os.path.getsize(path) // dtype.itemsize  # Ignores a partially written last record
+            if n_records == 0:
+                flight[channel] = numpy.zeros(0, dtype=dtype)
+            else:
+                flight[channel] = numpy.memmap(path, dtype=dtype, mode='r', shape=(n_records,))
+        flight['stages'] = schema['stages']
+        return flight
@@ -1,34 +1,52 @@
+import time
+
 from DJITelloPy.djitellopy.tello import Tello
 from subsys_read_user_input import RCStatus
+from subsys_telemetry import TelemetryRecorder
 
 
 class TelloActuators:
     """
     Sends the velocity commands to the Tello
+    A command is only sent when it changed (its version differs from the last sent one), or again after
+    RC_REFRESH_PERIOD seconds, so that a lost command packet does not leave the UAV on an old command
     """
+    RC_REFRESH_PERIOD: float = 0.5  # in seconds
     tello: Tello = None
-    previous_RCstate = None
+    sent_version: int = -1
+    last_sent_time: float = 0.0
+    refresh_count: int = 0          # Number of commands sent again after RC_REFRESH_PERIOD
     
     @classmethod
     def setup(cls, tello: Tello):
         cls.tello = tello
 
     @classmethod
-    def run(cls, rc_status: type(RCStatus)):
-        cls.update_rc_command(rc_status)
+    def run(cls, rc_status: type(RCStatus)) -> bool:
+        return cls.update_rc_command(rc_status)
 
     @classmethod
-    def update_rc_command(cls, rc_status: RCStatus):
+    def update_rc_command(cls, rc_status: RCStatus) -> bool:
         """Update routine. Send velocities to Tello.
+        Returns True if a new command version was sent, False if nothing was sent or the last command was only sent
+        again to keep it alive.
         """
-        if rc_status.toStr() != cls.previous_RCstate :
+        command = rc_status.command     # Consistent snapshot, even if another thread sets a new command meanwhile
+        now = time.perf_counter()
+        new_command = command.version != cls.sent_version
+        if new_command or now - cls.last_sent_time > cls.RC_REFRESH_PERIOD:
             cls.tello.send_rc_control(
-                rc_status.a,  # left_right_velocity,
-                rc_status.b,  # for_back_velocity,
-                rc_status.c,  # up_down_velocity,
-                rc_status.d,  # yaw_velocity,
+                command.a,  # left_right_velocity,
+                command.b,  # for_back_velocity,
+                command.c,  # up_down_velocity,
+                command.d,  # yaw_velocity,
             )
-            cls.previous_RCstate = rc_status.toStr()
+            TelemetryRecorder.record_rc(command.a, command.b, command.c, command.d)
+            cls.sent_version = command.version
+            cls.last_sent_time = now
+            cls.refresh_count += not new_command
+            return new_command
+        return False
         
     @classmethod
     def stop(cls):
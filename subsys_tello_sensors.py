@@ -1,9 +1,10 @@
-from queue import LifoQueue
+from typing import Optional
 
 import cv2
 import numpy
 
 from DJITelloPy.djitellopy.tello import Tello, BackgroundFrameRead
+from channels import LatestMailbox
 from parameters import MODE, IMG_SIZE, RUN, RunStatus
 from subsys_read_user_input import ModeStatus
 from subsys_tello_actuators import TelloActuators
@@ -14,20 +15,25 @@ class TelloSensors:
     """
     Retrieves the attitude and battery level from onboard Tello sensors
     Calls the high-level functions from the Tello API to handle Takeoff, Landing and Emergency flight modes
+    When the capture time of the processed frame is given, the attitude is the one of the UAV at that time,
+    interpolated from the state history, instead of the one of the last state packet.
     """
+    ATTITUDE_FIELDS: tuple = ('roll', 'pitch', 'yaw')
+    YAW_RATE_WINDOW: float = 0.5    # Duration over which the yaw rate is estimated, in seconds
 
     tello: Tello = None
     battery: int = 0
     roll: int = 0
     pitch: int = 0
     yaw: int = 0
+    yaw_rate: float = 0.0           # deg/s
 
     @classmethod
     def setup(cls, tello: Tello):
         cls.tello = tello
 
     @classmethod
-    def run(cls):
+    def run(cls, frame_timestamp: float = None):
         if ModeStatus.value == MODE.TAKEOFF:
             ModeStatus.value = MODE.MANUAL_FLIGHT
             cls.tello.takeoff()
@@ -37,15 +43,29 @@ class TelloSensors:
         elif ModeStatus.value == MODE.EMERGENCY:
             cls.tello.emergency()
             ModeStatus.value = -1
-        cls.update_state()
+        cls.update_state(frame_timestamp)
 
     @classmethod
-    def update_state(cls):
-        state = cls.tello.get_current_state()
-        cls.battery = state['bat']
-        cls.roll = state['roll']
-        cls.pitch = state['pitch']
-        cls.yaw = state['yaw']
+    def update_state(cls, frame_timestamp: float = None):
+        state = cls.tello.get_state_snapshot()
+        if state is None:
+            return
+        cls.battery = state.bat
+        attitude = cls.get_attitude_at(frame_timestamp) if frame_timestamp is not None else None
+        if attitude is None:
+            cls.roll, cls.pitch, cls.yaw = state.roll, state.pitch, state.yaw
+        else:
+            cls.roll, cls.pitch, cls.yaw = attitude
+        stats = cls.tello.get_state_history().rolling_stats(cls.YAW_RATE_WINDOW, ('yaw',))
+        cls.yaw_rate = float(stats['rate'][0])
+
+    @classmethod
+    def get_attitude_at(cls, timestamp: float) -> Optional[tuple]:
+        """ Returns the (roll, pitch, yaw) attitude of the UAV at the given time, in degrees """
+        attitude = cls.tello.get_state_history().at(timestamp, cls.ATTITUDE_FIELDS)
+        if attitude is None:
+            return None
+        return tuple(int(round(angle)) for angle in attitude)
 
     @classmethod
     def update_rc(cls, rc_status: RCStatus):
@@ -57,37 +77,66 @@ class TelloSensors:
         sensors: dict = {'Battery': cls.battery,
                          'Roll': cls.roll,
                          'Pitch': cls.pitch,
-                         'Yaw': cls.yaw}
+                         'Yaw': cls.yaw,
+                         'Yaw rate': int(cls.yaw_rate)}
         return sensors
 
 
 class FrameReader:
-    # The purpose of this class is to put every received frame from the Tello in a queue
-    # (This step is mandatory as the frames are passed from one thread to another)
-    # Since only the last received frame is important to control the UAV, we can dismiss the older ones that
-    # have not been processed in time.
-    frames_queue: LifoQueue = None
+    # The purpose of this class is to pass every received frame from the Tello to the image processing thread.
+    # Since only the last received frame is important to control the UAV, the frames are put in a single-slot
+    # mailbox : a new frame replaces the previous one, and the older frames that have not been processed in time
+    # are dismissed (and counted as dropped).
+    frames_mailbox: LatestMailbox = None
     frame_reader: BackgroundFrameRead = None
+    last_seq: int = 0               # Sequence number of the last frame handed to the image processing thread
+    last_timestamp: float = 0.0     # Reception time of this frame
+    last_pts: int = -1              # Presentation timestamp of this frame in the video stream
+    last_decode_time: float = 0.0   # Decoding time of this frame (time.perf_counter()), the origin of its latency
 
     @classmethod
     def setup(cls, frame_reader: BackgroundFrameRead):
         cls.frame_reader = frame_reader
-        cls.frames_queue = LifoQueue()
+        cls.frames_mailbox = LatestMailbox()
+        cls.last_seq = 0
 
     @classmethod
     def update_frame(cls):
         if cls.frame_reader.stopped:
             RunStatus.value = RUN.STOP
         else:
-            cls.frames_queue.put_nowait(cls.frame_reader.frame)
+            frame_reader = cls.frame_reader
+            cls.frames_mailbox.put((frame_reader.frame, frame_reader.frame_pts, frame_reader.frame_decode_time),
+                                   frame_reader.frame_timestamp)
+
+    @classmethod
+    def wait_first_frame(cls, timeout: float) -> bool:
+        return cls.frames_mailbox.get(0, timeout) is not None
 
     @classmethod
-    def flush_old_frames(cls):
-        cls.frames_queue = LifoQueue()
+    def wait_frame_taken(cls, timeout: float) -> bool:
+        """ Waits until the last frame received has been taken by the image processing thread (used by the replay) """
+        return cls.frames_mailbox.wait_taken(timeout)
 
     @classmethod
-    def get_most_recent_frame(cls) -> numpy.ndarray:
-        raw_frame = cls.frames_queue.get()
-        frame = cv2.resize(raw_frame, IMG_SIZE)
-        cls.flush_old_frames()
+    def get_most_recent_frame(cls, timeout: float = None) -> Optional[numpy.ndarray]:
+        """
+        Returns the most recent frame, waiting for a frame newer than the previous one at most timeout seconds.
+        Returns None if no new frame has been received in time.
+        """
+        slot = cls.frames_mailbox.get(cls.last_seq, timeout)
+        if slot is None:
+            return None
+        cls.last_seq, cls.last_timestamp, (raw_frame, cls.last_pts, cls.last_decode_time) = slot
+        if raw_frame.shape[1::-1] != IMG_SIZE:
+            # The decoder already scales the frames to IMG_SIZE, this is only a safety net
+            frame = cv2.resize(raw_frame, IMG_SIZE)
+        else:
+            frame = raw_frame
         return frame
+
+    @classmethod
+    def __get_dict__(cls) -> dict:
+        frames: dict = {'Frame': cls.last_seq,
+                        'Dropped': cls.frames_mailbox.dropped}
+        return frames
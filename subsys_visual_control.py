@@ -1,4 +1,7 @@
-from parameters import DEG2RAD, RAD2DEG
+import math
+import time
+
+from parameters import DEG2RAD, RAD2DEG, POSE_CONTROL
 from subsys_read_user_input import RCStatus
 from subsys_select_target_marker import MarkerStatus
 import numpy
@@ -10,37 +13,63 @@ class VisualControl:
     Input: MarkerStatus class containing information about the selected ARUCO code (distance and angles between
     marker and UAV, etc...)
     Output: RCStatus class containing velocity commands that will be forwarded to the UAV
+    When the target is lost, the velocity commands decay exponentially with the time elapsed since the loss,
+    whatever the rate VisualControl is run at.
+    With POSE_CONTROL, the UAV steers on the metric position of the point to reach (MarkerStatus.gate_pos, see
+    MarkerPoseEstimator) instead of its screen position, so the gains do not depend on the image size nor the range.
     """
     KP_LR_CTRL = 0.2
     KP_YAW_CTRL = 0.5
-    cmp: int = 0  # Counts the successive frames without any detected marker
+    KP_LR_POSE_CTRL = 40.0             # Left/right velocity per meter of lateral offset of the point to reach
+    FORWARD_SPEED: int = 40            # Forward velocity when the target is straight ahead
+    DECAY_TIME_CONSTANT: float = 3.3   # in seconds (formerly a 0.99 decay per frame, at 30 FPS)
+    BRAKE_DELAY: float = 0.35          # Time without marker before decreasing the forward velocity, in seconds
+    lost_time: float = None            # Time the target was lost at (time.perf_counter()), None if it is not lost
+    rc_when_lost: tuple = (0, 0, 0, 0)
 
     @classmethod
-    def run(cls, target_marker: MarkerStatus) -> type(RCStatus):
+    def run(cls, target_marker: MarkerStatus, now: float = None) -> type(RCStatus):
+        """ now is the current time (time.perf_counter() by default, the recorded time in a replay) """
         if target_marker.id == -1:  # When no markers are detected, smoothly stops the UAV
-            RCStatus.c = 0                          # up_down_velocity
-            RCStatus.d = int(0.99*RCStatus.d)       # yaw_velocity
-            RCStatus.a = int(0.99*RCStatus.a)       # left_right_velocity
-            if cls.cmp > 10:        # Waits for the UAV to pass the last Gate while decreasing its forward velocity
-                RCStatus.b = int(0.99*RCStatus.b)   # for_back_velocity
-            cls.cmp = cls.cmp + 1
+            if now is None:
+                now = time.perf_counter()
+            if cls.lost_time is None:
+                cls.lost_time = now
+                cls.rc_when_lost = RCStatus.command[1:]
+            elapsed = now - cls.lost_time
+            decay = math.exp(-elapsed / cls.DECAY_TIME_CONSTANT)
+            a, b, _, d = cls.rc_when_lost
+            if elapsed > cls.BRAKE_DELAY:   # Waits for the UAV to pass the last Gate while decreasing its forward velocity
+                b = int(math.exp(-(elapsed - cls.BRAKE_DELAY) / cls.DECAY_TIME_CONSTANT) * b)
+            RCStatus.set(a=int(decay * a),      # left_right_velocity
+                         b=b,                   # forward_backward_velocity
+                         c=0,                   # up_down_velocity
+                         d=int(decay * d))      # yaw_velocity
             return RCStatus
-        cls.cmp = 0
+        cls.lost_time = None
 
-        # Gets the angle and the distance between the marker and the drone
-        phi = int(target_marker.m_angle * RAD2DEG)
-        distance = target_marker.m_distance
+        if POSE_CONTROL and target_marker.range > 0:
+            # Bearing and lateral offset of the point to reach, in the camera frame
+            x, _, z = target_marker.gate_pos
+            phi = int(math.atan2(x, z) * RAD2DEG)
+            yaw_velocity = int(cls.KP_YAW_CTRL * phi)
+            left_right_velocity = int(cls.KP_LR_POSE_CTRL * x)
+        else:
+            # Gets the angle and the distance between the marker and the drone
+            phi = int(target_marker.m_angle * RAD2DEG)
+            distance = target_marker.m_distance
 
-        # Yaw velocity control
-        RCStatus.d = int(cls.KP_YAW_CTRL * phi)
+            # Yaw velocity control
+            yaw_velocity = int(cls.KP_YAW_CTRL * phi)
 
-        # Left/Right velocity control
-        dx = distance * numpy.sin(phi*DEG2RAD)
-        RCStatus.a = int(cls.KP_LR_CTRL * dx)
+            # Left/Right velocity control
+            dx = distance * numpy.sin(phi*DEG2RAD)
+            left_right_velocity = int(cls.KP_LR_CTRL * dx)
 
         # Forward/Backward velocity control
-        rb_threshold = 40
-        RCStatus.b = rb_threshold - int(rb_threshold * abs(phi)/70)
+        forward_backward_velocity = cls.FORWARD_SPEED - int(cls.FORWARD_SPEED * abs(phi)/70)
 
         # Up/Down velocity control
-        RCStatus.c = 0
+        up_down_velocity = 0
+
+        RCStatus.set(left_right_velocity, forward_backward_velocity, up_down_velocity, yaw_velocity)